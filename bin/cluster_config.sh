@@ -10,11 +10,18 @@ DB_PWD="{{ db_root_pwd }}"
     mysql -e "INSERT INTO clustrix_ui.clustrix_ui_systemproperty (name) VALUES (\"install_wizard_completed\")"
     mysql -e "set global cluster_name = \"$CLUSTER_NAME\""
  
-    #add nodes by ip to cluster: 
-    for i in $NODE_IPS; do
-        mysql -e "alter cluster add \"$i\""
-        sleep 5
-    done
+    #add nodes by ip to cluster, in one batch, waiting for membership:
+    #  cluster_join.py needs clxnode_netprobe.py next to it, without them
+    #  fall back to one node at a time
+    BIN_DIR="$(dirname "$0")"
+    if [ -x "$BIN_DIR/cluster_join.py" ] && [ -f "$BIN_DIR/clxnode_netprobe.py" ]; then
+        "$BIN_DIR/cluster_join.py" $NODE_IPS || exit 1
+    else
+        for i in $NODE_IPS; do
+            mysql -e "alter cluster add \"$i\""
+            sleep 5
+        done
+    fi
     #log "Completed cluster setup on ${HOSTNAME}"    
 
 exit 0
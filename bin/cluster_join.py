@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+#
+#   ClustrixDB cluster join tool.
+#
+#   Adds nodes to the cluster with as few ALTER CLUSTER ADD statements
+#   as possible, then watches the system tables until the new nodes are
+#   members instead of sleeping a fixed time between nodes.
+#
+#   Before adding anything, it compares every node's clock with ours over
+#   the back-end network. Nodes must be running
+#   `clxnode_netprobe.py --listen --port 24379` for this; nodes which don't
+#   answer are added without a skew check.
+
+import sys
+import socket
+import optparse
+import random
+import time
+from clxnode_netprobe import SkewSurvey, SKEW_PORT, BUDGET_SKEW_MS, valid_ip
+
+DEFAULT_SOCKET = '/var/lib/mysql/mysql.sock'
+JOIN_TIMEOUT = 600 # Seconds to wait for a batch of nodes to join
+JOIN_RETRIES = 3 # Attempts to add a node on its own after a batch fails
+POLL_INITIAL = 0.5 # Seconds, first delay between membership polls
+POLL_MAX = 10.0 # Seconds, longest delay between membership polls
+# IPs of nodes which are currently in quorum:
+MEMBERS_QUERY = ("SELECT n.iface_ip FROM system.nodeinfo n "
+        "JOIN system.membership m ON m.nid = n.nodeid "
+        "WHERE m.status = 'quorum'")
+# Every node the cluster knows about, with its membership status:
+MEMBERSHIP_QUERY = ("SELECT n.iface_ip, m.status FROM system.nodeinfo n "
+        "JOIN system.membership m ON m.nid = n.nodeid")
+# MySQL client errors which mean the connection went away, which is
+#   expected while the cluster regroups to take in new nodes:
+CR_SERVER_GONE_ERROR = 2006
+CR_SERVER_LOST = 2013
+
+class ClusterConnection(object):
+    """A single MySQL connection to the cluster, re-opened as needed.
+
+    ALTER CLUSTER ADD makes the cluster regroup, which drops every session,
+    so each statement gets one reconnect before its error is passed on."""
+    def __init__(self, MySQLdb, **connect_args):
+        self.MySQLdb = MySQLdb
+        self.connect_args = connect_args
+        self.db = None
+    def connect(self):
+        self.close()
+        self.db = self.MySQLdb.connect(**self.connect_args)
+        self.db.autocommit(True)
+    def close(self):
+        if self.db:
+            try:
+                self.db.close()
+            except self.MySQLdb.Error:
+                pass
+        self.db = None
+    def execute(self, sql, args=None, retry=True):
+        """Run sql, returning all rows. If the connection was lost, reconnect
+        and run it once more, unless retry is False."""
+        for attempt in (1, 2):
+            try:
+                if not self.db:
+                    self.connect()
+                c = self.db.cursor()
+                c.execute(sql, args)
+                rows = c.fetchall()
+                c.close()
+                return rows
+            except self.MySQLdb.OperationalError, e:
+                if not self.lost_connection(e):
+                    raise
+                self.close() # Reconnect on the next statement
+                if attempt == 2 or not retry:
+                    raise
+    @staticmethod
+    def lost_connection(error):
+        """Check if a MySQLdb error means the session was dropped."""
+        return error.args and error.args[0] in (CR_SERVER_GONE_ERROR,
+                CR_SERVER_LOST)
+    def members(self):
+        """Return the set of IPs of nodes in quorum, or None if the cluster
+        can't be queried right now (it may be regrouping)."""
+        try:
+            return set([row[0] for row in self.execute(MEMBERS_QUERY)])
+        except self.MySQLdb.Error:
+            self.close()
+            return None
+    def membership(self):
+        """Return a dict of IP: membership status for every node, or None
+        if the cluster can't be queried right now."""
+        try:
+            return dict(self.execute(MEMBERSHIP_QUERY))
+        except self.MySQLdb.Error:
+            self.close()
+            return None
+    def add(self, ips):
+        """Add all of ips to the cluster in a single statement.
+        The regroup usually drops our session before the statement returns,
+        so a lost connection is not an error here; membership polling tells
+        us whether the nodes made it."""
+        sql = "ALTER CLUSTER ADD %s" % ', '.join(['%s'] * len(ips))
+        try:
+            self.execute(sql, tuple(ips), retry=False)
+        except self.MySQLdb.OperationalError, e:
+            if not self.lost_connection(e):
+                raise
+
+class ClusterJoiner(object):
+    """Adds nodes in batches, waits for membership, and retries nodes
+    which did not make it individually."""
+    def __init__(self, conn, batch_size=0, timeout=JOIN_TIMEOUT,
+            retries=JOIN_RETRIES):
+        self.conn = conn
+        self.batch_size = batch_size # 0 means everything at once
+        self.timeout = timeout
+        self.retries = retries
+        self.joined = []
+        self.failed = {} # IP: last error
+    def log(self, message):
+        print "%s %s" % (time.strftime('%H:%M:%S'), message)
+        sys.stdout.flush()
+    def wait_for(self, ips):
+        """Poll membership until all of ips are in quorum or we time out.
+        Returns the IPs which did not join."""
+        deadline = time.time() + self.timeout
+        delay = POLL_INITIAL
+        pending = set(ips)
+        while True:
+            members = self.conn.members()
+            if members is not None:
+                pending -= members
+            if not pending or time.time() >= deadline:
+                return pending
+            # Exponential backoff with jitter:
+            time.sleep(min(random.uniform(delay / 2, delay),
+                max(0, deadline - time.time())))
+            delay = min(delay * 2, POLL_MAX)
+    def add_batch(self, ips):
+        """Add ips with one statement, returning the ones which failed."""
+        self.log("Adding %d node(s): %s" % (len(ips), ' '.join(ips)))
+        try:
+            self.conn.add(ips)
+        except self.conn.MySQLdb.Error, e:
+            # The statement is all-or-nothing, so every node failed
+            for ip in ips:
+                self.failed[ip] = str(e)
+            self.log("ALTER CLUSTER ADD failed: %s" % e)
+            return list(ips)
+        pending = self.wait_for(ips)
+        for ip in ips:
+            if ip in pending:
+                self.failed[ip] = "Not in quorum after %d seconds" % \
+                        self.timeout
+            else:
+                self.joined.append(ip)
+                self.failed.pop(ip, None)
+        return [ip for ip in ips if ip in pending]
+    def check_skew(self, ips, port=SKEW_PORT, budget=BUDGET_SKEW_MS,
+            refuse=False):
+        """Measure clock skew between us and ips, warning about nodes which
+        are outside the budget. With refuse, those nodes, and nodes whose
+        clocks could not be measured, are failed instead and left out of
+        the returned list of IPs to add."""
+        survey = SkewSurvey(ips, port)
+        survey.run()
+        for line in survey.summary():
+            self.log(line)
+        unmeasured = survey.unmeasured()
+        if unmeasured and len(unmeasured) == len(ips):
+            self.log("Warning: No node answered the clock skew check on port "
+                    "%d, so no clocks were compared. Run `clxnode_netprobe.py "
+                    "--listen --port %d` on every node, or use --skew-port 0 "
+                    "to skip the check." % (port, port))
+        for ip in unmeasured:
+            if refuse:
+                self.failed[ip] = "Clock skew could not be measured, no " \
+                        "reply on port %d" % port
+            elif len(unmeasured) < len(ips):
+                self.log("Warning: Clock on %s could not be measured, no "
+                        "reply on port %d." % (ip, port))
+        outliers = survey.outliers(budget)
+        for ip in outliers:
+            offset = survey.offsets()[ip][0]
+            if refuse:
+                self.failed[ip] = "Clock is %+.1f ms off, skew budget is " \
+                        "%.1f ms" % (offset, budget)
+            else:
+                self.log("Warning: Clock on %s is %+.1f ms off, outside the "
+                        "%.1f ms skew budget. Commits across the cluster will "
+                        "be slower until it is fixed." % (ip, offset, budget))
+        if refuse:
+            return [ip for ip in ips if ip not in outliers and
+                    ip not in unmeasured]
+        return ips
+    def batches(self, ips):
+        size = self.batch_size or len(ips)
+        return [ips[x:x + size] for x in range(0, len(ips), size)]
+    def join(self, ips):
+        """Join all of ips, return True if every node is a member."""
+        t0 = time.time()
+        members = self.conn.members() or set()
+        already = [ip for ip in ips if ip in members]
+        if already:
+            self.log("Already members: %s" % ' '.join(already))
+        todo = [ip for ip in ips if ip not in members]
+        retry = []
+        for batch in self.batches(todo):
+            retry.extend(self.add_batch(batch))
+        # Retry stragglers one at a time, so one bad node can't keep
+        #   the rest out of the cluster:
+        for ip in retry:
+            for attempt in range(self.retries):
+                if ip in (self.conn.members() or ()):
+                    # Joined late, after its batch timed out
+                    self.joined.append(ip)
+                    self.failed.pop(ip, None)
+                    break
+                self.log("Retrying %s (attempt %d of %d)" % (ip, attempt + 1,
+                    self.retries))
+                if not self.add_batch([ip]):
+                    break
+        self.log("Joined %d node(s) in %.1f seconds." % (len(self.joined),
+            time.time() - t0))
+        for ip, error in sorted(self.failed.items()):
+            self.log("Failed to add %s: %s" % (ip, error))
+        return not self.failed
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] IP ...")
+    parser.add_option('--unix-socket', default=DEFAULT_SOCKET,
+            help="MySQL socket of the local node [Default: %default]")
+    parser.add_option('--host', help="Connect over TCP to HOST instead of "
+            "the unix socket.")
+    parser.add_option('--port', type='int', default=3306)
+    parser.add_option('--user', default='root')
+    parser.add_option('--password', default='')
+    parser.add_option('--batch-size', type='int', default=0, help="Nodes "
+            "per ALTER CLUSTER ADD, 0 for all at once [Default: %default]")
+    parser.add_option('--timeout', type='int', default=JOIN_TIMEOUT,
+            help="Seconds to wait for each batch to join "
+            "[Default: %default]")
+    parser.add_option('--retries', type='int', default=JOIN_RETRIES,
+            help="Times to retry a node on its own [Default: %default]")
+    parser.add_option('--skew-port', type='int', default=SKEW_PORT,
+            help="Port the nodes' clxnode_netprobe.py listeners use, 0 to "
+            "skip the clock skew check [Default: %default]")
+    parser.add_option('--max-skew-ms', type='float', default=BUDGET_SKEW_MS,
+            help="Budget for clock skew between any two nodes "
+            "[Default: %default]")
+    parser.add_option('--refuse-skew', action='store_true', default=False,
+            help="Don't add nodes whose clocks are outside the skew budget, "
+            "or can't be measured, instead of just warning about them.")
+    (options, args) = parser.parse_args()
+
+    ips = []
+    for ip in args:
+        if not valid_ip(ip):
+            parser.error("`%s` is not a valid IP address." % ip)
+        if ip not in ips:
+            ips.append(ip)
+    if not ips:
+        parser.error("No node IPs given.")
+    try:
+        import MySQLdb
+    except ImportError:
+        print "Error: Python MySQLdb not found"
+        exit(1)
+    connect_args = {'user': options.user, 'passwd': options.password}
+    if options.host:
+        connect_args.update(host=options.host, port=options.port)
+    else:
+        connect_args['unix_socket'] = options.unix_socket
+    conn = ClusterConnection(MySQLdb, **connect_args)
+    joiner = ClusterJoiner(conn, options.batch_size, options.timeout,
+            options.retries)
+    if options.skew_port:
+        ips = joiner.check_skew(ips, options.skew_port, options.max_skew_ms,
+                options.refuse_skew)
+    ok = joiner.join(ips)
+    conn.close()
+    exit(not ok)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+#
+#   ClustrixDB node config reader and differ.
+#
+#   Reads the clxnode.json written by clxnode_install.py (or, for nodes
+#   installed before it existed, the KEY=VALUE lines of clxnode.conf)
+#   without sourcing anything, so that configs collected from many nodes
+#   can be shown, compared pairwise, or grouped by what they set.
+
+import sys
+import os
+import json
+import hashlib
+import optparse
+
+CONFIG_JSON_VERSION = 1 # Newest clxnode.json version we understand
+
+class NodeConfig(object):
+    """Options and extra variables from one node's config file."""
+    def __repr__(self):
+        return "<NodeConfig %s>" % self.path
+    def __init__(self, path):
+        self.path = path
+        self.options = {} # variable name: value
+        self.extra = {} # Variables the installer didn't know about
+        self.defaults = set() # Options left at their default
+        self.per_node = set() # Options which differ between nodes anyway
+        self.version = None # None for clxnode.conf
+        content = open(path).read()
+        if content.lstrip().startswith('{'):
+            self.load_json(content)
+        else:
+            self.load_bash(content)
+    def load_json(self, content):
+        doc = json.loads(content)
+        if doc.get('version') > CONFIG_JSON_VERSION:
+            raise ValueError("%s: config version %s is newer than %d" %
+                    (self.path, doc.get('version'), CONFIG_JSON_VERSION))
+        self.version = doc['version']
+        self.options = doc['options']
+        self.extra = doc.get('extra', {})
+        self.defaults = set(doc.get('defaults', []))
+        self.per_node = set(doc.get('per_node', []))
+    def load_bash(self, content):
+        """Values are strings here, and options at their default are
+        commented out, so they are simply missing."""
+        for line in content.split('\n'):
+            line = line.strip()
+            if '=' not in line or line.startswith('#'):
+                continue
+            key, value = [x.strip() for x in line.split('=', 1)]
+            self.options[key] = value
+    def settings(self, skip=()):
+        """All options and extra variables as one dict, without skip."""
+        settings = dict(self.extra)
+        settings.update(self.options)
+        for key in skip:
+            settings.pop(key, None)
+        return settings
+    def explicit(self, skip=(), defaults={}):
+        """settings() without options at their default, as strings.
+        clxnode.conf leaves most defaults out and clxnode.json lists them,
+        so this is what both formats agree on. defaults maps variable
+        names to default values, see default_values()."""
+        explicit = {}
+        for key, value in self.settings(skip).items():
+            value = str(value)
+            if key not in self.defaults and value != defaults.get(key):
+                explicit[key] = value
+        return explicit
+    def fingerprint(self, skip=(), defaults={}):
+        """Hash of explicit(), equal for nodes configured the same."""
+        settings = sorted(self.explicit(skip, defaults).items())
+        return hashlib.sha1(json.dumps(settings)).hexdigest()
+
+def default_values(configs):
+    """Return a dict of variable name: default value, as strings, from
+    the clxnode.json files among configs."""
+    defaults = {}
+    for config in configs:
+        for key in config.defaults:
+            if key in config.options:
+                defaults[key] = str(config.options[key])
+    return defaults
+
+def diff_configs(a, b, skip=(), defaults=None):
+    """Return a sorted list of (key, value in a, value in b) for every
+    setting which differs. Settings at their default are shown as the
+    default value if we know it, otherwise as None."""
+    if defaults is None:
+        defaults = default_values([a, b])
+    left = a.explicit(skip, defaults)
+    right = b.explicit(skip, defaults)
+    changes = []
+    for key in sorted(set(left) | set(right)):
+        old, new = left.get(key), right.get(key)
+        if old != new:
+            changes.append((key, old or defaults.get(key),
+                new or defaults.get(key)))
+    return changes
+
+def group_configs(configs, skip=(), defaults=None):
+    """Group configs by fingerprint, largest group first."""
+    if defaults is None:
+        defaults = default_values(configs)
+    groups = {}
+    for config in configs:
+        groups.setdefault(config.fingerprint(skip, defaults),
+                []).append(config)
+    return sorted(groups.values(), key=len, reverse=True)
+
+def load_all(paths):
+    """Load every path, printing and skipping ones which can't be read."""
+    configs = []
+    for path in paths:
+        try:
+            configs.append(NodeConfig(path))
+        except (IOError, ValueError, KeyError), e:
+            print >> sys.stderr, "Error: %s: %s" % (path, e)
+    return configs
+
+def main():
+    parser = optparse.OptionParser(usage="%prog show FILE ...\n"
+            "       %prog diff FILE FILE\n"
+            "       %prog group FILE ...")
+    parser.add_option('--skip', action='append', default=[],
+            metavar='VARIABLE', help="Ignore VARIABLE when comparing, may "
+            "be given more than once.")
+    parser.add_option('--all', action='store_true', default=False,
+            help="Also compare options which differ between nodes anyway, "
+            "like BACKEND_ADDR.")
+    (options, args) = parser.parse_args()
+    if len(args) < 2 or args[0] not in ('show', 'diff', 'group'):
+        parser.error("Give a command and config files.")
+    command, paths = args[0], args[1:]
+    configs = load_all(paths)
+    if len(configs) < len(paths):
+        exit(1)
+    def skip(*configs):
+        keys = set(options.skip)
+        if not options.all:
+            for config in configs:
+                keys |= config.per_node
+        return keys
+
+    if command == 'show':
+        for config in configs:
+            print "%s (%s):" % (config.path, config.version and
+                    "clxnode.json v%d" % config.version or "clxnode.conf")
+            for key, value in sorted(config.settings().items()):
+                print "    %s=%s%s" % (key, value,
+                        key in config.defaults and ' (default)' or '')
+    elif command == 'diff':
+        if len(configs) != 2:
+            parser.error("diff takes two config files.")
+        changes = diff_configs(configs[0], configs[1], skip(*configs))
+        for key, old, new in changes:
+            print "%s: %s -> %s" % (key, old, new)
+        exit(bool(changes))
+    else:
+        defaults = default_values(configs)
+        groups = group_configs(configs, skip(*configs), defaults)
+        reference = groups[0][0]
+        print "%d config(s) in %d group(s)." % (len(configs), len(groups))
+        for n, group in enumerate(groups):
+            print "Group %d, %d config(s): %s" % (n + 1, len(group),
+                    ' '.join(x.path for x in group))
+            if n:
+                # Say how it differs from the largest group
+                for key, old, new in diff_configs(reference, group[0],
+                        skip(*configs), defaults):
+                    print "    %s: %s -> %s" % (key, old, new)
+        exit(len(groups) > 1)
+
+
+if __name__ == "__main__":
+    main()
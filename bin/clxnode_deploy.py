@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+#
+#   ClustrixDB multi-node install driver.
+#
+#   Takes the option set printed by `clxnode_install.py --print-config`
+#   on a configured node and runs the installer with those options on
+#   many other nodes at once, instead of pasting the command onto each
+#   node by hand.
+#
+#   With --rolling, an installed cluster is reconfigured one node at a
+#   time instead, waiting for every node to be back in quorum before
+#   moving on, so the cluster stays up throughout.
+
+import os
+import sys
+import re
+import optparse
+import shlex
+import pipes
+import tempfile
+import subprocess
+import threading
+import Queue
+import shutil
+import random
+import time
+from cluster_join import ClusterConnection
+
+INSTALLER_NAME = 'clxnode_install.py'
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCE_DIR = os.path.join(os.path.dirname(BIN_DIR), 'rpms')
+DEFAULT_WORKERS = 8 # Nodes installed at once
+DEFAULT_REMOTE_DIR = '/root/clustrix-install'
+SSH_OPTIONS = ('-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no')
+# Note: every Popen here uses close_fds=True, otherwise one worker's child
+#   can inherit another worker's open file and hit "Text file busy".
+# --print-config prints per-node options like --cluster-addr=<BACKEND_ADDR>:
+PER_NODE_ARG = re.compile(r'^--([a-zA-Z0-9-]+)=<([A-Z_]+)>$')
+BACKEND_ARG = 'cluster-addr' # Installer option for BACKEND_ADDR
+ROLL_TIMEOUT = 900 # Seconds to wait for the cluster to be whole again
+POLL_INITIAL = 1.0 # Seconds, first delay between membership polls
+POLL_MAX = 15.0 # Seconds, longest delay between membership polls
+
+class SSHTransport(object):
+    """Copies files to and runs commands on a remote host over ssh."""
+    def __init__(self, host, user='root'):
+        self.host = host
+        self.target = '%s@%s' % (user, host)
+    def __repr__(self):
+        return "<SSHTransport %s>" % self.target
+    def path(self, remote_dir):
+        """Path to remote_dir as seen by commands we run."""
+        return remote_dir
+    def put(self, local_dir, remote_dir):
+        """Copy the contents of local_dir into remote_dir, with a tar pipe
+        so that a single connection carries every file. Symlinks are
+        copied as the files they point to.
+        Returns the exit status of the remote tar."""
+        tar = subprocess.Popen(('tar', '-C', local_dir, '-chf', '-', '.'),
+                stdout=subprocess.PIPE, close_fds=True)
+        remote = subprocess.Popen(('ssh',) + SSH_OPTIONS + (self.target,
+                'mkdir -p %s && tar -C %s -xf -' % (remote_dir, remote_dir)),
+                stdin=tar.stdout, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, close_fds=True)
+        tar.stdout.close() # Let tar see SIGPIPE if ssh dies
+        output = remote.communicate()[0]
+        tar.wait()
+        return tar.returncode or remote.returncode, output
+    def run(self, command):
+        """Start command on the host, returning a Popen whose stdout
+        carries the combined output."""
+        return subprocess.Popen(('ssh',) + SSH_OPTIONS + (self.target,
+                command), stdin=open(os.devnull), stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, close_fds=True)
+
+class LocalTransport(object):
+    """Stand-in transport which "installs" into a per-host directory on
+    this machine, optionally chroot'ed into it.
+
+    Useful for exercising the driver without real nodes, for example
+    with a fake installer that just echoes its arguments."""
+    def __init__(self, host, root, chroot=False):
+        self.host = host
+        self.root = os.path.join(root, host)
+        self.chroot = chroot
+    def __repr__(self):
+        return "<LocalTransport %s>" % self.root
+    def local_path(self, remote_dir):
+        """Map a remote path into this host's directory."""
+        return os.path.join(self.root, remote_dir.lstrip(os.sep))
+    def path(self, remote_dir):
+        """Path to remote_dir as seen by commands we run."""
+        if self.chroot:
+            return remote_dir
+        return self.local_path(remote_dir)
+    def put(self, local_dir, remote_dir):
+        dest = self.local_path(remote_dir)
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        try:
+            shutil.copytree(local_dir, dest)
+        except (IOError, OSError, shutil.Error), e:
+            return 1, str(e)
+        return 0, ''
+    def run(self, command):
+        if self.chroot:
+            cmd = ('chroot', self.root, 'sh', '-c', command)
+        else:
+            cmd = ('sh', '-c', command)
+        return subprocess.Popen(cmd, stdin=open(os.devnull),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                cwd=self.root, close_fds=True)
+
+class NodeJob(object):
+    """Install state and result for a single host."""
+    def __repr__(self):
+        return "<NodeJob %s: %s>" % (self.host, self.status)
+    def __init__(self, spec, transport):
+        # Host specs look like "host" or "host=BACKEND_IP"
+        if '=' in spec:
+            self.host, self.backend_addr = spec.split('=', 1)
+        else:
+            self.host, self.backend_addr = spec, None
+        self.transport = transport
+        self.status = 'pending'
+        self.returncode = None
+        self.started_at = None
+        self.finished_at = None
+        self.output = [] # Keep the tail for the summary
+    def node_args(self, args):
+        """Fill in per-node placeholders from --print-config output.
+        Placeholders we have no value for are dropped, so the installer
+        picks its own default on that node. A BACKEND_IP from the host
+        spec replaces any back-end address in args."""
+        values = {'BACKEND_ADDR': self.backend_addr}
+        filled = []
+        for arg in args:
+            match = PER_NODE_ARG.match(arg)
+            if match:
+                if values.get(match.group(2)):
+                    filled.append('--%s=%s' % (match.group(1),
+                        values[match.group(2)]))
+            elif self.backend_addr and \
+                    arg.startswith('--%s=' % BACKEND_ARG):
+                # Someone else's address, probably from --args
+                filled.append('--%s=%s' % (BACKEND_ARG, self.backend_addr))
+            else:
+                filled.append(arg)
+        return filled
+    def backend_arg(self, args):
+        """Return the back-end address node_args() gives this node, or
+        None if it is left to the installer."""
+        for arg in self.node_args(args):
+            if arg.startswith('--%s=' % BACKEND_ARG):
+                return arg.split('=', 1)[1]
+        return None
+    def duration(self):
+        if not self.started_at:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+class Deployer(object):
+    """Runs NodeJobs through a bounded pool of worker threads, streaming
+    each node's output with a host prefix."""
+    def __init__(self, jobs, source_dir, remote_dir, args,
+            workers=DEFAULT_WORKERS, quiet=False, stage=False):
+        self.jobs = jobs
+        self.source_dir = source_dir # Installer and RPMs, see make_bundle()
+        self.remote_dir = remote_dir
+        self.args = args # Installer arguments, before node_args()
+        self.workers = max(1, min(workers, len(jobs)))
+        self.quiet = quiet
+        self.stage = stage # Only copy and stage the RPMs, don't install
+        self.print_lock = threading.Lock()
+        self.queue = Queue.Queue()
+    def log(self, job, line):
+        with self.print_lock:
+            print "[%s] %s" % (job.host, line)
+            sys.stdout.flush()
+    def command(self, job):
+        if self.stage:
+            return remote_command(job.transport.path(self.remote_dir),
+                    ['--stage-rpms'])
+        return remote_command(job.transport.path(self.remote_dir),
+                job.node_args(self.args) + ['--yes'])
+    def run_job(self, job):
+        job.started_at = time.time()
+        job.status = 'copying'
+        self.log(job, "Copying installer and RPMs to %s" % self.remote_dir)
+        rc, output = job.transport.put(self.source_dir, self.remote_dir)
+        if rc:
+            job.output = output.strip().split('\n')
+            job.returncode = rc
+            return
+        job.status = 'installing'
+        command = self.command(job)
+        self.log(job, "Running: %s" % command)
+        p = job.transport.run(command)
+        for line in iter(p.stdout.readline, ''):
+            line = line.rstrip()
+            job.output = (job.output + [line])[-5:]
+            if not self.quiet:
+                self.log(job, line)
+        p.wait()
+        job.returncode = p.returncode
+    def finish_job(self, job):
+        """run_job() and record how it went."""
+        try:
+            self.run_job(job)
+        except (IOError, OSError), e:
+            # Couldn't even start the transport command
+            job.output = [str(e)]
+            job.returncode = -1
+        job.finished_at = time.time()
+        if job.returncode:
+            job.status = 'FAILED'
+        else:
+            job.status = 'ok'
+        self.log(job, "Finished: %s in %.1fs" % (job.status,
+            job.duration()))
+    def worker(self):
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.finish_job(job)
+    def run(self):
+        """Install on every node, return True if all succeeded."""
+        for job in self.jobs:
+            self.queue.put(job)
+        threads = [threading.Thread(target=self.worker)
+                for x in range(self.workers)]
+        for t in threads:
+            t.daemon = True # ^C should not wait for ssh sessions
+            t.start()
+        for t in threads:
+            # join() with a timeout so ^C is delivered to the main thread
+            while t.is_alive():
+                t.join(1)
+        return all(job.returncode == 0 for job in self.jobs)
+    def summary(self):
+        """Return a pass/fail table for all nodes."""
+        lines = ["%-30s %-8s %8s" % ('Host', 'Result', 'Time')]
+        for job in self.jobs:
+            lines.append("%-30s %-8s %7.1fs" % (job.host, job.status,
+                job.duration()))
+            if job.returncode:
+                for line in job.output:
+                    lines.append("    %s" % line)
+        done = len([job for job in self.jobs if job.returncode == 0])
+        lines.append("%d of %d nodes %s successfully." %
+                (done, len(self.jobs), self.verb()))
+        return '\n'.join(lines)
+    def verb(self):
+        return self.stage and 'staged' or 'installed'
+
+class RollingDeployer(Deployer):
+    """Reconfigures nodes of a running cluster one at a time with
+    `--rolling`, which only stops ClustrixDB on a node for its restart.
+
+    Before and after each node, the cluster must have every node in
+    quorum, as seen from one of the other nodes; if it doesn't within
+    the timeout, the roll stops and the remaining nodes are left alone."""
+    def __init__(self, jobs, source_dir, remote_dir, args, connect,
+            quiet=False, timeout=ROLL_TIMEOUT):
+        Deployer.__init__(self, jobs, source_dir, remote_dir, args, 1,
+                quiet)
+        self.connect = connect # host: ClusterConnection
+        self.timeout = timeout
+        self.connections = {}
+        self.expected = None # Node count of the whole cluster
+    def command(self, job):
+        return remote_command(job.transport.path(self.remote_dir),
+                ['--rolling'] + job.node_args(self.args) + ['--yes'])
+    def verb(self):
+        return 'reconfigured'
+    def membership(self, skip=None):
+        """Return membership as seen from the first node other than skip
+        which answers, or None if none do."""
+        for job in self.jobs:
+            if job is skip:
+                continue
+            host = job.backend_addr or job.host
+            if host not in self.connections:
+                self.connections[host] = self.connect(host)
+            members = self.connections[host].membership()
+            if members is not None:
+                return members
+        return None
+    def healthy(self, members):
+        """Check that every node is in quorum, and that none are missing
+        compared to the first time we looked."""
+        if not members:
+            return False
+        if self.expected is None:
+            self.expected = len(members)
+        return len(members) >= self.expected and \
+                all(status == 'quorum' for status in members.values())
+    def wait_healthy(self, job, skip=None):
+        """Poll membership until the cluster is whole, or time out."""
+        deadline = time.time() + self.timeout
+        delay = POLL_INITIAL
+        while True:
+            members = self.membership(skip)
+            if self.healthy(members):
+                return True
+            if time.time() >= deadline:
+                if members:
+                    down = ['%s (%s)' % x for x in sorted(members.items())
+                            if x[1] != 'quorum']
+                    self.log(job, "Cluster not whole after %d seconds, not "
+                            "in quorum: %s" % (self.timeout,
+                                ', '.join(down) or 'missing nodes'))
+                else:
+                    self.log(job, "Unable to query cluster membership.")
+                return False
+            # Exponential backoff with jitter:
+            time.sleep(min(random.uniform(delay / 2, delay),
+                max(0, deadline - time.time())))
+            delay = min(delay * 2, POLL_MAX)
+    def run(self):
+        """Reconfigure nodes in order, return True if all succeeded."""
+        for job in self.jobs:
+            self.log(job, "Checking cluster health")
+            if not self.wait_healthy(job, skip=job):
+                job.status = 'skipped'
+                job.output = ["Cluster was not healthy, stopped rolling"]
+                job.returncode = -1
+                break
+            self.finish_job(job)
+            if job.returncode:
+                break
+            self.log(job, "Waiting for the cluster to be whole again")
+            if not self.wait_healthy(job):
+                job.status = 'FAILED'
+                job.output = ["Node did not rejoin the cluster"]
+                job.returncode = -1
+                break
+        for job in self.jobs:
+            if job.status == 'pending':
+                job.status = 'skipped'
+        for conn in self.connections.values():
+            conn.close()
+        return all(job.returncode == 0 for job in self.jobs)
+
+def remote_command(remote_dir, args):
+    """Return a shell command running the installer in remote_dir with
+    args, each quoted for the remote shell."""
+    return "cd %s && %s" % (pipes.quote(remote_dir), ' '.join(
+        [pipes.quote(x) for x in ['./' + INSTALLER_NAME] + list(args)]))
+
+def print_config():
+    """Run --print-config with the installer next to us and return the
+    arguments for other nodes."""
+    p = subprocess.Popen((sys.executable, os.path.join(BIN_DIR,
+            INSTALLER_NAME), '--print-config'), stdout=subprocess.PIPE)
+    output = p.communicate()[0].strip()
+    if p.returncode:
+        return None
+    return output
+
+def make_bundle(source_dir):
+    """Return a temporary directory of symlinks to every file in
+    source_dir plus the installer, which is what each node gets.
+    The installer looks for its RPMs next to itself."""
+    bundle = tempfile.mkdtemp(prefix='clxnode-deploy-')
+    for name in os.listdir(source_dir):
+        os.symlink(os.path.join(os.path.abspath(source_dir), name),
+                os.path.join(bundle, name))
+    if INSTALLER_NAME not in os.listdir(source_dir):
+        os.symlink(os.path.join(BIN_DIR, INSTALLER_NAME),
+                os.path.join(bundle, INSTALLER_NAME))
+    return bundle
+
+def shared_addresses(jobs, args):
+    """Return a dict of back-end address: hosts for addresses which more
+    than one job would be installed with."""
+    hosts = {}
+    for job in jobs:
+        addr = job.backend_arg(args)
+        if addr:
+            hosts.setdefault(addr.split('/')[0], []).append(job.host)
+    return dict((addr, names) for addr, names in hosts.items()
+            if len(names) > 1)
+
+def read_hosts(hosts_file, hosts):
+    """Combine hosts from the command line and an optional file, which
+    may contain comments and blank lines."""
+    specs = list(hosts)
+    if hosts_file:
+        for line in open(hosts_file):
+            line = line.split('#', 1)[0].strip()
+            if line:
+                specs.extend(line.split())
+    return specs
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] "
+            "HOST[=BACKEND_IP] ...")
+    parser.add_option('--hosts-file', metavar='FILE', help="Read hosts "
+            "from FILE, one HOST[=BACKEND_IP] per line.")
+    parser.add_option('--workers', '-n', type='int', default=DEFAULT_WORKERS,
+            help="Number of nodes to install at once [Default: %default]")
+    parser.add_option('--source-dir', default=DEFAULT_SOURCE_DIR,
+            help="Directory containing the ClustrixDB RPMs, copied to "
+            "each node along with %s [Default: %%default]" % INSTALLER_NAME)
+    parser.add_option('--remote-dir', default=DEFAULT_REMOTE_DIR,
+            help="Directory to copy the installer to on each node "
+            "[Default: %default]")
+    parser.add_option('--args', dest='arg_string', help="Installer "
+            "arguments to use instead of the output of --print-config.")
+    parser.add_option('--user', default='root', help="ssh user "
+            "[Default: %default]")
+    parser.add_option('--local-root', metavar='DIR', help="Use the local "
+            "stand-in transport, installing each host into DIR/<host> on "
+            "this machine instead of over ssh.")
+    parser.add_option('--chroot', action='store_true', default=False,
+            help="With --local-root, run each install chroot'ed into its "
+            "host directory.")
+    parser.add_option('--stage', action='store_true', default=False,
+            help="Only copy the installer and RPMs and build the local yum "
+            "repo on each node, so the real install later is quick.")
+    parser.add_option('--rolling', action='store_true', default=False,
+            help="Reconfigure an installed cluster one node at a time, "
+            "keeping it up, instead of installing in parallel.")
+    parser.add_option('--roll-timeout', type='int', default=ROLL_TIMEOUT,
+            help="With --rolling, seconds to wait for every node to be "
+            "in quorum before and after each node [Default: %default]")
+    parser.add_option('--db-user', default='root', help="MySQL user for "
+            "--rolling membership checks [Default: %default]")
+    parser.add_option('--db-password', default='')
+    parser.add_option('--db-port', type='int', default=3306)
+    parser.add_option('--quiet', '-q', action='store_true', default=False,
+            help="Only print per-node start and finish lines.")
+    (options, args) = parser.parse_args()
+
+    specs = read_hosts(options.hosts_file, args)
+    if not specs:
+        parser.error("No hosts given.")
+    if options.stage and options.rolling:
+        parser.error("--stage and --rolling don't mix.")
+    if not os.path.isdir(options.source_dir):
+        parser.error("Source directory %s not found." % options.source_dir)
+    arg_string = options.arg_string
+    if options.stage:
+        arg_string = ''
+    elif arg_string is None:
+        arg_string = print_config()
+        if arg_string is None:
+            print "Error: %s --print-config failed." % INSTALLER_NAME
+            exit(1)
+    installer_args = shlex.split(arg_string)
+
+    jobs = []
+    for spec in specs:
+        host = spec.split('=', 1)[0]
+        if options.local_root:
+            transport = LocalTransport(host, options.local_root,
+                    options.chroot)
+        else:
+            transport = SSHTransport(host, options.user)
+        jobs.append(NodeJob(spec, transport))
+    if not options.stage:
+        # Two nodes with one back-end address would never both join
+        for addr, hosts in sorted(shared_addresses(jobs, installer_args).items()):
+            parser.error("Hosts %s would all get back-end address %s, give "
+                    "each one as HOST=BACKEND_IP." % (', '.join(hosts), addr))
+    if options.stage:
+        print "Staging RPMs on %d nodes" % len(specs)
+    elif options.rolling:
+        print "Reconfiguring %d nodes one at a time with options: %s" % (
+                len(specs), ' '.join(installer_args))
+    else:
+        print "Installing on %d nodes with options: %s" % (len(specs),
+                ' '.join(installer_args))
+    if options.rolling:
+        try:
+            import MySQLdb
+        except ImportError:
+            print "Error: Python MySQLdb not found, --rolling needs it"
+            exit(1)
+        def connect(host):
+            return ClusterConnection(MySQLdb, host=host, port=options.db_port,
+                    user=options.db_user, passwd=options.db_password,
+                    connect_timeout=10)
+    bundle = make_bundle(options.source_dir)
+    if options.rolling:
+        deployer = RollingDeployer(jobs, bundle, options.remote_dir,
+                installer_args, connect, options.quiet, options.roll_timeout)
+    else:
+        deployer = Deployer(jobs, bundle, options.remote_dir, installer_args,
+                options.workers, options.quiet, options.stage)
+    try:
+        ok = deployer.run()
+    finally:
+        shutil.rmtree(bundle)
+    print ''
+    print deployer.summary()
+    exit(not ok)
+
+
+if __name__ == "__main__":
+    main()
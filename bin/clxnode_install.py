@@ -27,8 +27,68 @@ import httplib
 import termios
 import stat
 import textwrap
+import threading
+import random
+import select
+import ctypes
+import ctypes.util
+import Queue
+import mmap
+import shutil
+import json
+import hashlib
+import tempfile
+import bisect
+import atexit
+import contextlib
 
 CONFIG_FILE_PATH = "/etc/clustrix/clxnode.conf"
+# Typed copy of the same settings, which clxnode.conf is generated from.
+#   Bump the version on incompatible changes; readers refuse newer ones:
+CONFIG_JSON_PATH = "/etc/clustrix/clxnode.json"
+CONFIG_JSON_VERSION = 1
+PROC_MOUNTS_PATH = '/proc/mounts'
+SYS_NODE_PATH = '/sys/devices/system/node'
+SYS_CPU_PATH = '/sys/devices/system/cpu'
+PROC_INTERRUPTS_PATH = '/proc/interrupts'
+PROC_MEMINFO_PATH = '/proc/meminfo'
+PROC_NET_PATH = '/proc/net'
+TCP_LISTEN = 0x0A # st column of /proc/net/tcp for listening sockets
+PORT_SUGGESTIONS = 3 # Free ports to suggest when one is taken
+PROC_BUDDYINFO_PATH = '/proc/buddyinfo'
+NR_HUGEPAGES_PATH = '/proc/sys/vm/nr_hugepages'
+COMPACT_MEMORY_PATH = '/proc/sys/vm/compact_memory'
+# rtnetlink, see rtnetlink(7) and linux/rtnetlink.h:
+NETLINK_ROUTE = 0
+RTM_GETLINK = 18
+RTM_GETADDR = 22
+RTM_GETROUTE = 26
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_F_SECONDARY = 0x01
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+RTN_UNICAST = 1
+RTF_REJECT = 0x200 # Route flags in /proc/net/ipv6_route
+RTF_LOCAL = 0x80000000
+NLMSGHDR = struct.Struct('=IHHII') # len, type, flags, seq, pid
+IFINFOMSG = struct.Struct('=BxHiII') # family, type, index, flags, change
+IFADDRMSG = struct.Struct('=BBBBI') # family, prefixlen, flags, scope, index
+RTMSG = struct.Struct('=BBBBBBBBI') # family, dst_len, src_len, tos, table,
+                                    #   protocol, scope, type, flags
+RTATTR = struct.Struct('=HH') # len, type
+# A CPU taking more than this share of device interrupts is considered
+#   busy with interrupts, and not recommended for clxnode:
+IRQ_CPU_SHARE = 0.01
 MIN_FREE_SPACE = 20 # GiB
 VALID_FILESYSTEMS = ('ext4', 'xfs') # Could also just be single string
 MINIMUM_OS_RAM = 1024 # MiB, left for the OS
@@ -42,13 +102,43 @@ RPM_GLOBS = ('clustrix-common-*.x86_64.rpm',
         'clustrix-clxnode-*.x86_64.rpm',
         'clustrix-utils-*.x86_64.rpm',
         )
+RPM_SEARCH_DIRS = ('.', 'rpms') # Where to look for RPM_GLOBS and their deps
+# Local yum repo built from the bundled RPMs, so installing them needs no
+#   mirror metadata refresh:
+LOCAL_REPO_PATH = '/var/cache/clustrix-install'
+LOCAL_REPO_ID = 'clustrix-local'
+# Hashes of what each install stage was given and wrote, for reruns:
+STATE_MANIFEST_PATH = '/var/lib/clustrix-install/state.json'
+STATE_MANIFEST_VERSION = 1
 ALWAYS_WRITE = ('BACKEND_ADDR',
         'UI_LOGDIR',
         )
 DB_INIT_TIMEOUT = 120 # Seconds to wait for clxnode to initialize
 UI_INIT_TIMEOUT = 120 # Seconds to wait for WebUI to initialize
 HTTP_STATUS_PATH = '/bootup/status' # From the WebUI
+BACKOFF_INITIAL = 0.1 # Seconds, first delay between readiness probes
+BACKOFF_MAX = 2.0 # Seconds, longest delay between readiness probes
+NTP_MAX_OFFSET_MS = 100.0 # Clock offset beyond this fails the install
+NTP_MAX_JITTER_MS = 50.0 # As does jitter beyond this
+NTP_START_TIMEOUT = 15 # Seconds to wait for a time daemon we started
+PREFLIGHT_WORKERS = 8 # Threads used to probe options before check()
+# Storage benchmark (--benchmark-storage) sizes and durations:
+STORAGE_BENCH_FILE = '.clx_storage_benchmark' # Removed when done
+STORAGE_BENCH_SIZE = 256 # MiB written sequentially, then randomly accessed
+STORAGE_BENCH_FSYNCS = 200 # Number of 4K write + fsync() round trips
+STORAGE_BENCH_SECONDS = 3 # Duration of each random IO test
+STORAGE_BENCH_QUEUE_DEPTH = 16 # IOs kept in flight for random IO tests
+# Minimum acceptable results, anything worse gets a warning.
+#   fsync latency is a maximum, everything else is a minimum:
+STORAGE_BENCH_THRESHOLDS = {'seq_write_mibps': 100,
+        'fsync_p99_ms': 20,
+        'rand_read_iops': 2000,
+        'rand_write_iops': 1000,
+        }
+# $VARIABLE references inside path options:
+PATH_VARIABLE_RE = re.compile(r"\$([a-zA-Z_]+[a-zA-Z0-9_]*)")
 CLXNODE_PATH = '/opt/clustrix/bin/clxnode'
+CLUSTRIX_ROOT = '/opt/clustrix' # Processes running from here are ClustrixDB
 
 SSHD_CONFIG_PATH = '/etc/ssh/sshd_config'
 SSHD_CONFIG_ATTRS = {'HostbasedAuthentication': 'yes',
@@ -63,12 +153,56 @@ ROOT_SHOSTS_PATH = os.path.expanduser('~root/.shosts')
 ETC_HOSTS_EQUIV_PATH = '/etc/hosts.equiv'
 
 SYSCTL_CONFIG_PATH = '/etc/sysctl.conf'
+PROC_SYS_PATH = '/proc/sys'
+# Sysctl tuning profiles, see sysctl_profiles() for which ones apply.
+#   Values are (value, rule): 'min' values will not lower the system's
+#   current setting on write, 'max' values will not raise it, and 'exact'
+#   values always replace it. Multi-field values compare field by field.
 # The value for sysctl fs.aio-max-nr is the first large value that
 #   made clxnode run; it may not be optimal
-# All specified sysctl values greater than 1 are minimums;
-#   they will not lower the system's current setting on write.
-SYSCTL_CONFIG_ATTRS = {'fs.aio-max-nr': '262144',
+SYSCTL_PROFILES = {
+        'base': {'fs.aio-max-nr': ('262144', 'min'),
+            'net.core.somaxconn': ('4096', 'min'),
+            'net.ipv4.tcp_max_syn_backlog': ('4096', 'min'),
+            'vm.swappiness': ('1', 'max'),
+            },
+        # Back-end traffic on dedicated hardware, typically 10GbE or better:
+        'bare-metal': {'net.core.rmem_max': ('16777216', 'min'),
+            'net.core.wmem_max': ('16777216', 'min'),
+            'net.ipv4.tcp_rmem': ('4096 87380 16777216', 'min'),
+            'net.ipv4.tcp_wmem': ('4096 65536 16777216', 'min'),
+            'net.core.netdev_max_backlog': ('30000', 'min'),
+            },
+        'virtual': {'net.core.rmem_max': ('4194304', 'min'),
+            'net.core.wmem_max': ('4194304', 'min'),
+            'net.ipv4.tcp_rmem': ('4096 87380 4194304', 'min'),
+            'net.ipv4.tcp_wmem': ('4096 65536 4194304', 'min'),
+            'net.core.netdev_max_backlog': ('5000', 'min'),
+            },
+        # Dirty ratios are a share of RAM, keep writeback bursts small
+        #   on machines with a lot of it:
+        'large-memory': {'vm.dirty_background_ratio': ('5', 'max'),
+            'vm.dirty_ratio': ('10', 'max'),
+            },
+        'small-memory': {'vm.dirty_background_ratio': ('10', 'max'),
+            'vm.dirty_ratio': ('20', 'max'),
+            },
+        # clxnode places its own memory, don't let the kernel migrate it:
+        'numa': {'kernel.numa_balancing': ('0', 'exact'),
+            },
+        # Roles, see --sysctl-role. Front-end nodes take client connections
+        #   directly, so they see many short-lived sockets:
+        'frontend': {'net.core.somaxconn': ('16384', 'min'),
+            'net.ipv4.tcp_max_syn_backlog': ('16384', 'min'),
+            'net.ipv4.tcp_tw_reuse': ('1', 'exact'),
+            'net.ipv4.tcp_fin_timeout': ('30', 'max'),
+            },
+        # Only other nodes or a proxy connect, base is enough:
+        'backend': {},
         }
+SYSCTL_ROLES = ('frontend', 'backend')
+DEFAULT_SYSCTL_ROLE = 'frontend'
+LARGE_MEMORY_MIB = 64 * 1024 # Machines with this much RAM get large-memory
 if sys.stdout.isatty():
     INITIAL_TTY_STATE = termios.tcgetattr(1) # To reset terminal on quit
 else:
@@ -83,7 +217,8 @@ def quit(signal, frame):
         # This is not a TTY, nothing to reset
         exit(0)
     termios.tcsetattr(1, termios.TCSANOW, INITIAL_TTY_STATE)
-    if ConfigOption.runmode.reconfigure:
+    if ConfigOption.runmode.reconfigure and not ConfigOption.runmode.rolling:
+        # We stopped the service, put it back:
         socket_path = ConfigOption.get_var('UNIX_SOCKET_PATH').value
         http_port = ConfigOption.get_var('HTTP_PORT').value
         private_ip = ConfigOption.get_var('BACKEND_ADDR').value
@@ -171,13 +306,106 @@ def display_license():
     print "-"*80
     print "\n"
 
-def yum_install(rpm):
-    """Invoke yum to install specified RPM."""
-    yum = subprocess.Popen(('yum', 'install', '-y', '--nogpgcheck',
-        os.path.realpath(rpm)))
+def find_rpm(rpmglob):
+    """Return the first RPM matching rpmglob in RPM_SEARCH_DIRS, or None."""
+    for rpm_dir in RPM_SEARCH_DIRS:
+        matches = sorted(glob.glob(os.path.join(rpm_dir, rpmglob)))
+        if matches:
+            return matches[0]
+    return None
+
+def find_rpms():
+    """Return one RPM per RPM_GLOBS entry, or None if any are missing."""
+    rpms = [find_rpm(rpmglob) for rpmglob in RPM_GLOBS]
+    if not all(rpms):
+        return None
+    return rpms
+
+class LocalRepo(object):
+    """A yum repo of every RPM in RPM_SEARCH_DIRS, under LOCAL_REPO_PATH.
+
+    createrepo only runs when the set of RPMs changes, and the repo is used
+    on its own (through reposdir) so that yum does not refresh metadata
+    from the system's mirrors."""
+    def __init__(self, path=LOCAL_REPO_PATH):
+        self.path = path
+        self.rpm_path = os.path.join(path, 'rpms')
+        self.reposdir = os.path.join(path, 'yum.repos.d')
+        self.manifest_path = os.path.join(path, 'manifest')
+        self.rpms = {} # File name: source path
+        for rpm_dir in reversed(RPM_SEARCH_DIRS):
+            for rpm in glob.glob(os.path.join(rpm_dir, '*.rpm')):
+                self.rpms[os.path.basename(rpm)] = rpm
+    def manifest(self):
+        """Describe the RPMs by name, size and mtime."""
+        lines = []
+        for name, rpm in sorted(self.rpms.items()):
+            rpm_stat = os.stat(rpm)
+            lines.append("%s %d %d" % (name, rpm_stat.st_size,
+                rpm_stat.st_mtime))
+        return '\n'.join(lines) + '\n'
+    def is_current(self):
+        current = read_sys(self.manifest_path)
+        return current is not None and current + '\n' == self.manifest()
+    def build(self):
+        """Bring the repo up to date, return True if it is usable."""
+        if self.is_current():
+            return True
+        for repo_dir in (self.rpm_path, self.reposdir):
+            if not os.path.isdir(repo_dir):
+                os.makedirs(repo_dir)
+        for name in os.listdir(self.rpm_path):
+            if name.endswith('.rpm') and name not in self.rpms:
+                os.unlink(os.path.join(self.rpm_path, name))
+        for name, rpm in self.rpms.items():
+            dest = os.path.join(self.rpm_path, name)
+            if os.path.exists(dest):
+                os.unlink(dest)
+            try:
+                os.link(rpm, dest)
+            except OSError:
+                # Different filesystem
+                shutil.copy2(rpm, dest)
+        cmd = ['createrepo', '-q']
+        if os.path.isdir(os.path.join(self.rpm_path, 'repodata')):
+            cmd.append('--update')
+        try:
+            rc = subprocess.call(cmd + [self.rpm_path])
+        except OSError:
+            print "Note: createrepo not found, not using a local yum repo."
+            return False
+        if rc:
+            return False
+        with open(os.path.join(self.reposdir, '%s.repo' % LOCAL_REPO_ID),
+                'w') as repo_file:
+            repo_file.write("[%s]\nname=ClustrixDB installer RPMs\n"
+                    "baseurl=file://%s\ngpgcheck=0\nmetadata_expire=never\n"
+                    % (LOCAL_REPO_ID, self.rpm_path))
+        with open(self.manifest_path, 'w') as manifest:
+            manifest.write(self.manifest())
+        return True
+
+def yum_install(rpms, repo=None):
+    """Invoke yum to install all of rpms in a single transaction, with
+    only the LocalRepo repo if one is given."""
+    cmd = ['yum', 'install', '-y', '--nogpgcheck']
+    if repo:
+        cmd.append('--setopt=reposdir=%s' % repo.reposdir)
+    yum = subprocess.Popen(cmd + [os.path.realpath(rpm) for rpm in rpms])
     yum.communicate()
     return yum.returncode
 
+def install_rpms(rpms):
+    """Install rpms, from the local repo when possible. If that can't
+    resolve every dependency, fall back to the system's repos."""
+    repo = LocalRepo()
+    if repo.build():
+        if not yum_install(rpms, repo):
+            return 0
+        print ("Unable to install from the local repo alone, retrying with "
+                "the system repos.")
+    return yum_install(rpms)
+
 def get_output(cmd):
     """Get stdout and stderr from a command"""
     p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
@@ -186,18 +414,566 @@ def get_output(cmd):
     return stdout
 
 def have_command(cmd_name):
-    """Use which to determine if a command is available on this system."""
-    return get_output('which %s' % cmd_name)
+    """Search PATH to determine if a command is available on this system."""
+    # `which` prints its "no cmd in ..." complaint on stderr, which
+    #   get_output() would hand back as a true value, so look ourselves:
+    for path_dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        if os.access(os.path.join(path_dir, cmd_name), os.X_OK):
+            return True
+    return False
 
 def ntp_warn(warning):
     """Print a specific warning message followed by a generic one."""
-    ntp_warning_msg = ("Please ensure that ntpd is installed and configured "
-            "properly to connect to one or more time servers, in order to "
-            "keep node clocks in sync through your cluster.")
+    ntp_warning_msg = ("Please ensure that ntpd or chronyd is installed and "
+            "configured properly to connect to one or more time servers, in "
+            "order to keep node clocks in sync through your cluster.")
     print " !! " * 20
     print "WARNING: %s %s" % (warning, ntp_warning_msg)
     print " !! " * 20
 
+def percentile(values, pct):
+    """Return the pct'th percentile (nearest rank) of a list of numbers."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def get_libc():
+    """Return a ctypes handle for the C library, or None."""
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                use_errno=True)
+    except OSError:
+        return None
+
+IN_MOVED_TO = 0x00000080 # From <sys/inotify.h>
+IN_CREATE = 0x00000100
+
+def inotify_watch(directory):
+    """Return an inotify file descriptor watching directory for new entries,
+    or None if inotify is not available on this system."""
+    libc = get_libc()
+    if not libc or not hasattr(libc, 'inotify_init'):
+        # No libc or a libc without inotify support
+        return None
+    fd = libc.inotify_init()
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory, IN_CREATE | IN_MOVED_TO) < 0:
+        # Most likely the directory does not exist (yet)
+        os.close(fd)
+        return None
+    return fd
+
+SELINUX_XATTR = 'security.selinux'
+# isodate() stamps, which alone don't make a config file different:
+TIMESTAMP_RE = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?')
+
+def get_xattr(path, name):
+    """Return extended attribute name of path, or None if it has none or
+    xattrs are not supported."""
+    libc = get_libc()
+    if not libc or not hasattr(libc, 'getxattr'):
+        return None
+    buf = ctypes.create_string_buffer(4096)
+    size = libc.getxattr(path, name, buf, len(buf))
+    if size < 0:
+        return None
+    return buf.raw[:size]
+
+def set_xattr(path, name, value):
+    """Set extended attribute name on path, return True on success."""
+    libc = get_libc()
+    if not libc or not hasattr(libc, 'setxattr'):
+        return False
+    return libc.setxattr(path, name, value, len(value), 0) == 0
+
+def fsync_dir(dirname):
+    """fsync() a directory, so that renames in it survive a crash."""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(path, content, backup=False, mode=0644):
+    """Replace path with content so that a crash at any point leaves
+    either the old or the new file, never a partial one: write a temp file
+    in the same directory, fsync it, rename it over path and fsync the
+    directory. The old file's mode, owner and SELinux context are kept,
+    and with backup the old file is also linked to path.bak.
+
+    Does nothing if path already has this content, apart from isodate()
+    stamps. Returns True if the file was written."""
+    dirname = os.path.dirname(os.path.abspath(path))
+    try:
+        current = open(path).read()
+    except IOError:
+        current = None
+    if current is not None and \
+            TIMESTAMP_RE.sub('', current) == TIMESTAMP_RE.sub('', content):
+        return False
+    fd, temp_path = tempfile.mkstemp(dir=dirname,
+            prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if current is None:
+            os.chmod(temp_path, mode)
+        else:
+            conf_stat = os.stat(path)
+            os.chmod(temp_path, stat.S_IMODE(conf_stat.st_mode))
+            os.chown(temp_path, conf_stat.st_uid, conf_stat.st_gid)
+            context = get_xattr(path, SELINUX_XATTR)
+            if context:
+                set_xattr(temp_path, SELINUX_XATTR, context)
+            if backup:
+                # Link, then rename over any old backup, so path itself
+                #   is never missing
+                backup_temp = temp_path + '.bak'
+                os.link(path, backup_temp)
+                os.rename(backup_temp, '%s.bak' % path)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    fsync_dir(dirname)
+    return True
+
+class StateManifest(object):
+    """Remembers, per install stage, a hash of the stage's inputs and of
+    each file it wrote, so that a rerun can tell that a stage has nothing
+    to do without redoing it.
+
+    Hashes of files ignore isodate() stamps, as atomic_write() does."""
+    def __init__(self, path=STATE_MANIFEST_PATH):
+        self.path = path
+        self.stages = {} # stage: {'inputs': hash, 'outputs': {path: hash}}
+        try:
+            state = json.load(open(path))
+            if state.get('version') == STATE_MANIFEST_VERSION:
+                self.stages = state['stages']
+        except (IOError, ValueError, KeyError, AttributeError):
+            # Missing, or not ours to understand: everything is stale
+            pass
+    @staticmethod
+    def digest(value):
+        """Hash any JSON-able value."""
+        return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+    @staticmethod
+    def file_digest(path):
+        """Hash a file's content, or None if it doesn't exist. A symlink
+        is hashed by where it points: we only make the link, the file it
+        points to is not ours to watch."""
+        if os.path.islink(path):
+            return hashlib.sha1('link to %s' % os.readlink(path)).hexdigest()
+        try:
+            content = open(path).read()
+        except IOError:
+            return None
+        return hashlib.sha1(TIMESTAMP_RE.sub('', content)).hexdigest()
+    def is_current(self, stage, inputs, outputs=()):
+        """Check if stage last ran with these inputs, and the files it
+        wrote are unchanged since."""
+        state = self.stages.get(stage)
+        if not state or state['inputs'] != self.digest(inputs):
+            return False
+        return sorted(state['outputs']) == sorted(outputs) and \
+                all(self.file_digest(path) == state['outputs'][path]
+                    for path in outputs)
+    def record(self, stage, inputs, outputs=()):
+        """Remember that stage ran with inputs and left outputs as they
+        are now."""
+        self.stages[stage] = {'inputs': self.digest(inputs),
+                'outputs': dict((path, self.file_digest(path))
+                    for path in outputs)}
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        atomic_write(self.path, json.dumps({'version': STATE_MANIFEST_VERSION,
+            'stages': self.stages}, sort_keys=True, indent=1) + '\n')
+
+class Backoff(object):
+    """Generate exponentially increasing delays with random jitter,
+    so that polling loops start fast but don't hammer a slow service."""
+    def __init__(self, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX,
+            factor=2):
+        self.delay = initial
+        self.maximum = maximum
+        self.factor = factor
+    def next(self):
+        """Return the next delay, in seconds."""
+        delay = random.uniform(self.delay / 2, self.delay)
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return delay
+
+def wait_for_path(path, deadline, cancelled=None):
+    """Block until path exists, deadline (from time.time()) passes,
+    or the optional cancelled Event is set. Returns True if path exists.
+
+    Sleeps on inotify events for the parent directory when possible,
+    otherwise falls back to polling with Backoff."""
+    fd = inotify_watch(os.path.dirname(path))
+    backoff = Backoff()
+    try:
+        # Check after the watch is in place, so we can't miss a create:
+        while not os.path.exists(path):
+            remaining = deadline - time.time()
+            if remaining <= 0 or (cancelled and cancelled.is_set()):
+                return False
+            if fd is None:
+                time.sleep(min(backoff.next(), remaining))
+                continue
+            # Wake at least once a second to notice cancellation:
+            readable = select.select([fd], [], [], min(remaining, 1))[0]
+            if readable:
+                os.read(fd, 4096) # Drain events, we only re-check the path
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+class PhaseTimer(object):
+    """Records wall and CPU time spent in each install phase, and shorter
+    spans inside them, for a summary and a Chrome trace file (load it in
+    chrome://tracing or Perfetto). Use PhaseTimer.shared()."""
+    instance = None
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.current = None # (name, start, start cpu) of the open phase
+        self.thread_ids = {} # Thread name: small int, for the trace
+    @classmethod
+    def shared(cls):
+        if not cls.instance:
+            cls.instance = cls()
+        return cls.instance
+    @staticmethod
+    def cpu():
+        """CPU seconds used by this process so far, user and system."""
+        times = os.times()
+        return times[0] + times[1]
+    def phase(self, name):
+        """End the current phase, and start a new one called name."""
+        self.end_phase()
+        self.current = (name, time.time(), self.cpu())
+    def end_phase(self):
+        if self.current:
+            name, start, start_cpu = self.current
+            self.current = None
+            self.record(name, 'phase', start, time.time(),
+                    self.cpu() - start_cpu)
+    @contextlib.contextmanager
+    def span(self, name, category):
+        """Time the body of a with statement as a span within a phase."""
+        start, start_cpu = time.time(), self.cpu()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.time(),
+                    self.cpu() - start_cpu)
+    def record(self, name, category, start, end, cpu=None, args=None):
+        """Add a finished span. Safe to call from any thread."""
+        thread = threading.current_thread().name
+        with self.lock:
+            tid = self.thread_ids.setdefault(thread, len(self.thread_ids))
+            self.events.append({'name': name, 'cat': category,
+                'start': start, 'end': end, 'cpu': cpu, 'tid': tid,
+                'args': args or {}})
+    def trace(self):
+        """Return the events in Chrome trace event format."""
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+            'args': {'name': thread}} for thread, tid in
+            self.thread_ids.items()]
+        for event in self.events:
+            args = dict(event['args'])
+            if event['cpu'] is not None:
+                args['cpu_ms'] = round(event['cpu'] * 1000, 3)
+            events.append({'name': event['name'], 'cat': event['cat'],
+                'ph': 'X', 'pid': pid, 'tid': event['tid'],
+                'ts': int(event['start'] * 1000000),
+                'dur': int((event['end'] - event['start']) * 1000000),
+                'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'host': socket.gethostname(),
+                    'argv': ' '.join(sys.argv)}}
+    def summary(self):
+        """Return wall and CPU time per phase as lines of text."""
+        lines = ["%-24s %9s %9s" % ('Phase', 'Wall', 'CPU')]
+        for event in self.events:
+            if event['cat'] == 'phase':
+                lines.append("%-24s %8.2fs %8.2fs" % (event['name'],
+                    event['end'] - event['start'], event['cpu']))
+        return lines
+    def write_trace(self, path):
+        """Close the open phase, then write the trace to path."""
+        self.end_phase()
+        try:
+            with open(path, 'w') as trace_file:
+                json.dump(self.trace(), trace_file)
+        except IOError, e:
+            print "Warning: Unable to write trace file %s: %s" % (path, e)
+            return
+        print '\n'.join(self.summary())
+        print "Install trace written to %s" % path
+
+class ReadinessProbe(threading.Thread):
+    """Run a probe function in the background until it returns True or
+    the deadline passes, recording when each phase completed.
+
+    Exceptions listed in "errors" count as a failed attempt; anything else
+    is a bug and is left to propagate."""
+    def __init__(self, name, probe, deadline, errors=(), wait_for=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True # Don't hold up exit on timeout
+        self.probe = probe
+        self.deadline = deadline
+        self.errors = errors
+        self.wait_for = wait_for # Optional path which must appear first
+        self.cancelled = threading.Event()
+        self.started_at = None
+        self.path_at = None
+        self.ready_at = None
+        self.attempts = 0
+    def run(self):
+        self.started_at = time.time()
+        if self.wait_for:
+            if not wait_for_path(self.wait_for, self.deadline, self.cancelled):
+                return
+            self.path_at = time.time()
+            PhaseTimer.shared().record('wait for %s' % self.wait_for, 'probe',
+                    self.started_at, self.path_at)
+        backoff = Backoff()
+        timer = PhaseTimer.shared()
+        while not self.cancelled.is_set():
+            self.attempts += 1
+            attempt_start = time.time()
+            try:
+                if self.probe():
+                    self.ready_at = time.time()
+                    timer.record('%s probe' % self.name, 'probe',
+                            attempt_start, self.ready_at,
+                            args={'attempt': self.attempts, 'ready': True})
+                    return
+            except self.errors:
+                # Not up yet, try again after a delay
+                pass
+            timer.record('%s probe' % self.name, 'probe', attempt_start,
+                    time.time(), args={'attempt': self.attempts,
+                        'ready': False})
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                return
+            self.cancelled.wait(min(backoff.next(), remaining))
+    def cancel(self):
+        self.cancelled.set()
+    def wait(self):
+        """Wait for the probe to finish, printing a dot each second so the
+        user knows we haven't disappeared. Returns True if ready."""
+        while self.is_alive():
+            self.join(1)
+            if self.is_alive():
+                sys.stdout.write('.')
+                sys.stdout.flush() # Make sure the dot shows up
+        print '' # Print \n to terminate the dots
+        return bool(self.ready_at)
+    def elapsed(self, t0, at):
+        """Human-readable seconds from t0 to one of our timestamps."""
+        if at is None:
+            return 'n/a'
+        return '%.1fs' % (at - t0)
+
+def parse_ntpq(output):
+    """Parse `ntpq -pn` output into (synced, source, offset ms, jitter ms).
+    Returns None if ntpd could not be reached."""
+    # Ex:
+    #       remote           refid      st t when poll reach   delay   offset  jitter
+    #   ==============================================================================
+    #    127.127.1.0     .LOCL.          10 l   6h   64    0    0.000    0.000   0.000
+    #   *203.0.113.5     38.229.71.1      3 u  834 1024  377    2.048   -0.121  11.800
+    # Example with no servers configured:
+    #   No association ID's returned
+    # Column info: http://www.eecis.udel.edu/~mills/ntp/html/ntpq.html - peers section
+    if 'refused' in output:
+        return None
+    best = None
+    for line in output.split('\n')[2:]: # Ignore first two lines
+        fields = line[1:].split()
+        if len(fields) != 10:
+            continue
+        tally = line[0]
+        remote, refid, t, reach = fields[0], fields[1], fields[3], fields[6]
+        if t == 'l' or refid == '.LOCL.' or reach == '0':
+            # The local clock does not provide sync, and an unreached
+            #   peer has no offset yet
+            continue
+        if tally in ('x', '.', '-'):
+            # The leading character indicates peer status, as per
+            #   the 'T' column of the 'Select Field' table here:
+            # http://www.eecis.udel.edu/~mills/ntp/html/decode.html#peer
+            # A leading space is not selected yet, but that's what
+            # all servers start with before ntpd has had time to
+            # get sync'd up, so we'll keep it as a candidate.
+            continue
+        try:
+            offset, jitter = float(fields[8]), float(fields[9])
+        except ValueError:
+            continue
+        synced = tally in ('*', 'o')
+        if not best or (synced and not best[0]):
+            best = (synced, remote, offset, jitter)
+    return best or (False, None, None, None)
+
+def parse_chronyc(output):
+    """Parse `chronyc -n tracking` output into (synced, source, offset ms,
+    jitter ms). Returns None if chronyd could not be reached."""
+    # Ex:
+    #   Reference ID    : CB00710A (203.0.113.10)
+    #   Stratum         : 3
+    #   System time     : 0.000123456 seconds slow of NTP time
+    #   Last offset     : -0.000012345 seconds
+    #   RMS offset      : 0.000045678 seconds
+    #   Leap status     : Normal
+    fields = {}
+    for line in output.split('\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            fields[key.strip()] = value.strip()
+    if 'Leap status' not in fields:
+        # 506 Cannot talk to daemon
+        return None
+    try:
+        offset = float(fields['System time'].split()[0]) * 1000
+        if 'slow' in fields['System time']:
+            offset = -offset
+        jitter = float(fields['RMS offset'].split()[0]) * 1000
+    except (KeyError, IndexError, ValueError):
+        return (False, None, None, None)
+    ref = fields.get('Reference ID', '').split()
+    source = ref and ref[-1].strip('()') or None
+    synced = fields['Leap status'] != 'Not synchronised' and ref and \
+            ref[0] not in ('00000000', '7F7F0101') # Unset, or local clock
+    return (bool(synced), source, offset, jitter)
+
+class TimeSyncCheck(threading.Thread):
+    """Checks ntpd or chronyd health in the background, so it can overlap
+    the RPM install. Starts the daemon if it isn't running, and records
+    the selected time source with its offset and jitter."""
+    # (daemon, query command, parser), in order of preference:
+    DAEMONS = (('ntpd', 'ntpq -pn', parse_ntpq),
+            ('chronyd', 'chronyc -n tracking', parse_chronyc),
+            )
+    def __init__(self, max_offset_ms=NTP_MAX_OFFSET_MS,
+            max_jitter_ms=NTP_MAX_JITTER_MS):
+        threading.Thread.__init__(self, name='timesync')
+        self.daemon = True # Don't hold up exit on a hung query
+        self.max_offset_ms = max_offset_ms
+        self.max_jitter_ms = max_jitter_ms
+        self.found = False # Whether any client command is installed
+        self.daemon_name = None # The daemon which answered
+        self.started_service = False
+        self.synced = False
+        self.source = None
+        self.offset_ms = None
+        self.jitter_ms = None
+        self.reported = None # report() result, once finish() has run
+    def query(self, daemon):
+        """Ask one daemon for its status, return True if it answered."""
+        name, cmd, parse = daemon
+        result = parse(get_output(cmd))
+        if result is None:
+            return False
+        self.daemon_name = name
+        self.synced, self.source, self.offset_ms, self.jitter_ms = result
+        return True
+    def run(self):
+        with PhaseTimer.shared().span('time sync query', 'ntp'):
+            self.check()
+    def check(self):
+        # -n skips reverse DNS on every peer, which is what made
+        #   `ntpq -p` take ~20 seconds
+        daemons = [x for x in self.DAEMONS if have_command(x[1].split()[0])]
+        self.found = bool(daemons)
+        for daemon in daemons:
+            if self.query(daemon):
+                return
+        if not daemons:
+            return
+        # Nothing is running, attempt to start our preferred daemon, then
+        #   poll until it answers instead of sleeping a fixed time:
+        daemon = daemons[0]
+        try:
+            subprocess.call(('service', daemon[0], 'start'),
+                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        except OSError:
+            return # No service command to start it with
+        self.started_service = daemon[0]
+        deadline = time.time() + NTP_START_TIMEOUT
+        backoff = Backoff(0.5)
+        while time.time() < deadline:
+            time.sleep(min(backoff.next(), max(0, deadline - time.time())))
+            if self.query(daemon):
+                return
+    def problems(self):
+        """Return a list of strings describing what's wrong with time
+        sync, if anything."""
+        if not self.found:
+            return ["ntp not found."]
+        if not self.daemon_name:
+            return ["Neither ntpd nor chronyd is running."]
+        if self.offset_ms is None:
+            return ["No valid NTP time source found."]
+        return self.limit_problems()
+    def limit_problems(self):
+        """Return the problems with offset and jitter beyond the limits."""
+        if self.offset_ms is None:
+            return []
+        problems = []
+        if abs(self.offset_ms) > self.max_offset_ms:
+            problems.append("Clock offset is %.1f ms, more than the %.1f ms "
+                    "limit." % (self.offset_ms, self.max_offset_ms))
+        if self.jitter_ms > self.max_jitter_ms:
+            problems.append("Clock jitter is %.1f ms, more than the %.1f ms "
+                    "limit." % (self.jitter_ms, self.max_jitter_ms))
+        return problems
+    def report(self):
+        """Print a note on time sync, or a warning for each problem."""
+        if self.started_service:
+            print "NOTE: %s was not running - started service." % \
+                    self.started_service
+        problems = self.problems()
+        for problem in problems:
+            ntp_warn(problem)
+        if problems:
+            return False
+        if self.synced:
+            print ("Note: %s is synchronized to %s, offset %.3f ms, jitter "
+                    "%.3f ms." % (self.daemon_name, self.source,
+                        self.offset_ms, self.jitter_ms))
+        else:
+            print ("Note: %s is running but not synchronized yet, best source "
+                    "%s has offset %.3f ms." % (self.daemon_name, self.source,
+                        self.offset_ms))
+        return True
+    def finish(self):
+        """Wait for the background check, then report() it, only the first
+        time. Returns True if the clock is within the limits; a missing
+        or unsynchronized daemon is only warned about."""
+        if self.reported is None:
+            self.join()
+            if not self.found:
+                # ntp comes in the ntp package, which may have just been
+                #   installed
+                self.check()
+            self.reported = self.report()
+        return not self.limit_problems()
+
 def initctl_clustrix(action, mysql_sock=None, http_port=None):
     """Run:
         initctl <action> clustrix
@@ -229,86 +1005,136 @@ def initctl_clustrix(action, mysql_sock=None, http_port=None):
     except ImportError:
         print "Error: Python MySQLdb not found"
         return False
-    db_ready = False
-    t0 = time.time()
-    while time.time() - t0 < DB_INIT_TIMEOUT:
+    def probe_db():
+        db = MySQLdb.connect(unix_socket=mysql_sock)
         try:
-            db = MySQLdb.connect(unix_socket=mysql_sock)
             c = db.cursor()
             c.execute('select 1')
-            if c.fetchone()[0] == 1:
-                db_ready = True
+            return c.fetchone()[0] == 1
+        finally:
             db.close()
-        except MySQLdb.OperationalError:
-            # Unable to connect, wait a bit and try again
-            time.sleep(1)
-            sys.stdout.write('.') # Print dot to ensure we haven't disappeared
-            sys.stdout.flush() # Make sure the dot shows up
-        if db_ready:
-            print '' # Print \n to terminate the dots
-            break
-    if not db_ready:
+    # One connection object, httplib reconnects after close():
+    ui_conn = httplib.HTTPConnection('localhost:%d' % int(http_port))
+    def probe_ui():
+        # We'll know it's done when we can fetch a legit status JSON blob
+        #   from localhost/bootup/status
+        try:
+            ui_conn.request('GET', HTTP_STATUS_PATH)
+            r = ui_conn.getresponse()
+            body = r.read() # Must read the body before reusing the connection
+        except (socket.error, httplib.HTTPException):
+            ui_conn.close()
+            raise
+        return r.status == 200 and 'clustrix' in body
+    # Probe both at once, the WebUI is polled while clxnode comes up so
+    #   that we notice it the moment it is ready:
+    t0 = time.time()
+    db_probe = ReadinessProbe('database', probe_db, t0 + DB_INIT_TIMEOUT,
+            errors=(MySQLdb.OperationalError,), wait_for=mysql_sock)
+    ui_probe = ReadinessProbe('webui', probe_ui,
+            t0 + DB_INIT_TIMEOUT + UI_INIT_TIMEOUT,
+            errors=(socket.error, httplib.HTTPException))
+    db_probe.start()
+    ui_probe.start()
+    if not db_probe.wait():
         # We exceeded the DB_INIT_TIMEOUT with no response from clxnode
-        print ("Error: Database did not come up within %d "
-                "seconds." % DB_INIT_TIMEOUT)
+        ui_probe.cancel()
+        if db_probe.wait_for and not db_probe.path_at:
+            print ("Error: MySQL socket %s did not appear within %d "
+                    "seconds." % (mysql_sock, DB_INIT_TIMEOUT))
+        else:
+            print ("Error: Database did not come up within %d "
+                    "seconds." % DB_INIT_TIMEOUT)
         return False
     # Database is up, so the WebUI should start migrating now
     print ("ClustrixDB initialized... Please wait for Clustrix "
         "Insight UI initialization (This will take another minute.)")
-    # We'll know it's done when we can fetch a legit status JSON blob
-    #   from localhost/bootup/status
-    t0 = time.time()
-    ui_ready = False
-    while time.time() - t0 < UI_INIT_TIMEOUT:
-        try:
-            h = httplib.HTTPConnection('localhost:%d' % http_port) # Never fails
-            h.request('GET', HTTP_STATUS_PATH) # Will raise socket.error
-            r = h.getresponse()
-            if not r.status == 200:
-                # HTTP error, wait any try again
-                time.sleep(1)
-                sys.stdout.write('.') # Print dot to ensure we haven't disappeared
-                sys.stdout.flush() # Make sure the dot shows up
-                continue
-            elif 'clustrix' in r.read():
-                # We probably have a legit return blob now
-                print '' # Print \n to terminate the dots
-                ui_ready = True
-                break
-        except socket.error:
-            # Could not contact HTTP server, wait and try again
-            time.sleep(1)
-            sys.stdout.write('.') # Print dot to ensure we haven't disappeared
-            sys.stdout.flush() # Make sure the dot shows up
-    if not ui_ready:
+    if not ui_probe.wait():
         # UI_INIT_TIMEOUT expired with no valid response from server
         print ("Error: Clustrix Insight UI did not come up within %d "
                 "seconds." % UI_INIT_TIMEOUT)
         return False
+    print ("Startup timing: socket %s, database %s, WebUI %s "
+            "(%d database and %d WebUI probes)" %
+            (db_probe.elapsed(t0, db_probe.path_at),
+                db_probe.elapsed(t0, db_probe.ready_at),
+                ui_probe.elapsed(t0, ui_probe.ready_at),
+                db_probe.attempts, ui_probe.attempts))
     # We made it, everything is now running as expected
     return True
 
+def clustrix_running():
+    """Check if the clustrix upstart job is running."""
+    try:
+        p = subprocess.Popen(('initctl', 'status', UPSTART_PROCESS),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        # No upstart, so nothing can be running under it
+        return False
+    status = p.communicate()[0]
+    return ('%s start/running' % UPSTART_PROCESS) in status
+
 
 class ConfigFile(object):
-    """Stores, Reads, and Writes clxnode.conf file"""
+    """Stores, Reads, and Writes clxnode.json and the clxnode.conf file
+    generated from it"""
     def __init__(self):
         self.path = CONFIG_FILE_PATH
+        self.json_path = CONFIG_JSON_PATH
         # Don't need these things if we're not reading the config file:
         self.current_config = {}
         # If we see unknown options in the config file, save them here
         #   so that we can write them back out later:
         self.extra_config = {}
-        if os.path.exists(self.path):
+        if os.path.exists(self.json_path):
+            self.load_from_json()
+        elif os.path.exists(self.path):
             self.load_from_file()
-    def load_from_file(self):
-        """Load an existing config file"""
+    def read_file(self):
+        """Return the variables set in clxnode.conf as a dict"""
+        settings = {}
         with open(self.path) as config_file:
             for line in config_file:
                 line = line.strip()
                 if '=' not in line: continue
                 if line[0] == "#": continue # Comment
                 k,v = [x.strip() for x in line.split('=',1)]
-                self.current_config[k] = v
+                settings[k] = v
+        return settings
+    def load_from_file(self):
+        """Load an existing config file"""
+        self.current_config.update(self.read_file())
+    def load_from_json(self):
+        """Load clxnode.json, falling back to clxnode.conf if it is
+        unreadable or from a newer installer, or if clxnode.conf no longer
+        matches it because someone edited it by hand. Options at their
+        defaults are left out, as they are commented out in clxnode.conf."""
+        try:
+            doc = json.load(open(self.json_path))
+            if doc['version'] > CONFIG_JSON_VERSION:
+                raise ValueError("version %s is newer than %d" %
+                        (doc['version'], CONFIG_JSON_VERSION))
+            defaults = set(doc.get('defaults', []))
+            options = doc['options']
+            extra = doc.get('extra', {})
+        except (IOError, ValueError, KeyError, TypeError), e:
+            print "Warning: Ignoring %s: %s" % (self.json_path, e)
+            if os.path.exists(self.path):
+                self.load_from_file()
+            return
+        settings = dict(extra)
+        for k, v in options.items():
+            if k not in defaults or k in ALWAYS_WRITE:
+                settings[k] = v
+        if os.path.exists(self.path):
+            # Compare as to_bash() would have written them:
+            written = dict((k, '%s' % v) for k, v in settings.items())
+            if self.read_file() != written:
+                print ("Warning: %s was changed after %s was written, using "
+                        "%s." % (self.path, self.json_path, self.path))
+                self.load_from_file()
+                return
+        self.current_config.update(settings)
     def add_extra(self, option):
         """Store an unrecognized config value in self.extra_config,
         where it will be safe until we run self.write()"""
@@ -316,36 +1142,85 @@ class ConfigFile(object):
             print "ConfigFile Error: %s not found in config file" % option
             return
         self.extra_config[option] = self.current_config[option]
+    def to_json(self, options, runmode):
+        """Return the typed, versioned form of options."""
+        return {'version': CONFIG_JSON_VERSION,
+                'generated': isodate(),
+                'force': bool(runmode.force),
+                'options': dict((opt.variable_name, opt.json_value())
+                    for opt in options),
+                'defaults': [opt.variable_name for opt in options
+                    if opt.is_default()],
+                # Expected to differ between nodes, for fleet diffs:
+                'per_node': [opt.variable_name for opt in options
+                    if opt.per_node],
+                'extra': self.extra_config}
+    def to_bash(self, doc, options):
+        """Generate clxnode.conf from the output of to_json(), commenting
+        any options which are set to the default value."""
+        lines = ['# ClustrixDB config file',
+                '# File must be valid Bash with comment, blank lines '
+                'and varible definitions only.',
+                '# Generated from %s, edits to this file take precedence '
+                'over it.' % self.json_path, '',
+                '# Config File Generated at: %s' % doc['generated']]
+        if doc['force']:
+            lines.append('# This file generated with --force')
+        for opt in options:
+            # Write out variables in the order they're defined below
+            commented = ""
+            if opt.variable_name in doc['defaults'] and \
+                    not opt.variable_name in ALWAYS_WRITE:
+                # Write a commented version of the variable
+                # Specifically always write out certain variables,
+                #  which this script determines better than the .sh
+                commented = "#"
+            lines.append('# %s:' % opt.long_description)
+            for comment in opt.config_comments():
+                lines.append('#   %s' % comment)
+            lines.append('%s%s=%s' % (commented, opt.variable_name,
+                doc['options'][opt.variable_name]))
+        if doc['extra']:
+            lines.append('# Extra Config Variables:')
+            for var in sorted(doc['extra'].iteritems()):
+                # var is a 2 item tuple now
+                lines.append('%s=%s' % var)
+        return '\n'.join(lines) + '\n'
     def write(self, options, runmode):
-        """Write a list of options to file, commenting any which are set to
-        the default value."""
+        """Write options to clxnode.json, then clxnode.conf from that.
+        Returns True if either file changed."""
         dirname = os.path.dirname(self.path)
         if not os.path.exists(dirname):
             # Directory which contains config does not exist, create it
             os.makedirs(dirname)
-        with open(self.path, 'w') as config_file:
-            config_file.write('# ClustrixDB config file\n')
-            config_file.write('# File must be valid Bash with comment, blank lines '
-                                'and varible definitions only.\n\n')
-            config_file.write('# Config File Generated at: %s\n' % isodate())
-            if runmode.force:
-                config_file.write('# This file generated with --force')
-            for opt in options:
-                # Write out variables in the order they're defined below
-                commented = ""
-                if opt.is_default() and not opt.variable_name in ALWAYS_WRITE:
-                    # Write a commented version of the variable
-                    # Specifically always write out certain variables,
-                    #  which this script determines better than the .sh
-                    commented = "#"
-                config_file.write('# %s:\n' % opt.long_description)
-                config_file.write('%s%s=%s\n' % (commented, opt.variable_name,
-                    opt.config_string()))
-            if self.extra_config:
-                config_file.write('# Extra Config Variables:\n')
-                for var in self.extra_options.iteritems():
-                    # var is a 2 item tuple now
-                    config_file.write('%s=%s\n' % var)
+        doc = self.to_json(options, runmode)
+        wrote_json = atomic_write(self.json_path, json.dumps(doc,
+            sort_keys=True, indent=1) + '\n')
+        wrote_bash = atomic_write(self.path, self.to_bash(doc, options))
+        return wrote_json or wrote_bash
+
+def config_schema(options):
+    """Return a JSON Schema for clxnode.json, from the options' types."""
+    properties = {}
+    for opt in options:
+        properties[opt.variable_name] = {'type': opt.json_type(),
+                'description': opt.long_description,
+                'default': opt.to_json_type(opt.default)}
+    names = {'type': 'array', 'items': {'enum': sorted(properties)}}
+    return {'$schema': 'http://json-schema.org/draft-04/schema#',
+            'title': 'ClustrixDB node configuration',
+            'type': 'object',
+            'required': ['version', 'options'],
+            'properties': {
+                'version': {'type': 'integer', 'maximum': CONFIG_JSON_VERSION},
+                'generated': {'type': 'string'},
+                'force': {'type': 'boolean'},
+                'options': {'type': 'object', 'properties': properties,
+                    'additionalProperties': False},
+                'defaults': names,
+                'per_node': names,
+                'extra': {'type': 'object',
+                    'additionalProperties': {'type': 'string'}}}}
 
 
 class RunMode(dict):
@@ -405,24 +1280,130 @@ class RunFlag(object):
         """When this flag is specified, set mode to the non-default value."""
         self.mode = not self.default
 
+class RunValue(RunFlag):
+    """Run mode option which takes a value, such as a file path.
+    Its mode is the value, or None when not given."""
+    def __init__(self, option_name, help_str, metavar=None):
+        RunFlag.__init__(self, option_name, None, help_str)
+        self.metavar = metavar
+    def mkoptparse(self, parser):
+        parser.add_option('--'+self.option_name, dest=self.variable_name,
+                type='string', metavar=self.metavar, action='callback',
+                callback=self.optcallback, help=self.help_str)
+    def optcallback(self, option, opt_text, value, parser):
+        self.mode = value
+
 class WizardFlag(RunFlag):
     def optcallback(self, option, opt_text, value, parser):
         """Wizard option forces wizard mode, it does not disable it."""
         self.mode = True
 
 
+class OptionRegistry(list):
+    """Every ConfigOption in creation order, indexed by variable name and
+    option name, along with the dependency graph between them (see
+    ConfigOption.dependencies())."""
+    def __init__(self):
+        list.__init__(self)
+        self.by_variable = {}
+        self.by_option = {}
+        # variable_names whose value changed since they last passed check():
+        self.dirty = set()
+    def append(self, opt):
+        list.append(self, opt)
+        self.by_variable[opt.variable_name] = opt
+        if opt.option_name:
+            self.by_option[opt.option_name] = opt
+    def get(self, variable):
+        """Return the option with this variable_name, or None."""
+        return self.by_variable.get(variable)
+    def get_option(self, option_name):
+        """Return the option for --option_name, or None."""
+        return self.by_option.get(option_name)
+    def dependencies(self, opt):
+        """Return variable_names opt depends on, ignoring unknown ones."""
+        return [x for x in opt.dependencies() if x in self.by_variable and
+                x != opt.variable_name]
+    def graph(self):
+        """Return a dict of variable_name: set of variable_names of the
+        options it depends on."""
+        return dict([(opt.variable_name, set(self.dependencies(opt)))
+            for opt in self])
+    def dependents(self, variable):
+        """Return every option which depends on variable, directly or not,
+        in topological order."""
+        graph = self.graph()
+        found = set()
+        todo = [variable]
+        while todo:
+            name = todo.pop()
+            for other, deps in graph.items():
+                if name in deps and other not in found:
+                    found.add(other)
+                    todo.append(other)
+        found.discard(variable)
+        return [opt for opt in self.topological_order()
+                if opt.variable_name in found]
+    def mark_dirty(self, opt):
+        self.dirty.add(opt.variable_name)
+    def mark_checked(self, opt):
+        """Record that opt passed check() with its current value. Options
+        depending on it were checked against its old value, so they become
+        dirty instead."""
+        self.dirty.discard(opt.variable_name)
+        self.dirty.update([x.variable_name for x in
+            self.dependents(opt.variable_name)])
+    def stale(self):
+        """Return the options which need check() again, in topological
+        order: the dirty ones, and everything depending on them."""
+        names = set(self.dirty)
+        for name in self.dirty:
+            names.update([x.variable_name for x in self.dependents(name)])
+        return [opt for opt in self.topological_order()
+                if opt.variable_name in names]
+    def topological_order(self, options=None):
+        """Return options (default: all of them) ordered so that each comes
+        after the options it depends on, otherwise keeping creation order.
+        Options caught in a dependency cycle keep creation order too."""
+        if options is None:
+            options = list(self)
+        names = set([opt.variable_name for opt in options])
+        pending = [(opt, set(self.dependencies(opt)) & names)
+                for opt in options]
+        ordered = []
+        while pending:
+            done = set([opt.variable_name for opt in ordered])
+            ready = [opt for opt, deps in pending if deps <= done]
+            if not ready:
+                # Cycle, take what's left as-is
+                ordered.extend([opt for opt, deps in pending])
+                break
+            # Take the first ready option only, to stay close to
+            #   creation order
+            ordered.append(ready[0])
+            pending = [(opt, deps) for opt, deps in pending
+                    if opt is not ready[0]]
+        return ordered
+
 class ConfigOption(object):
     """Base Config Option Class.
     Most meaningful options will be subclasses of this one."""
-    options = []
+    options = OptionRegistry()
     option_type = "Default" # Replace in all Sub Classes
     metavar = "OPTION" # for optparse
     runmode = RunMode()
     configured = False
     loaded_from_file = False
+    cluster_wide = True # False if values never apply to other nodes
     def __getitem__(self, key):
         """Emulate this dictionary method so we can fill in strings"""
         return self.__dict__[key]
+    def __setattr__(self, name, value):
+        """Track value changes, however a subclass makes them, so that the
+        wizard only re-checks what changed."""
+        object.__setattr__(self, name, value)
+        if name == 'value':
+            self.options.mark_dirty(self)
     def __repr__(self):
         """Provide something useful to print."""
         s = "<`%s` Option:" % self.option_type
@@ -433,7 +1414,6 @@ class ConfigOption(object):
         return s
     def __init__(self, variable_name, description, default, per_node=False,
                  option_name=None, **kwargs):
-        self.options.append(self)
         self.variable_name = variable_name # Bash variable name for config file
         self.description = description
         if not 'ClustrixDB' in description:
@@ -443,18 +1423,19 @@ class ConfigOption(object):
             self.long_description = description
         self.value = default # We'll start from here
         self.default = default # Default value
-        self.per_node = per_node # Does this option apply this cluster-wide?
+        # Does this option's value only apply to this node?
+        self.per_node = per_node or not self.cluster_wide
         # Command line argument name, if this will be configurable:
         self.option_name = option_name
         self.is_set = False
+        self.from_command_line = False # Wins over the config file
+        self.probe_cache = {} # Results of expensive probes, see cached()
         self.extra_kwarg('extra_help', kwargs)
+        self.options.append(self) # Once we have names to index it by
     @classmethod
     def get_var(self, variable):
         """Retrieve a specific option from self.options by variable_name."""
-        for opt in self.options:
-            if opt.variable_name == variable:
-                return opt
-        return None # Could not find matching variable
+        return self.options.get(variable)
     def all_strings(self):
         """Print all user-facing strings, for review purposes."""
         # Probably out of date, not called during normal execution
@@ -503,6 +1484,24 @@ class ConfigOption(object):
         achieve a minimum viable configuration. Return True in all other
         cases."""
         return True
+    def dependencies(self):
+        """Return variable_names of options which must be settled before
+        this one can be probed or checked."""
+        return []
+    def probe(self):
+        """Gather facts about the current value without printing or
+        prompting, and return them as a dict for the preflight report.
+
+        Overload this in a subclass to do expensive, non-interactive work
+        (filesystem and network probes) ahead of check(), which is safe to
+        run in a thread alongside other options' probes."""
+        return {}
+    def cached(self, name, key, func, *args):
+        """Return func(*args), remembering the result for this name and
+        key so that repeated checks don't repeat expensive probes."""
+        if (name, key) not in self.probe_cache:
+            self.probe_cache[(name, key)] = func(*args)
+        return self.probe_cache[(name, key)]
     def mkhelp(self):
         """Assemble a help string from either long_description or extra_help,
         with the latter using __getitem__() to perform string substitution
@@ -525,6 +1524,7 @@ class ConfigOption(object):
         """Optparse callback, pass the 'value' arg to set_value() and
         ignore the rest."""
         self.set_value(value)
+        self.from_command_line = True
     def set_value(self, value):
         """Function to set self.value, so that subclasses may do some
         processing first."""
@@ -533,16 +1533,19 @@ class ConfigOption(object):
     def is_default(self):
         """See if this option has not been changed"""
         return self.value == self.default
-    def mkarg(self, no_defaults=True):
+    def mkarg(self, no_defaults=True, placeholders=True):
         """Return an argument which may be passed to this script to set
         this option to its current value. Skipped if the option is currently
         set to its default value.
 
-        If pre_node is true, don't print the actual value, just the name in
+        If per_node is true, don't print the actual value, just the name in
         brackets, for things like IP addresses which do not apply to other
-        machines."""
+        machines. Without placeholders such options are skipped, for
+        commands meant to be pasted into a shell as they are."""
         if not self.option_name or (self.is_default() and no_defaults):
             return None # Don't add defaults
+        if self.per_node and not placeholders:
+            return None
         if self.per_node:
             # We don't want the user copying this value to other nodes
             return "--%s=<%s>" % (self.option_name, self.variable_name)
@@ -557,6 +1560,38 @@ class ConfigOption(object):
     def config_string(self):
         """Return value for use in clxnode.conf file."""
         return self.value
+    def config_comments(self):
+        """Return extra lines to write as comments above this option in
+        clxnode.conf, for subclasses with findings worth recording."""
+        return []
+    def json_type(self):
+        """JSON Schema type of this option in clxnode.json, going by the
+        type of the default."""
+        if isinstance(self.default, bool):
+            return 'boolean'
+        if isinstance(self.default, (int, long)):
+            return 'integer'
+        return 'string'
+    def to_json_type(self, value):
+        """Convert a value to json_type(), keeping anything which doesn't
+        convert as a string for check() to complain about."""
+        if self.json_type() == 'boolean':
+            return bool(value)
+        if self.json_type() == 'integer':
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                pass
+        return str(value)
+    def json_value(self):
+        """Return the value for clxnode.json."""
+        return self.to_json_type(self.config_string())
+    def from_config(self, value):
+        """Convert a value from clxnode.json or clxnode.conf into what
+        set_value() takes: strings, as typed by the user, or bools."""
+        if isinstance(value, bool):
+            return value
+        return str(value)
 
 class ConfigBoolOption(ConfigOption):
     """A class for True/False options"""
@@ -603,16 +1638,257 @@ class ConfigBoolOption(ConfigOption):
     def optcallback(self, option, opt_text, value, parser):
         """When this flag is specified, set mode to the non-default value."""
         self.value = not self.default
-    def mkarg(self, no_defaults=False):
+        self.from_command_line = True
+    def mkarg(self, no_defaults=False, placeholders=True):
         """This is a flag, so don't supply self.value."""
         # Ignore the no_defaults variable, it doesn't work with flags
         if self.value != self.default:
             return "--%s" % self.option_name
 
+class StorageBenchmark(object):
+    """Measure how fast a directory's device is: sequential write
+    throughput, fsync() latency, and random 4K read and write IOPS with
+    STORAGE_BENCH_QUEUE_DEPTH IOs in flight.
+
+    IO goes through O_DIRECT with page-aligned buffers so that the page
+    cache doesn't flatter the device. Filesystems which refuse O_DIRECT
+    (tmpfs, for one) are measured buffered, and the results say so."""
+    block = 4096
+    chunk = 1024 * 1024 # Sequential write size per call
+    def __init__(self, directory, size_mib=STORAGE_BENCH_SIZE,
+            fsyncs=STORAGE_BENCH_FSYNCS, seconds=STORAGE_BENCH_SECONDS,
+            queue_depth=STORAGE_BENCH_QUEUE_DEPTH):
+        self.directory = directory
+        self.path = os.path.join(directory, STORAGE_BENCH_FILE)
+        self.size = size_mib * 1024 * 1024
+        self.fsyncs = fsyncs
+        self.seconds = seconds
+        self.queue_depth = queue_depth
+        self.direct = hasattr(os, 'O_DIRECT')
+        self.results = {}
+    def open(self, flags):
+        """Open the test file, with O_DIRECT if we still can."""
+        if self.direct:
+            try:
+                return os.open(self.path, flags | os.O_DIRECT, 0600)
+            except OSError:
+                self.direct = False # Not supported here, go buffered
+        return os.open(self.path, flags, 0600)
+    def run(self):
+        """Run all of the tests, return the results dict."""
+        try:
+            self.seq_write()
+            self.fsync_latency()
+            libc = get_libc()
+            if libc and hasattr(libc, 'pread'):
+                self.results['rand_read_iops'] = self.random_io(libc, False)
+                self.results['rand_write_iops'] = self.random_io(libc, True)
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.results['direct_io'] = self.direct
+        return self.results
+    def seq_write(self):
+        buf = mmap.mmap(-1, self.chunk) # mmap memory is page aligned
+        buf.write('\xa5' * self.chunk)
+        fd = self.open(os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            t0 = time.time()
+            written = 0
+            while written < self.size:
+                written += os.write(fd, buf)
+            os.fsync(fd)
+            elapsed = time.time() - t0
+        finally:
+            os.close(fd)
+            buf.close()
+        self.results['seq_write_mibps'] = written / 1048576.0 / elapsed
+    def fsync_latency(self):
+        """Time small write + fsync() pairs, like a redo log commit."""
+        fd = os.open(self.path, os.O_WRONLY)
+        latencies = []
+        try:
+            for x in range(self.fsyncs):
+                t0 = time.time()
+                os.lseek(fd, (x % 256) * self.block, os.SEEK_SET)
+                os.write(fd, '\0' * self.block)
+                os.fsync(fd)
+                latencies.append((time.time() - t0) * 1000)
+        finally:
+            os.close(fd)
+        self.results['fsync_p50_ms'] = percentile(latencies, 50)
+        self.results['fsync_p99_ms'] = percentile(latencies, 99)
+        self.results['fsync_max_ms'] = max(latencies)
+    def random_io(self, libc, write):
+        """Issue random 4K preads or pwrites from queue_depth threads
+        for self.seconds, return IOs per second.
+
+        ctypes releases the GIL around the calls, so the threads really do
+        keep queue_depth IOs in flight like an AIO queue would."""
+        if write:
+            fd = self.open(os.O_WRONLY)
+            call = getattr(libc, 'pwrite64', libc.pwrite)
+        else:
+            fd = self.open(os.O_RDONLY)
+            call = getattr(libc, 'pread64', libc.pread)
+        call.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                ctypes.c_int64)
+        blocks = self.size / self.block
+        counts = [0] * self.queue_depth
+        errors = []
+        deadline = time.time() + self.seconds
+        def worker(n):
+            buf = mmap.mmap(-1, self.block)
+            addr = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+            rand = random.Random(n)
+            while time.time() < deadline:
+                offset = rand.randrange(blocks) * self.block
+                if call(fd, addr, self.block, offset) != self.block:
+                    errors.append(ctypes.get_errno())
+                    return
+                counts[n] += 1
+        threads = [threading.Thread(target=worker, args=(n,))
+                for n in range(self.queue_depth)]
+        t0 = time.time()
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            os.close(fd)
+        if errors:
+            raise OSError(errors[0], os.strerror(errors[0]))
+        return sum(counts) / (time.time() - t0)
+    def failures(self, thresholds=STORAGE_BENCH_THRESHOLDS):
+        """Return a list of strings describing results below threshold."""
+        failed = []
+        for key, limit in sorted(thresholds.items()):
+            value = self.results.get(key)
+            if value is None:
+                continue
+            if key.endswith('_ms'):
+                if value > limit:
+                    failed.append("%s %.1f is above the limit of %s" %
+                            (key, value, limit))
+            elif value < limit:
+                failed.append("%s %.1f is below the minimum of %s" %
+                        (key, value, limit))
+        return failed
+    def summary(self):
+        """Return the results as lines of text."""
+        r = self.results
+        lines = ["Storage benchmark for %s (%s IO):" % (self.directory,
+            self.direct and 'direct' or 'buffered')]
+        lines.append("sequential write %.0f MiB/s" % r['seq_write_mibps'])
+        lines.append("fsync latency p50 %.2f ms, p99 %.2f ms, max %.2f ms" %
+                (r['fsync_p50_ms'], r['fsync_p99_ms'], r['fsync_max_ms']))
+        if 'rand_read_iops' in r:
+            lines.append("random 4K read %.0f IOPS, write %.0f IOPS "
+                    "(queue depth %d)" % (r['rand_read_iops'],
+                        r['rand_write_iops'], self.queue_depth))
+        return lines
+
+class MountEntry(object):
+    """One line of /proc/mounts."""
+    def __repr__(self):
+        return "<MountEntry %s on %s type %s>" % (self.device,
+                self.mount_point, self.fstype)
+    def __init__(self, line):
+        # /proc/mounts lines look like:
+        # /dev/md0 /mnt/backup ext4 rw,relatime,barrier=1,data=ordered 0 0
+        # Whitespace in paths is escaped as octal, e.g. \040 for a space
+        fields = [MountTable.unescape(x) for x in line.split()]
+        self.device, self.mount_point, self.fstype = fields[:3]
+        self.options = fields[3].split(',')
+
+class MountTable(object):
+    """Index of /proc/mounts by mount point.
+
+    The table is parsed once and only re-read when the kernel flags a
+    change on our open /proc/mounts file descriptor, so lookups cost a
+    dictionary probe per path component instead of a rescan of every
+    mount on the system. Use MountTable.shared() to get the common
+    instance."""
+    instance = None
+    instance_lock = threading.Lock() # Preflight threads share the instance
+    def __init__(self, path=PROC_MOUNTS_PATH):
+        self.path = path
+        self.mounts = {} # mount point: MountEntry
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDONLY)
+        # The kernel signals mount table changes with POLLERR|POLLPRI
+        #   on this fd, until it is read again:
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLERR | select.POLLPRI)
+        self.refresh()
+    @classmethod
+    def shared(cls):
+        """Return the process-wide MountTable, creating it on first use."""
+        with cls.instance_lock:
+            if not cls.instance:
+                cls.instance = cls()
+        return cls.instance
+    @staticmethod
+    def unescape(field):
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                field)
+    def changed(self):
+        """Check, without blocking, whether the mount table has changed
+        since we last read it."""
+        return bool(self.poller.poll(0))
+    def refresh(self):
+        """Re-read and re-index the mount table."""
+        with self.lock:
+            # Read through our own fd, that's what clears the change flag
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(self.fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            mounts = {}
+            for line in ''.join(chunks).split('\n'):
+                if not line.strip():
+                    continue
+                entry = MountEntry(line)
+                if entry.device == 'rootfs' and entry.mount_point in mounts:
+                    # This is not the actual mount record, skip it
+                    continue
+                # Later entries are mounted on top of earlier ones at the
+                #   same point, so the last one wins:
+                mounts[entry.mount_point] = entry
+            self.mounts = mounts
+    def lookup(self, path):
+        """Return the MountEntry of the filesystem holding path, or None.
+
+        This is a longest-prefix match over path components, so bind mounts
+        (which os.path.ismount() can't see on the same device) are found."""
+        if self.changed():
+            self.refresh()
+        mounts = self.mounts
+        # Avoid symlinks, look at where the path really lives:
+        path = os.path.realpath(path)
+        while True:
+            if path in mounts:
+                return mounts[path]
+            parent = os.path.dirname(path)
+            if parent == path:
+                # Got to / without a mount, only rootfs could be here
+                return None
+            path = parent
+
 class ConfigPathOption(ConfigOption):
     """Option for a directory or file path."""
     option_type = "Path"
-    path_variables = {}
+    # Every path, dereferenced at once by resolve_paths(). Any path value
+    #   change bumps path_generation, which makes these stale:
+    path_generation = 0
+    resolved = {} # variable_name: (path or None, error or None)
+    resolved_generation = -1
+    resolve_lock = threading.Lock()
+    benchmarks = {} # StorageBenchmarks by mount point, shared by all paths
     metavar = "PATH" # for optparse
     def __init__(self, *args, **kwargs):
         # Emulate extra kwargs without confusing things:
@@ -622,42 +1898,105 @@ class ConfigPathOption(ConfigOption):
         self.extra_kwarg('valid_fs', kwargs)
         # We need to handle files slightly differently from dirs:
         self.extra_kwarg('is_file', kwargs, False)
+        # Run StorageBenchmark here with --benchmark-storage:
+        self.extra_kwarg('benchmark', kwargs, False)
+        self.benchmark_result = None
         ConfigOption.__init__(self, *args, **kwargs)
         if not self.is_file:
             # Makes sense for directories only
             self.description = "%s Path" % self.description
             self.long_description = "%s Path" % self.long_description
-        self.path_variables[self.variable_name] = self # For dereferencing
         self.mkdir = False # for sub-directories to check
-    def get_path(self):
-        """Return an absolute, dereferenced path.
-        On failure to dereference, returns None, or raises RuntimeError."""
-        if '$' in self.value:
-            # At least one variable here
-            path = self.value
-            for var in re.findall("\$([a-zA-Z_]+[a-zA-Z0-9_]*)", self.value):
-                if var in self.path_variables:
-                    # Circular references will hit recursion limit
-                    # Exception looks like:
-                    #   RuntimeError: maximum recursion depth exceeded
-                    try:
-                        path = path.replace("$%s" % var,
-                                self.path_variables[var].get_path())
-                    except RuntimeError:
-                        # This won't get hit because it will trip in the caller first
-                        # This probably needs some work to handle smoothly.
-                        print ("Error: Circular variable reference to $%s "
-                                "found in $%s." % (var, self.variable_name))
-                        return None
-                else:
-                    # Attempted to look up a variable which did not exist
-                    print ("Error: Reference to $%s in $%s cannot be resolved." %
-                        (var, self.variable_name))
-                    return None
-            return path
-        else:
+    def dependencies(self):
+        """Paths depend on the path variables they reference."""
+        if self.value is None:
+            return []
+        return PATH_VARIABLE_RE.findall(self.value)
+    @classmethod
+    def path_variable(cls, variable):
+        """Return the path option named variable, for dereferencing, or
+        None if there is no such path option."""
+        opt = cls.get_var(variable)
+        if isinstance(opt, ConfigPathOption):
+            return opt
+        return None
+    def __setattr__(self, name, value):
+        ConfigOption.__setattr__(self, name, value)
+        if name == 'value':
+            ConfigPathOption.path_generation += 1
+    def find_cycle(self):
+        """Depth-first search of path references from this option.
+        Returns the variable_names around a reference cycle, starting and
+        ending with the same one, or None if there is no cycle."""
+        stack = [] # Current chain of references
+        done = set() # Options fully explored, known to be cycle-free
+        def visit(opt):
+            if opt.variable_name in stack:
+                return stack[stack.index(opt.variable_name):] + \
+                        [opt.variable_name]
+            if opt.variable_name in done:
+                return None
+            stack.append(opt.variable_name)
+            for var in opt.dependencies():
+                ref = self.path_variable(var)
+                if ref:
+                    cycle = visit(ref)
+                    if cycle:
+                        return cycle
+            stack.pop()
+            done.add(opt.variable_name)
+            return None
+        return visit(self)
+    @classmethod
+    def resolve_paths(cls):
+        """Dereference every path option once, in dependency order, so
+        that each reference is substituted with an already resolved path."""
+        with cls.resolve_lock:
+            generation = cls.path_generation
+            resolved = {}
+            for opt in cls.options.topological_order():
+                if isinstance(opt, ConfigPathOption):
+                    resolved[opt.variable_name] = opt.resolve(resolved)
+            cls.resolved = resolved
+            cls.resolved_generation = generation
+    def resolve(self, resolved):
+        """Return (path, error) for this option, given the results for the
+        paths it references."""
+        if self.value is None or '$' not in self.value:
             # Nothing to dereference
-            return self.value
+            return (self.value, None)
+        cycle = self.find_cycle()
+        if cycle:
+            return (None, "Error: Circular variable reference %s found in "
+                    "$%s." % (' -> '.join(['$%s' % x for x in cycle]),
+                        self.variable_name))
+        errors = []
+        def substitute(match):
+            var = match.group(1)
+            if not self.path_variable(var):
+                # Attempted to look up a variable which did not exist
+                errors.append("Error: Reference to $%s in $%s cannot be "
+                        "resolved." % (var, self.variable_name))
+                return match.group(0)
+            path, error = resolved[var]
+            if error:
+                errors.append(error)
+                return match.group(0)
+            return path
+        path = PATH_VARIABLE_RE.sub(substitute, self.value)
+        if errors:
+            return (None, errors[0])
+        return (path, None)
+    def get_path(self, quiet=False):
+        """Return an absolute, dereferenced path, or None on failure to
+        dereference. Errors are printed unless quiet is True."""
+        if self.resolved_generation != self.path_generation or \
+                self.variable_name not in self.resolved:
+            self.resolve_paths()
+        path, error = self.resolved[self.variable_name]
+        if error and not quiet:
+            print error
+        return path
     # Abbreviate some os.path functions pointed at our current path:
     def exists(self):
         return os.path.exists(self.get_path())
@@ -698,9 +2037,9 @@ class ConfigPathOption(ConfigOption):
             path = self.get_path()
         if '$' in self.value:
             # At least one variable here
-            for var in re.findall("\$([a-zA-Z_]+[a-zA-Z0-9_]*)", self.value):
-                if var in self.path_variables:
-                    if self.path_variables[var].mkdir:
+            for var in PATH_VARIABLE_RE.findall(self.value):
+                if self.path_variable(var):
+                    if self.path_variable(var).mkdir:
                         # Parent dir has already gotten a 'yes' to a prompt
                         print "Creating directory: %s" % path
                         os.makedirs(path)
@@ -722,31 +2061,37 @@ class ConfigPathOption(ConfigOption):
         value = os.path.abspath(value) # Must be done after expanduser()
         self.value = value
         self.is_set = True
+    def free_space(self):
+        """Return free space in GiB on the volume containing our path."""
+        return self.cached('free_space', self.get_dir_path(),
+                self.statvfs_free, self.get_dir_path())
+    @staticmethod
+    def statvfs_free(path):
+        statvfs = os.statvfs(path)
+        # Block size in bytes * blocks available / 1GB:
+        return statvfs.f_frsize * statvfs.f_bavail / 1024.0**3
     def get_fstype(self):
         """Determine the filesystem type for a given path."""
-        # Find our mount point:
-        # os.path.ismount() will take a file or dir, but avoid symlinks:
-        path = os.path.realpath(self.get_path())
-        while not os.path.ismount(path):
-            # If this is not a mountpoint, remove the last path element
-            #   and check again, until we get to /, which we assume is a
-            #   mount point
+        mount = MountTable.shared().lookup(self.get_path())
+        if not mount:
+            return None
+        return mount.fstype
+    def probe(self):
+        """Look up free space and filesystem type ahead of check(),
+        if the path already exists."""
+        path = self.get_path(quiet=True)
+        if not path:
+            return {'path': None}
+        if self.is_file:
             path = os.path.dirname(path)
-        # /proc/mounts lines look like:
-        # /dev/md0 /mnt/backup ext4 rw,relatime,barrier=1,data=ordered 0 0
-        fs_type = None
-        with open('/proc/mounts') as mounts_file:
-            for line in mounts_file.read().split('\n'):
-                line = line.strip()
-                if not line: continue
-                line_parts = line.split()
-                if line_parts[0] == 'rootfs':
-                    # This is not the actual mount record, skip it
-                    continue
-                if line_parts[1] == path:
-                    fs_type = line_parts[2]
-                    break
-        return fs_type
+        if not os.path.isdir(path):
+            return {'path': path, 'exists': False}
+        findings = {'path': path}
+        if self.min_free_space:
+            findings['free_gib'] = round(self.free_space(), 1)
+        if self.valid_fs:
+            findings['fstype'] = self.get_fstype()
+        return findings
     def check(self):
         """Verify path exists and optionally is on the right filesystem
         with sufficient free space."""
@@ -807,9 +2152,7 @@ class ConfigPathOption(ConfigOption):
         if self.min_free_space:
             # Verify minimum free space on volume containing path:
             # min_free_space is in GiB
-            statvfs = os.statvfs(self.get_dir_path())
-            # Block size in bytes * blocks available / 1GB:
-            free_space = statvfs.f_frsize * statvfs.f_bavail / 1024.0**3
+            free_space = self.free_space()
             if free_space < self.min_free_space:
                 print ("Warning: Insufficient free space on %s - Expected at "
                         "least %d GiB." % (self.get_path(), self.min_free_space))
@@ -829,8 +2172,8 @@ class ConfigPathOption(ConfigOption):
         if self.valid_fs:
             fs_type = self.get_fstype()
             if not fs_type:
-                print ("Could not determine filesystem type for %s (mounted "
-                        "on: %s)" % (self.get_path(), path))
+                print ("Could not determine filesystem type for %s." %
+                        self.get_path())
             if fs_type != self.valid_fs and fs_type not in self.valid_fs:
                 # valid_fs could be a single-fs string or sequence of fs types
                 # the filesystem type we're on is not in that list
@@ -856,11 +2199,344 @@ class ConfigPathOption(ConfigOption):
                 #            (fs_type, self.get_dir_path, path, self.valid_fs))
             # If we get this far either we're running with force or
             #   we've found a satisfactory filesystem. Continue on.
+        if self.benchmark and self.runmode.benchmark_storage:
+            self.run_benchmark()
         return True # If we get here, everything has passed
+    def run_benchmark(self):
+        """Benchmark the device under our path, once per filesystem, and
+        warn about results which are below STORAGE_BENCH_THRESHOLDS."""
+        mount = MountTable.shared().lookup(self.get_dir_path())
+        key = mount and mount.mount_point or self.get_dir_path()
+        if key not in self.benchmarks:
+            print "Benchmarking storage for %s..." % self.long_description
+            bench = StorageBenchmark(self.get_dir_path())
+            try:
+                bench.run()
+            except (IOError, OSError), e:
+                print "Warning: Storage benchmark of %s failed: %s" % (
+                        self.get_dir_path(), e)
+                return
+            self.benchmarks[key] = bench
+        self.benchmark_result = self.benchmarks[key]
+        print '\n\t'.join(self.benchmark_result.summary())
+        for failure in self.benchmark_result.failures():
+            print ("Warning: %s may be too slow for ClustrixDB: %s." %
+                    (self.get_path(), failure))
+    def config_comments(self):
+        """Record benchmark results, if we have them."""
+        if not self.benchmark_result:
+            return []
+        return self.benchmark_result.summary() + ["Below threshold: %s" % x
+                for x in self.benchmark_result.failures()]
+
+def nl_align(length):
+    """Round up to the 4 byte alignment of netlink messages and attributes."""
+    return (length + 3) & ~3
+
+def nl_attrs(data):
+    """Parse a run of rtattrs into a dict of type: raw value."""
+    attrs = {}
+    while len(data) >= RTATTR.size:
+        length, attr_type = RTATTR.unpack_from(data)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type & 0x7fff] = data[RTATTR.size:length]
+        data = data[nl_align(length):]
+    return attrs
+
+def addr_to_int(family, text):
+    """Convert IPv4 or IPv6 text to an int, as stored by IP()."""
+    return int(socket.inet_pton(family, text).encode('hex'), 16)
+
+class PrefixTable(object):
+    """Longest prefix match over one address family.
+
+    Holds one dict of network: value per prefix length in use, and probes
+    them from the longest length down, so a lookup is at most one dict
+    probe per distinct prefix length (a handful in practice, never more
+    than 33 or 129) however many prefixes there are."""
+    def __init__(self, bits=32):
+        self.bits = bits
+        self.ones = (1 << bits) - 1
+        self.tables = {} # prefixlen: {network int: value}
+        self.masks = {} # prefixlen: mask int
+        self.lengths = [] # Prefix lengths in use, longest first
+    def __len__(self):
+        return sum(len(x) for x in self.tables.values())
+    def add(self, addr, prefixlen, value):
+        """Add addr/prefixlen. If the prefix is already present, the value
+        added first is kept, so add in order of preference."""
+        if prefixlen not in self.tables:
+            self.tables[prefixlen] = {}
+            self.masks[prefixlen] = self.ones ^ (self.ones >> prefixlen)
+            self.lengths = sorted(self.tables, reverse=True)
+        self.tables[prefixlen].setdefault(addr & self.masks[prefixlen], value)
+    def lookup(self, addr):
+        """Return (prefixlen, value) for the longest prefix containing addr,
+        or (None, None) if nothing matches."""
+        for prefixlen in self.lengths:
+            value = self.tables[prefixlen].get(addr & self.masks[prefixlen])
+            if value is not None:
+                return prefixlen, value
+        return None, None
+
+class NetAddress(object):
+    """One address assigned to an interface."""
+    def __repr__(self):
+        return "<NetAddress %s %s/%d>" % (self.ifname, self.addr,
+                self.prefixlen)
+    def __init__(self, ifname, family, addr, prefixlen, secondary=False):
+        self.ifname = ifname
+        self.family = family
+        self.addr = addr # Text form, as from inet_ntop()
+        self.prefixlen = prefixlen
+        self.secondary = secondary
+
+class NetRoute(object):
+    """One unicast route from the main routing table."""
+    def __repr__(self):
+        return "<NetRoute %s/%d via %s dev %s>" % (self.destination,
+                self.dst_len, self.gateway, self.ifname)
+    def __init__(self, ifname, family, destination, dst_len, gateway=None,
+            metric=0):
+        self.ifname = ifname
+        self.family = family
+        self.destination = destination
+        self.dst_len = dst_len
+        self.gateway = gateway
+        self.metric = metric
+
+class NetSnapshot(object):
+    """Every interface, address and route on this host, read with one
+    rtnetlink dump of each, and indexed for the Interfaces lookups.
+
+    Falls back to /sys, ioctls and /proc/net when netlink is unavailable,
+    which only finds each interface's primary IPv4 address.
+    Use NetSnapshot.shared() to get the common instance."""
+    instance = None
+    def __init__(self):
+        self.links = {} # ifindex: name
+        self.addresses = []
+        self.routes = []
+        self.source = 'netlink'
+        try:
+            self.read_netlink()
+        except (socket.error, struct.error, AttributeError):
+            # No AF_NETLINK here (AttributeError), or it failed on us
+            self.links, self.addresses, self.routes = {}, [], []
+            self.source = 'proc'
+            self.read_proc()
+        self.index()
+    @classmethod
+    def shared(cls):
+        if not cls.instance:
+            cls.instance = cls()
+        return cls.instance
+    @classmethod
+    def refresh(cls):
+        """Take a new snapshot, for after interfaces or routes change."""
+        cls.instance = cls()
+        return cls.instance
+    def index(self):
+        self.by_name = {} # ifname: list of NetAddresses, primary first
+        self.by_addr = {} # address text: NetAddress
+        # Per family, every address as an int in sorted order, with the
+        #   NetAddresses alongside, for bisecting subnet ranges:
+        self.sorted_addrs = {socket.AF_INET: ([], []),
+                socket.AF_INET6: ([], [])}
+        for address in self.addresses:
+            self.by_name.setdefault(address.ifname, []).append(address)
+            self.by_addr.setdefault(address.addr, address)
+        for addresses in self.by_name.values():
+            addresses.sort(key=lambda x: x.secondary)
+        for value, address in sorted((addr_to_int(x.family, x.addr), x)
+                for x in self.addresses):
+            ints, addresses = self.sorted_addrs[address.family]
+            ints.append(value)
+            addresses.append(address)
+        self.route_tables = {} # (ifname, family): PrefixTable of NetRoutes
+        self.defaults = {} # family: lowest metric default NetRoute
+        # Lowest metric first, so it wins duplicate prefixes:
+        for route in sorted(self.routes, key=lambda x: x.metric):
+            if not route.ifname:
+                continue
+            key = (route.ifname, route.family)
+            if key not in self.route_tables:
+                self.route_tables[key] = PrefixTable(
+                        route.family == socket.AF_INET6 and 128 or 32)
+            self.route_tables[key].add(addr_to_int(route.family,
+                route.destination), route.dst_len, route)
+            if not route.dst_len:
+                self.defaults.setdefault(route.family, route)
+    def dump(self, sock, seq, msg_type, payload):
+        """Send one dump request, return the payloads of every reply."""
+        sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+            NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+        replies = []
+        while True:
+            data = sock.recv(65536)
+            while len(data) >= NLMSGHDR.size:
+                length, reply_type, flags, reply_seq, pid = \
+                        NLMSGHDR.unpack_from(data)
+                if length < NLMSGHDR.size:
+                    return replies
+                if reply_seq == seq:
+                    if reply_type == NLMSG_DONE:
+                        return replies
+                    if reply_type == NLMSG_ERROR:
+                        raise socket.error("netlink dump %d failed" %
+                                msg_type)
+                    replies.append((reply_type,
+                        data[NLMSGHDR.size:length]))
+                data = data[nl_align(length):]
+    def read_netlink(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                NETLINK_ROUTE)
+        try:
+            sock.bind((0, 0))
+            for msg_type, payload in self.dump(sock, 1, RTM_GETLINK,
+                    IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+                family, if_type, ifindex, flags, change = \
+                        IFINFOMSG.unpack_from(payload)
+                attrs = nl_attrs(payload[IFINFOMSG.size:])
+                self.links[ifindex] = attrs.get(IFLA_IFNAME,
+                        '').rstrip('\0')
+            for msg_type, payload in self.dump(sock, 2, RTM_GETADDR,
+                    IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+                family, prefixlen, flags, scope, ifindex = \
+                        IFADDRMSG.unpack_from(payload)
+                if family not in (socket.AF_INET, socket.AF_INET6):
+                    continue
+                attrs = nl_attrs(payload[IFADDRMSG.size:])
+                # IFA_ADDRESS is the peer on point-to-point links,
+                #   IFA_LOCAL is always ours when present:
+                raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+                if raw is None:
+                    continue
+                self.addresses.append(NetAddress(self.links.get(ifindex),
+                    family, socket.inet_ntop(family, raw), prefixlen,
+                    bool(flags & IFA_F_SECONDARY)))
+            for msg_type, payload in self.dump(sock, 3, RTM_GETROUTE,
+                    RTMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0)):
+                (family, dst_len, src_len, tos, table, protocol, scope,
+                        route_type, flags) = RTMSG.unpack_from(payload)
+                attrs = nl_attrs(payload[RTMSG.size:])
+                if RTA_TABLE in attrs:
+                    table = struct.unpack('=I', attrs[RTA_TABLE])[0]
+                if table != RT_TABLE_MAIN or route_type != RTN_UNICAST or \
+                        family not in (socket.AF_INET, socket.AF_INET6):
+                    continue
+                zero = '\0' * (family == socket.AF_INET and 4 or 16)
+                gateway = None
+                if RTA_GATEWAY in attrs:
+                    gateway = socket.inet_ntop(family, attrs[RTA_GATEWAY])
+                oif = None
+                if RTA_OIF in attrs:
+                    oif = self.links.get(struct.unpack('=i',
+                        attrs[RTA_OIF])[0])
+                metric = 0
+                if RTA_PRIORITY in attrs:
+                    metric = struct.unpack('=I', attrs[RTA_PRIORITY])[0]
+                self.routes.append(NetRoute(oif, family,
+                    socket.inet_ntop(family, attrs.get(RTA_DST, zero)),
+                    dst_len, gateway, metric))
+        finally:
+            sock.close()
+    def read_proc(self):
+        """The old way: /sys/class/net, SIOCGIFADDR and /proc/net/route,
+        plus /proc/net/if_inet6 and /proc/net/ipv6_route."""
+        for path in glob.glob('/sys/class/net/*'):
+            ifindex = read_sys(os.path.join(path, 'ifindex'))
+            if ifindex:
+                self.links[int(ifindex)] = os.path.basename(path)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for ifname in self.links.values():
+                request = struct.pack('256s', ifname[:15])
+                try:
+                    addr = fcntl.ioctl(sock.fileno(), 0x8915, # SIOCGIFADDR
+                            request)[20:24]
+                    mask = fcntl.ioctl(sock.fileno(), 0x891b, # SIOCGIFNETMASK
+                            request)[20:24]
+                except IOError:
+                    # No IPv4 address on this interface
+                    continue
+                prefixlen = bin(struct.unpack('!I', mask)[0]).count('1')
+                self.addresses.append(NetAddress(ifname, socket.AF_INET,
+                    socket.inet_ntoa(addr), prefixlen))
+        finally:
+            sock.close()
+        # Lines look like:
+        #   fe800000000000000000000000000001 02 40 20 80     eth0
+        for line in read_sys('/proc/net/if_inet6', '').split('\n'):
+            fields = line.split()
+            if len(fields) == 6:
+                self.addresses.append(NetAddress(fields[5], socket.AF_INET6,
+                    socket.inet_ntop(socket.AF_INET6, fields[0].decode('hex')),
+                    int(fields[2], 16)))
+        # Lines look like (hex fields in host byte order):
+        #   Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+        #   eth0  00000000    0102A8C0 0003  0      0   100    00000000 ...
+        lines = read_sys('/proc/net/route', '').split('\n')[1:]
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            to_text = lambda x: socket.inet_ntoa(struct.pack('<I',
+                int(x, 16)))
+            prefixlen = bin(int(fields[7], 16)).count('1')
+            gateway = None
+            if int(fields[2], 16):
+                gateway = to_text(fields[2])
+            self.routes.append(NetRoute(fields[0], socket.AF_INET,
+                to_text(fields[1]), prefixlen, gateway, int(fields[6])))
+        # Lines look like:
+        #   dest(32 hex) dst_len src src_len gateway metric refcnt use flags dev
+        for line in read_sys('/proc/net/ipv6_route', '').split('\n'):
+            fields = line.split()
+            if len(fields) < 10 or fields[9] == 'lo':
+                continue
+            # Only unicast routes, as from the main table via netlink:
+            if int(fields[8], 16) & (RTF_LOCAL | RTF_REJECT) or \
+                    fields[0].startswith('ff'):
+                continue
+            to_text = lambda x: socket.inet_ntop(socket.AF_INET6,
+                    x.decode('hex'))
+            gateway = None
+            if int(fields[4], 16):
+                gateway = to_text(fields[4])
+            self.routes.append(NetRoute(fields[9], socket.AF_INET6,
+                to_text(fields[0]), int(fields[1], 16), gateway,
+                int(fields[5], 16)))
+    def interface_names(self):
+        return sorted(self.links.values())
+    def addresses_for(self, ifname, family=socket.AF_INET):
+        """Return addresses on ifname, primary first."""
+        return [x for x in self.by_name.get(ifname, []) if x.family == family]
+    def default_route(self, family=socket.AF_INET):
+        """Return the default NetRoute with the lowest metric, or None."""
+        return self.defaults.get(family)
+    def route_for(self, ifname, addr):
+        """Return the longest NetRoute via ifname which covers addr (an IP),
+        or None."""
+        table = self.route_tables.get((ifname, addr.family()))
+        if not table:
+            return None
+        return table.lookup(addr.addr)[1]
+    def addresses_in(self, network, prefixlen):
+        """Return the NetAddresses within network/prefixlen (network is an
+        IP), in address order."""
+        ints, addresses = self.sorted_addrs[network.family()]
+        host_bits = (1 << (network.bits() - prefixlen)) - 1
+        first = network.addr & ~host_bits
+        return addresses[bisect.bisect_left(ints, first):
+                bisect.bisect_right(ints, first | host_bits)]
 
 class IP(object):
-    """Represents an IPv4 address or mask, stored as an int"""
-    def __init__(self, orig_addr=None):
+    """Represents an IPv4 or IPv6 address or mask, stored as an int along
+    with its version"""
+    def __init__(self, orig_addr=None, version=4):
+        self.version = version
         if not orig_addr:
             self.addr = 0 # Represents 0.0.0.0, which is the global-listen address
             return
@@ -868,44 +2544,46 @@ class IP(object):
             self.addr = self.from_dotted(orig_addr)
         except (ValueError, AttributeError):
             try:
-                self.addr = self.from_hex(orig_addr)
-            except (ValueError, TypeError):
+                self.addr = self.from_v6(orig_addr)
+                self.version = 6
+            except (ValueError, TypeError, socket.error):
                 try:
-                    self.addr = int(orig_addr)
-                    if self.addr < 32:
-                        # Too small to be an IP, treat this as a CIDR netmask
-                        tmp_addr = ['0'] * 32
-                        for x in range(self.addr):
-                            tmp_addr[x] = '1'
-                        self.addr = int(''.join(tmp_addr), 2)
-                except ValueError:
+                    self.addr = self.from_hex(orig_addr)
+                except (ValueError, TypeError):
                     try:
-                        assert(isinstance(orig_addr, (int, long)))
-                        self.addr = orig_addr
-                    except AssertionError:
+                        prefixlen = int(orig_addr)
+                        if prefixlen <= self.bits():
+                            # Too small to be an IP, treat this as a CIDR netmask
+                            self.addr = self.from_prefixlen(prefixlen,
+                                    version).addr
+                        else:
+                            self.addr = prefixlen
+                    except ValueError:
                         raise ValueError('`%s` is not a known IP '
                                 'address format.' % orig_addr)
     def __repr__(self):
-        return "<IP %s>" % self.to_dotted()
+        return "<IP %s>" % self.to_text()
     def __str__(self):
-        return self.to_dotted()
+        return self.to_text()
     def __eq__(self, other):
-        return self.addr == other.addr
+        return self.version == other.version and self.addr == other.addr
+    def __ne__(self, other):
+        return not self == other
     def __nonzero__(self):
-        # 0.0.0.0 returns False
+        # 0.0.0.0 and :: return False
         return bool(self.addr)
     def __len__(self):
         # Define this as the number of 1 bits in an address,
         #   so it becomes a proxy for specificity of a mask
-        x = 0
-        a = self.addr
-        while a:
-            x += a&1
-            a >>= 1
-        return a
+        return bin(self.addr).count('1')
     def __cmp__(self, other):
         # For comparing specificity of subnet masks
         return len(self).__cmp__(len(other))
+    def bits(self):
+        return self.version == 6 and 128 or 32
+    def family(self):
+        """The socket address family to use for this address."""
+        return self.version == 6 and socket.AF_INET6 or socket.AF_INET
     @staticmethod
     def from_dotted(from_addr):
         """Convert from dotted octet string to int"""
@@ -927,6 +2605,25 @@ class IP(object):
             from_addr >>=8
         return '.'.join(to_addr)
     @staticmethod
+    def from_v6(from_addr):
+        """Convert from any IPv6 text form to int"""
+        high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6,
+            from_addr))
+        return high << 64 | low
+    def to_v6(self):
+        """Convert from int to the shortest IPv6 text form"""
+        return socket.inet_ntop(socket.AF_INET6, struct.pack('!QQ',
+            self.addr >> 64, self.addr & 0xffffffffffffffff))
+    def to_text(self):
+        if self.version == 6:
+            return self.to_v6()
+        return self.to_dotted()
+    def url_host(self):
+        """Text form for the host part of a URL, bracketed for IPv6"""
+        if self.version == 6:
+            return '[%s]' % self.to_v6()
+        return self.to_dotted()
+    @staticmethod
     def from_hex(from_addr):
         """Convert from network-byte-order hex to int"""
         if len(from_addr) is not 8:
@@ -938,16 +2635,27 @@ class IP(object):
             to_addr += int(from_addr[-2:], 16)
             from_addr = from_addr[:-2]
         return to_addr
+    @classmethod
+    def from_prefixlen(cls, prefixlen, version=4):
+        """Return the netmask for a prefix length, including /0 and /32."""
+        mask = cls(version=version)
+        ones = (1 << mask.bits()) - 1
+        mask.addr = ones ^ (ones >> prefixlen)
+        return mask
     def in_subnet(self, other, mask):
         """Determine whether other_addr is in the same subnet as self.addr,
         as specified by the mask addr."""
-        return self.addr & mask.addr == other.addr & mask.addr
+        return self.version == other.version and \
+                self.addr & mask.addr == other.addr & mask.addr
 
 class Interface(object):
     """Represents a single network interface"""
     def __repr__(self):
         return "<Interface %s: %s/%s>" % (self.name, self.addr, self.mask)
     def __str__(self):
+        if self.mask and self.addr.version == 6:
+            # Nobody writes out IPv6 netmasks
+            return "%s/%d" % (self.addr, len(self.mask))
         if self.mask:
             return "%s/%s" % (self.addr, self.mask)
         return str(self.addr)
@@ -966,7 +2674,8 @@ class Interface(object):
             self.interface = name
             self.get_addr() # Raises ValueError if interface has no IP
         if mask:
-            self.mask = IP(mask)
+            # A bare prefix length follows the version of the address
+            self.mask = IP(mask, self.addr.version)
         else:
             self.get_mask()
     def __nonzero__(self):
@@ -994,54 +2703,26 @@ class Interface(object):
             return False
         return self.addr.in_subnet(other.addr, self.mask)
 
-class Route(object):
-    """Represents one line of /proc/net/route"""
-    def __repr__(self):
-        return '<Route %s/%s via %s>' % (self.destination, self.mask, self.interface_name)
-    def __init__(self, line):
-        self.interface_name = line[0]
-        self.destination = IP(line[1])
-        self.gateway = IP(line[2])
-        self.mask = IP(line[7])
-    def applies_to(self, other):
-        """See if this route fits the given addr"""
-        return self.destination.in_subnet(other, self.mask)
-
-
 class Interfaces(list):
     """Represents all of the ethernet interfaces available on the machine"""
-    routes = {}
     default_route = None
-    ifcache = {'Global': IP()}
     def __init__(self):
         self.populate_routes()
         self.append(Interface('*'))
     @classmethod
     def populate_routes(cls):
-        default = None
-        net_routes = open('/proc/net/route').read().split('\n')
-        net_routes.pop(0) # remove header line
-        for line in net_routes:
-            line = line.strip()
-            if not line:
-                continue
-            line = line.split()
-            route = Route(line)
-            if route.mask == IP('00000000') and not default:
-                # The first route with a /0 mask is default
-                default = route.interface_name
-            if not route.interface_name in cls.routes:
-                cls.routes[route.interface_name] = [route]
-            else:
-                cls.routes[route.interface_name].append(route)
+        snapshot = NetSnapshot.shared()
+        # Prefer the IPv4 default route, IPv6-only hosts use the IPv6 one:
+        default = snapshot.default_route(socket.AF_INET) or \
+                snapshot.default_route(socket.AF_INET6)
         if default:
             # Now that we have a routing table, instantiating Interface()
             #   makes more sense
-            cls.default_route = Interface(default)
+            cls.default_route = Interface(default.ifname)
     @staticmethod
     def list_interface_names():
-        """Enumerate the ethernet interfaces present based on /proc"""
-        return [os.path.basename(x) for x in glob.glob('/sys/class/net/*')]
+        """Enumerate the network interfaces present"""
+        return NetSnapshot.shared().interface_names()
     @classmethod
     def list_interfaces(cls):
         """Return a list of Interface objects for interfaces present
@@ -1056,19 +2737,16 @@ class Interfaces(list):
         return iflist
     @classmethod
     def list_addresses(cls, no_global=False):
-        """Return IP objects for all non-loopback addresses present,
-        optionally including the Global listen interface at 0.0.0.0"""
+        """Return IP objects for all non-loopback, non-link-local addresses
+        present, secondary and IPv6 addresses included, optionally including
+        the Global listen interface at 0.0.0.0"""
         addresses = []
         if not no_global:
             # Add the global-listen address
             addresses.append(IP())
-        for ifname in cls.list_interface_names():
-            try:
-                ifaddr = cls.ip_for_interface(ifname)
-            except ValueError:
-                # This interface doesn't exist or doesn't have an IP
-                continue
-            if cls.is_loopback(ifaddr):
+        for address in NetSnapshot.shared().addresses:
+            ifaddr = IP(address.addr)
+            if cls.is_loopback(ifaddr) or cls.is_link_local(ifaddr):
                 continue
             addresses.append(ifaddr)
         return addresses
@@ -1079,58 +2757,50 @@ class Interfaces(list):
         return ' '.join([str(addr) for addr in cls.list_addresses(no_global)])
     @classmethod
     def ip_for_interface(cls, interface):
-        """Determine IPv4 address of selected interface.
-        Mostly From:
-        http://code.activestate.com/recipes/439094/
+        """Determine the primary address of selected interface: IPv4 if it
+        has one, otherwise its first IPv6 address which isn't link-local.
 
         Note: May raise ValueError on unknown interface or interface with no
         address assigned."""
-        if interface in cls.ifcache:
-            return cls.ifcache[interface]
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            addr = IP(socket.inet_ntoa(fcntl.ioctl(sock.fileno(),
-                0x8915,  # SIOCGIFADDR
-                struct.pack('256s', interface[:15]))[20:24]))
-        except IOError:
+        if interface == 'Global':
+            return IP()
+        snapshot = NetSnapshot.shared()
+        addresses = snapshot.addresses_for(interface, socket.AF_INET) or \
+                [x for x in snapshot.addresses_for(interface, socket.AF_INET6)
+                        if not cls.is_link_local(IP(x.addr))]
+        if not addresses:
             # Requested interface does not exist or does not have address
             raise ValueError('Interface %s does not exist or has no '
                     'address assigned' % interface)
-        sock.close()
-        cls.ifcache[interface] = addr
-        return addr
+        return IP(addresses[0].addr)
     @classmethod
     def interface_for_ip(cls, addr):
         # Don't use Interface() object because this is called in Interface.__init__
-        if addr == IP():
-            # This is 0.0.0.0, the Global address
+        if not addr:
+            # This is 0.0.0.0 or ::, the Global address
             return 'Global'
-        for ifname in cls.list_interface_names():
-            try:
-                if addr == cls.ip_for_interface(ifname):
-                    return ifname
-            except ValueError:
-                # Attempted to get an IP for an interface that doesn't exist
-                #   or doesn't have an IP assigned
-                continue
+        address = NetSnapshot.shared().by_addr.get(str(addr))
+        if address:
+            return address.ifname
         return None # This IP isn't present on any interface
     @classmethod
     def mask_for_interface(cls, interface):
         # interface is an Interface object
-        if not interface.interface or interface.interface not in cls.routes:
-            # No interface name or no routes for interface
+        if not interface.interface:
+            # No interface name
             return None
-        mask = None
-        for route in cls.routes[interface.interface]:
-            if route.applies_to(interface.addr):
-                if not mask:
-                    mask = route.mask
-                    continue
-                # If we get here the interface has at least two usable routes
-                #   Pick the longest one:
-                if route.mask > mask:
-                    mask = route.mask
-        return mask
+        # The address itself carries its prefix length:
+        address = NetSnapshot.shared().by_addr.get(str(interface.addr))
+        if address and address.ifname == interface.interface:
+            return IP.from_prefixlen(address.prefixlen,
+                    interface.addr.version)
+        # Otherwise the longest route to it via the interface:
+        route = NetSnapshot.shared().route_for(interface.interface,
+                interface.addr)
+        if not route:
+            # No routes for interface
+            return None
+        return IP.from_prefixlen(route.dst_len, interface.addr.version)
     @classmethod
     def default_interface(cls):
         """Return the Interface object associated with the default route"""
@@ -1140,17 +2810,32 @@ class Interfaces(list):
     @staticmethod
     def is_loopback(addr):
         """Check an address to see if it's in the loopback subnet"""
+        if addr.version == 6:
+            return addr == IP('::1')
         lo_addr = IP('127.0.0.1')
         lo_subnet = IP(8) # Built in CIDR test
         return lo_addr.in_subnet(addr, lo_subnet)
+    @staticmethod
+    def is_link_local(addr):
+        """Check for IPv6 fe80::/10, which can't be used without a scope"""
+        return IP('fe80::').in_subnet(addr, IP(10, 6))
     @classmethod
     def find_interface_in_subnet(cls, subnet):
         """Find an available interface with an address within the specified
         subnet (which is actually an Interface() object. Don't worry about it."""
+        if not all((subnet.mask, subnet.addr)):
+            # Nothing is in an unresolved subnet
+            return None
         found = []
-        for interface in Interfaces.list_interfaces():
-            if subnet.in_subnet(interface):
-                found.append(interface)
+        # Every address, not just each interface's primary one, so that
+        #   IPv6 subnets find dual-stack interfaces:
+        for address in NetSnapshot.shared().addresses_in(subnet.addr,
+                len(subnet.mask)):
+            addr = IP(address.addr)
+            if cls.is_loopback(addr) or cls.is_link_local(addr):
+                continue
+            if address.ifname not in [x.interface for x in found]:
+                found.append(Interface(address.addr))
         if len(found) > 1:
             # Matched multiple interfaces, subnet isn't specific enough
             raise ValueError("Multiple interfaces match given subnet")
@@ -1161,13 +2846,11 @@ class Interfaces(list):
 
 class ConfigInterfaceOption(ConfigOption):
     """Interface Option for specifying IP Addresses."""
-    interfaces = {}
     option_type = "Interface"
     cluster_wide = False # IPs change between
     def __init__(self, *args, **kwargs):
         ConfigOption.__init__(self, *args, **kwargs)
         self.extra_kwarg('requires_address', kwargs, False)
-        self.interfaces[self.variable_name] = self
         self.long_description = "%s Interface" % self.long_description
     def prompt_str(self):
         pstr = ("Available IP Addresses on this node: %s\n"
@@ -1201,14 +2884,14 @@ class ConfigInterfaceOption(ConfigOption):
                 print ("Error: Unable to find interface in subnet `%s`." % iface)
                 return self.prompt()
             iface = local_iface
-        if not iface.addr == IP() and not (iface.addr and iface.interface):
+        if iface.addr and not iface.interface:
             print ("Error: `%s` is not associated with any available network "
                     "device. Please enter a valid address." % value)
             return self.prompt()
         # At this point we have a valid Interface object with address, though
         #   it may be 0.0.0.0
-        if self.requires_address and iface.addr == IP():
-            # We got 0.0.0.0 when a specific address is required
+        if self.requires_address and not iface.addr:
+            # We got 0.0.0.0 or :: when a specific address is required
             print ("Error: %s requires an IP which is currently assigned to a "
                     "network interface." % self.description)
             return self.prompt()
@@ -1224,9 +2907,11 @@ class ConfigInterfaceOption(ConfigOption):
                     % (self.description, self.variable_name))
             return False
         return True
+    def probe(self):
+        return {'addr': str(self.value.addr), 'interface': self.value.interface}
     def human_value(self):
         """Add description for '0.0.0.0' if necessary."""
-        if not self.value.addr or self.value.addr == IP(None):
+        if not self.value.addr:
             # We have a * interface
             return "%s (Listen on all available interfaces)" % self.value
         return self.value
@@ -1234,6 +2919,155 @@ class ConfigInterfaceOption(ConfigOption):
         """We don't want the netmask in the config file"""
         return self.value.addr
 
+class PortHolder(object):
+    """One bound socket from /proc/net/{tcp,tcp6,udp,udp6}."""
+    def __repr__(self):
+        return "<PortHolder %s %s:%d inode %d>" % (self.proto, self.addr,
+                self.port, self.inode)
+    def __init__(self, proto, addr, port, uid, inode):
+        self.proto = proto # socket.SOCK_STREAM or socket.SOCK_DGRAM
+        self.addr = addr # IP
+        self.port = port
+        self.uid = uid
+        self.inode = inode
+    def overlaps(self, addr):
+        """Check if binding addr (an IP) would collide with us. A wildcard
+        on either side collides with everything; an IPv6 wildcard also
+        takes IPv4, since bindv6only is off by default."""
+        if not self.addr or not addr:
+            return self.addr.version == addr.version or \
+                    (not self.addr and self.addr.version == 6) or \
+                    (not addr and addr.version == 6)
+        return self.addr == addr
+
+class PortIndex(object):
+    """Every listening TCP and bound UDP socket on the host, read from
+    /proc/net in one pass, so port options are checked without a trial
+    bind each.
+
+    Owning processes are found on demand, by matching socket inodes
+    against the /proc/<pid>/fd links, which is only worth doing for a
+    port that is actually taken. Use PortIndex.shared() to get the
+    common instance."""
+    instance = None
+    instance_lock = threading.Lock() # Preflight threads share the instance
+    tables = (('tcp', socket.SOCK_STREAM, 4), ('tcp6', socket.SOCK_STREAM, 6),
+            ('udp', socket.SOCK_DGRAM, 4), ('udp6', socket.SOCK_DGRAM, 6))
+    def __init__(self, net_path=PROC_NET_PATH):
+        self.net_path = net_path
+        self.holders = {} # (proto, port): [PortHolder]
+        self.readable = False # False means fall back to trial binds
+        self.owners = None # inode: pid, filled in by owner()
+        for name, proto, version in self.tables:
+            try:
+                self.read_table(os.path.join(net_path, name), proto, version)
+                self.readable = True
+            except IOError:
+                # No IPv6, or no /proc
+                continue
+    @classmethod
+    def shared(cls):
+        """Return the process-wide PortIndex, creating it on first use."""
+        with cls.instance_lock:
+            if not cls.instance:
+                cls.instance = cls()
+        return cls.instance
+    @classmethod
+    def refresh(cls):
+        """Re-read /proc/net, for after ports have been freed."""
+        with cls.instance_lock:
+            cls.instance = cls()
+        return cls.instance
+    @staticmethod
+    def parse_addr(text, version):
+        """Convert a /proc/net address, hex in host byte order per 32 bit
+        word, to an IP."""
+        words = [struct.unpack('=I', struct.pack('!I', int(text[x:x + 8],
+            16)))[0] for x in range(0, len(text), 8)]
+        addr = IP(version=version)
+        for word in words:
+            addr.addr = addr.addr << 32 | word
+        return addr
+    def read_table(self, path, proto, version):
+        # Lines look like:
+        #   sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+        #     retrnsmt uid timeout inode ...
+        #   0: 0100007F:0CEA 00000000:0000 0A 00000000:00000000 00:00000000
+        #     00000000 0 0 12345 ...
+        lines = open(path).read().split('\n')[1:]
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            if proto == socket.SOCK_STREAM and int(fields[3], 16) != TCP_LISTEN:
+                # Connections don't stop us from listening
+                continue
+            addr, port = fields[1].split(':')
+            holder = PortHolder(proto, self.parse_addr(addr, version),
+                    int(port, 16), int(fields[7]), int(fields[9]))
+            self.holders.setdefault((proto, holder.port), []).append(holder)
+    def conflicts(self, proto, addr, port):
+        """Return the PortHolders which would stop us binding addr:port."""
+        return [x for x in self.holders.get((proto, port), [])
+                if x.overlaps(addr)]
+    def owner(self, holder):
+        """Return the pid holding holder's socket, or None if it can't be
+        found (a kernel socket, or it has since closed)."""
+        if self.owners is None:
+            self.owners = {}
+            for fd_path in glob.glob('/proc/[0-9]*/fd/*'):
+                try:
+                    link = os.readlink(fd_path)
+                except OSError:
+                    # Process or fd went away while we looked
+                    continue
+                if link.startswith('socket:['):
+                    self.owners.setdefault(int(link[8:-1]),
+                            int(fd_path.split('/')[2]))
+        return self.owners.get(holder.inode)
+    def is_clustrix(self, holder):
+        """Check if holder's socket belongs to a ClustrixDB process, which
+        --rolling will stop before it binds the port again."""
+        pid = self.owner(holder)
+        if pid is None:
+            return False
+        try:
+            exe = os.readlink('/proc/%d/exe' % pid)
+        except OSError:
+            # Gone already
+            return False
+        return exe.startswith(CLUSTRIX_ROOT + os.sep)
+    @staticmethod
+    def process_name(pid):
+        """Return the command name of pid, or '?' if it's gone."""
+        try:
+            return open('/proc/%d/comm' % pid).read().strip()
+        except IOError:
+            return '?'
+    def describe(self, holder):
+        """Say who holds a port, for error messages."""
+        pid = self.owner(holder)
+        if pid is None:
+            return "held by a socket with no owning process (uid %d)" % \
+                    holder.uid
+        return "held by %s (pid %d) on %s" % (self.process_name(pid), pid,
+                holder.addr)
+    def nearest_free(self, proto, addr, port, count=PORT_SUGGESTIONS,
+            exclude=()):
+        """Return up to count free ports closest to port, nearest first,
+        skipping any in exclude."""
+        free = []
+        # Don't suggest a privileged port for an unprivileged one:
+        low = port < 1024 and 1 or 1024
+        for distance in range(1, 65535):
+            for candidate in (port - distance, port + distance):
+                if low <= candidate <= 65535 and candidate not in exclude \
+                        and not self.conflicts(proto, addr, candidate):
+                    free.append(candidate)
+            if len(free) >= count:
+                break
+        return free[:count]
+
 class ConfigPortOption(ConfigOption):
     """Option for configuring a TCP and/or UDP port."""
     option_type = "Port"
@@ -1243,9 +3077,9 @@ class ConfigPortOption(ConfigOption):
         self.extra_kwarg('interface_name', kwargs)
         self.extra_kwarg('configurable', kwargs, True) # Some ports are fixed
         self.interface = Interface() # Unknown interface binds to *
-        if self.interface_name in ConfigInterfaceOption.interfaces:
+        if self.interface_option():
             # Dereference by interface variable_name
-            self.interface = ConfigInterfaceOption.interfaces[self.interface_name].value
+            self.interface = self.interface_option().value
         self.multiproto = False
         try:
             if len(self.protos) > 1:
@@ -1280,15 +3114,72 @@ class ConfigPortOption(ConfigOption):
             self.is_set = False
             print ("Error: '%s' is not a valid %s port number." % (value,
                     self.proto_str()))
+    def dependencies(self):
+        """Ports are bound on the address of their interface option."""
+        if self.interface_option():
+            return [self.interface_name]
+        return []
+    def interface_option(self):
+        """Return our ConfigInterfaceOption, or None if there isn't one."""
+        opt = self.get_var(self.interface_name)
+        if isinstance(opt, ConfigInterfaceOption):
+            return opt
+        return None
+    def get_interface(self):
+        """Return the current Interface of our interface option, so that
+        bind tests follow changes made to it after we were created."""
+        if self.interface_option():
+            return self.interface_option().value
+        return self.interface
+    def port_available(self, proto):
+        """Check the port against the PortIndex. A taken port is checked
+        again against a fresh index, so one freed since is seen.
+        Without /proc/net, this is a cached test_port_bind(); only
+        successes are cached, so a port which was busy is tested again
+        next time."""
+        index = PortIndex.shared()
+        addr = self.get_interface().addr
+        if index.readable:
+            holders = self.port_conflicts(index, proto, addr)
+            if holders:
+                index = PortIndex.refresh()
+                holders = self.port_conflicts(index, proto, addr)
+            if holders:
+                return (False, "Port is %s" % index.describe(holders[0]))
+            return (True, '')
+        key = ('bind', proto, str(addr), self.value)
+        if key in self.probe_cache:
+            return self.probe_cache[key]
+        result = self.test_port_bind(proto)
+        if result[0]:
+            self.probe_cache[key] = result
+        return result
+    def port_conflicts(self, index, proto, addr):
+        """PortIndex.conflicts(), except that with --rolling, ports held by
+        the running ClustrixDB are fine: it is stopped before it restarts
+        with the new config."""
+        holders = index.conflicts(proto, addr, self.value)
+        if self.runmode.rolling:
+            holders = [x for x in holders if not index.is_clustrix(x)]
+        return holders
+    def suggest_ports(self, proto):
+        """Return nearby ports which are free and not used by another port
+        option, as a human-readable string."""
+        taken = [x.value for x in self.options
+                if isinstance(x, ConfigPortOption) and x is not self]
+        free = PortIndex.shared().nearest_free(proto,
+                self.get_interface().addr, self.value, exclude=taken)
+        return ', '.join([str(x) for x in free])
     def test_port_bind(self, proto):
         """Attempt to bind a listening socket to this port
 
         Return tuple of:
         available: True/False
         message: description of reason port isn't available"""
-        sock = socket.socket(socket.AF_INET, proto)
+        addr = self.get_interface().addr
+        sock = socket.socket(addr.family(), proto)
         try:
-            sock.bind((str(self.interface.addr), self.value))
+            sock.bind((str(addr), self.value))
             sock.close()
             return (True, '') # No error
         except socket.error, message: # Do this v2.5-compatible
@@ -1307,12 +3198,15 @@ class ConfigPortOption(ConfigOption):
                         (self.value, self.long_description))
                 return True # Cannot proceed with checks, but --force
         for proto in self.protos:
-            available, message = self.test_port_bind(proto)
+            available, message = self.port_available(proto)
             if not available:
                 # Unable to bind to port
                 print ("Error: Unable to bind to %s port %d for %s: %s" %
                         (self.proto_text(proto), self.value,
                             self.description, message))
+                if self.configurable and PortIndex.shared().readable:
+                    print ("Nearest free %s ports: %s" %
+                            (self.proto_text(proto), self.suggest_ports(proto)))
                 if not self.runmode.force:
                     if self.configurable:
                         return self.prompt()
@@ -1323,6 +3217,171 @@ class ConfigPortOption(ConfigOption):
                         return False
                 # force mode can keep going on this failure
         return True # Port is satisfactory
+    def probe(self):
+        findings = {'addr': str(self.get_interface().addr), 'port': self.value}
+        if not isinstance(self.value, int) or not 0 < self.value <= 65535:
+            # check() will complain about this
+            return findings
+        for proto in self.protos:
+            available, message = self.port_available(proto)
+            if available:
+                findings[self.proto_text(proto)] = 'free'
+            else:
+                findings[self.proto_text(proto)] = str(message)
+        return findings
+
+def parse_cpulist(cpulist):
+    """Expand a sysfs cpulist like '0-3,8-11' into a list of ints."""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def read_sys(path, default=None):
+    """Return the stripped contents of a small sysfs/procfs file, or
+    default if it can't be read."""
+    try:
+        with open(path) as sys_file:
+            return sys_file.read().strip()
+    except IOError:
+        return default
+
+class NumaNode(object):
+    """A NUMA node: its CPUs and local memory."""
+    def __repr__(self):
+        return "<NumaNode %d: %d CPUs, %d MiB>" % (self.node_id,
+                len(self.cpus), self.mem_mib)
+    def __init__(self, node_id, cpus, mem_mib):
+        self.node_id = node_id
+        self.cpus = cpus
+        self.mem_mib = mem_mib
+
+class HardwareTopology(object):
+    """CPU and memory layout of this machine, from sysfs.
+
+    Used to recommend NODE_MEMORY which fits evenly into every NUMA node's
+    local memory, and CPU_CORES counts which skip SMT siblings and cores
+    busy with device interrupts. Use HardwareTopology.shared() to get the
+    common instance."""
+    instance = None
+    def __init__(self, node_path=SYS_NODE_PATH, cpu_path=SYS_CPU_PATH,
+            interrupts_path=PROC_INTERRUPTS_PATH):
+        self.node_path = node_path
+        self.cpu_path = cpu_path
+        self.numa_nodes = []
+        self.cpus = parse_cpulist(read_sys(os.path.join(cpu_path, 'online'),
+            ''))
+        self.siblings = {} # cpu: tuple of its SMT sibling cpus (and itself)
+        self.cores = {} # (package, core id): list of cpus
+        self.irq_counts = {} # cpu: device interrupts handled
+        self.read_nodes()
+        self.read_cpus()
+        self.read_interrupts(interrupts_path)
+    @classmethod
+    def shared(cls):
+        """Return the process-wide HardwareTopology, created on first use."""
+        if not cls.instance:
+            cls.instance = cls()
+        return cls.instance
+    def read_nodes(self):
+        for node_dir in glob.glob(os.path.join(self.node_path, 'node[0-9]*')):
+            node_id = int(os.path.basename(node_dir)[4:])
+            cpus = parse_cpulist(read_sys(os.path.join(node_dir, 'cpulist'),
+                ''))
+            mem_mib = 0
+            # Lines look like:
+            #   Node 0 MemTotal:       16314540 kB
+            meminfo = read_sys(os.path.join(node_dir, 'meminfo'), '')
+            for line in meminfo.split('\n'):
+                line = line.split()
+                if len(line) >= 4 and line[2] == 'MemTotal:':
+                    mem_mib = int(line[3]) / 1024
+            self.numa_nodes.append(NumaNode(node_id, cpus, mem_mib))
+        self.numa_nodes.sort(key=lambda node: node.node_id)
+    def read_cpus(self):
+        for cpu in self.cpus:
+            topology = os.path.join(self.cpu_path, 'cpu%d' % cpu, 'topology')
+            siblings = read_sys(os.path.join(topology,
+                'thread_siblings_list'))
+            if siblings:
+                self.siblings[cpu] = tuple(parse_cpulist(siblings))
+            else:
+                self.siblings[cpu] = (cpu,)
+            core = (read_sys(os.path.join(topology, 'physical_package_id')),
+                    read_sys(os.path.join(topology, 'core_id'), str(cpu)))
+            self.cores.setdefault(core, []).append(cpu)
+    def read_interrupts(self, path):
+        """Total up device interrupts per CPU from /proc/interrupts."""
+        # Looks like:
+        #            CPU0       CPU1
+        #   24:    12345          0   PCI-MSI 524288-edge      eth0
+        #  LOC:   987654     876543   Local timer interrupts
+        lines = read_sys(path, '').split('\n')
+        columns = [int(x[3:]) for x in lines[0].split() if x.startswith('CPU')]
+        for line in lines[1:]:
+            fields = line.split()
+            if not fields or not fields[0].rstrip(':').isdigit():
+                # Per-CPU system interrupts (LOC, RES...) are everywhere
+                continue
+            for cpu, count in zip(columns, fields[1:]):
+                if not count.isdigit():
+                    break
+                self.irq_counts[cpu] = self.irq_counts.get(cpu, 0) + int(count)
+    def virtual(self):
+        """True if we're running under a hypervisor."""
+        if os.path.exists('/sys/hypervisor/type'):
+            return True
+        for line in read_sys('/proc/cpuinfo', '').split('\n'):
+            if line.startswith('flags'):
+                return 'hypervisor' in line.split()
+        return False
+    def smt(self):
+        """True if any core runs more than one hardware thread."""
+        return len(self.cores) < len(self.cpus)
+    def irq_cpus(self):
+        """Return the set of CPUs handling a real share of device
+        interrupts."""
+        total = sum(self.irq_counts.values())
+        if not total:
+            return set()
+        return set([cpu for cpu, count in self.irq_counts.items()
+            if count > total * IRQ_CPU_SHARE])
+    def physical_cores(self):
+        """Number of cores, counting SMT siblings once."""
+        return len(self.cores)
+    def irq_free_cores(self):
+        """Number of cores none of whose threads handle device
+        interrupts."""
+        busy = self.irq_cpus()
+        return len([cpus for cpus in self.cores.values()
+            if not busy.intersection(cpus)])
+    def balanced_memory(self, reserve_mib):
+        """Return the most memory (MiB) clxnode can use while taking the
+        same amount from every NUMA node's local memory, leaving reserve_mib
+        spread over the nodes for the OS. None without multiple nodes."""
+        nodes = [node for node in self.numa_nodes if node.mem_mib]
+        if len(nodes) < 2:
+            return None
+        per_node = min([node.mem_mib for node in nodes]) - \
+                reserve_mib / len(nodes)
+        return int(per_node) * len(nodes)
+    def summary(self):
+        """Return a description of the topology as lines of text."""
+        lines = []
+        if len(self.numa_nodes) > 1:
+            lines.append("NUMA nodes: %s" % ', '.join(["node%d %d MiB "
+                "(CPUs %d)" % (node.node_id, node.mem_mib, len(node.cpus))
+                for node in self.numa_nodes]))
+        lines.append("CPUs: %d threads on %d physical cores, %d cores free "
+                "of device interrupts" % (len(self.cpus),
+                    self.physical_cores(), self.irq_free_cores()))
+        return lines
 
 class ConfigMemOption(ConfigOption):
     """Memory Config Option, there should never be more than one instance
@@ -1332,11 +3391,7 @@ class ConfigMemOption(ConfigOption):
         machine has enough memory, otherwise we quit. It's done here so it
         will happen as early as possible."""
         ConfigOption.__init__(self, *args, **kwargs)
-        self.max_redo = 1024 #MiB, Default
-        for opt in self.options:
-            if opt.variable_name == "MAX_REDO":
-                # Look this up if available
-                self.max_redo = opt.value
+        self.max_redo = self.get_max_redo()
         self.memtotal = None
         with open('/proc/meminfo') as meminfo:
             for line in meminfo.read().split('\n'):
@@ -1358,7 +3413,20 @@ class ConfigMemOption(ConfigOption):
                     (self.min_sys_ram, self.memtotal))
             exit(1)
         self.default = int(self.memtotal - self.min_reserve_ram)
+        # On NUMA machines, take an equal share of every node's memory,
+        #   so that no node has to satisfy clxnode allocations remotely:
+        self.topology = HardwareTopology.shared()
+        self.numa_default = self.topology.balanced_memory(self.min_reserve_ram)
+        if self.numa_default and MINIMUM_CLX_RAM <= self.numa_default < \
+                self.default:
+            self.default = self.numa_default
         self.value = self.default
+    def get_max_redo(self):
+        """Return MAX_REDO in MiB, which must be created before us."""
+        max_redo = self.get_var('MAX_REDO')
+        if not max_redo:
+            return 1024 #MiB, Default
+        return int(max_redo.value)
     def set_value(self, value):
         """Cast user input to int type, otherwise set value to None,
         which check() will handle properly."""
@@ -1371,6 +3439,10 @@ class ConfigMemOption(ConfigOption):
     def check(self):
         """Ensure that we've got a valid value and that we still have enough
         system memory."""
+        # MAX_REDO may have changed since __init__:
+        self.max_redo = self.get_max_redo()
+        self.min_reserve_ram = MINIMUM_OS_RAM + self.max_redo
+        self.min_sys_ram = MINIMUM_CLX_RAM + self.min_reserve_ram
         if self.memtotal < self.min_sys_ram:
             # This should have been caught during __init__, just double check
             print ("Fatal Error: This system does not have enough memory "
@@ -1401,9 +3473,44 @@ class ConfigMemOption(ConfigOption):
     def human_arbitrary_value(self, value):
         """Add units to the value."""
         return "%s MiB" % self.value
+    def config_comments(self):
+        """Record the NUMA layout behind our default."""
+        if not self.numa_default:
+            return []
+        return ["%d NUMA nodes, %d MiB per node fits every node's local "
+                "memory" % (len(self.topology.numa_nodes),
+                    self.numa_default / len(self.topology.numa_nodes))]
+    def dependencies(self):
+        return ['MAX_REDO']
+    def probe(self):
+        return {'memtotal_mib': int(self.memtotal)}
 
 
 class ConfigCoresOption(ConfigOption):
+    """CPU core count, which may also be chosen from the hardware topology:
+    'physical' counts each SMT core once, and 'irq-free' also skips cores
+    which handle device interrupts."""
+    def __init__(self, *args, **kwargs):
+        ConfigOption.__init__(self, *args, **kwargs)
+        self.topology = HardwareTopology.shared()
+    def recommendations(self):
+        """Return a dict of keyword: core count suggested by the topology."""
+        recommended = {}
+        if self.topology.smt():
+            recommended['physical'] = self.topology.physical_cores()
+        irq_free = self.topology.irq_free_cores()
+        if 0 < irq_free < self.topology.physical_cores():
+            recommended['irq-free'] = irq_free
+        return recommended
+    def prompt_str(self):
+        recommended = self.recommendations()
+        if not recommended:
+            return ConfigOption.prompt_str(self)
+        choices = ', '.join(["'%s' for %d" % item for item in
+            sorted(recommended.items())])
+        return ("Please enter choice for %s, or %s [Default: %s]: " %
+                (self.long_description, choices,
+                    self.human_arbitrary_value(self.default)))
     def human_arbitrary_value(self, value):
         # Make default of 0 look better:
         if self.value in (0, '0'):
@@ -1415,8 +3522,11 @@ class ConfigCoresOption(ConfigOption):
         return self.prompt()
     def set_value(self, value):
         # At this point value will always be a string
+        recommended = self.recommendations()
         if value.lower() in ('max', 'maximum', 'all'):
             ConfigOption.set_value(self, '0')
+        elif value.lower() in recommended:
+            ConfigOption.set_value(self, str(recommended[value.lower()]))
         else:
             # See if we got a number here
             try:
@@ -1430,6 +3540,9 @@ class ConfigCoresOption(ConfigOption):
         if self.value in (0, '0', 'All'):
             return True
         return False
+    def config_comments(self):
+        """Record the CPU topology next to the core count."""
+        return self.topology.summary()[-1:]
 
 
 class SSHConfigAttr(object):
@@ -1573,16 +3686,8 @@ class ConfigSSHOption(ConfigBoolOption):
                 new_conf.append("# Added by ClustrixDB Installer at %s:"
                         % isodate())
                 new_conf.append("%s %s" % (attr.key, attr.desired_value))
-            # create backup of current file:
-            conf_stat = os.stat(path)
-            os.rename(path, "%s.bak" % path)
-            conf_file = open(path, 'w')
-            conf_file.write('\n'.join(new_conf) + '\n')
-            conf_file.close()
-            os.chmod(path, conf_stat[0]) # Apply previous mode
-            # Apply previous uid and guid:
-            os.chown(path, conf_stat[4], conf_stat[5])
-            return True # Conf File Modified
+            # Keeps a backup of the current file:
+            return atomic_write(path, '\n'.join(new_conf) + '\n', backup=True)
         return False # Conf File not Modified
     def write(self):
         """Apply sshd config changes to the filesystem, as necessary."""
@@ -1631,17 +3736,115 @@ class ConfigSSHOption(ConfigBoolOption):
             #   move on without doing anything here.
             pass
 
+class SysctlAttr(object):
+    """A single sysctl setting, and the rule for combining it with the
+    value already set on the system."""
+    def __repr__(self):
+        return "<SysctlAttr %s %s %s>" % (self.key, self.rule, self.value)
+    def __init__(self, key, value, rule='min'):
+        self.key = key
+        self.value = ' '.join(str(value).split())
+        self.rule = rule
+    def proc_path(self):
+        return os.path.join(PROC_SYS_PATH, *self.key.split('.'))
+    def read_live(self):
+        """Return the value on the running system, None if the kernel
+        doesn't have this setting."""
+        value = read_sys(self.proc_path())
+        if value is None:
+            return None
+        return ' '.join(value.split())
+    def target(self, current):
+        """Return the value to set, given the current one."""
+        if current is None or self.rule == 'exact':
+            return self.value
+        ours = self.value.split()
+        theirs = current.split()
+        if len(ours) != len(theirs):
+            return self.value
+        try:
+            if self.rule == 'min':
+                fields = [max(int(x), int(y)) for x, y in zip(ours, theirs)]
+            else:
+                fields = [min(int(x), int(y)) for x, y in zip(ours, theirs)]
+        except ValueError:
+            # Something did not cast to an int, to be safe use ours
+            return self.value
+        return ' '.join([str(x) for x in fields])
+    def satisfied_by(self, current):
+        return current is not None and \
+                self.target(current) == ' '.join(current.split())
+
+def sysctl_profiles(topology, memtotal, virtual, role=DEFAULT_SYSCTL_ROLE):
+    """Return the names of the SYSCTL_PROFILES which apply to this node,
+    given its hardware and role (one of SYSCTL_ROLES)."""
+    profiles = ['base']
+    if virtual:
+        profiles.append('virtual')
+    else:
+        profiles.append('bare-metal')
+    if memtotal >= LARGE_MEMORY_MIB:
+        profiles.append('large-memory')
+    else:
+        profiles.append('small-memory')
+    if len(topology.numa_nodes) > 1:
+        profiles.append('numa')
+    profiles.append(role)
+    return profiles
+
+def sysctl_attrs(profiles):
+    """Combine profiles into a dict of key: SysctlAttr, later profiles
+    overriding earlier ones."""
+    attrs = {}
+    for profile in profiles:
+        for key, (value, rule) in SYSCTL_PROFILES[profile].items():
+            attrs[key] = SysctlAttr(key, value, rule)
+    return attrs
+
 class SysctlConfig(object):
     """Class to update sysctl.conf and running sysctl settings."""
     def __init__(self, path, attrs):
         self.path = path
-        self.attrs = attrs
+        self.attrs = {}
+        for key, attr in attrs.items():
+            if not isinstance(attr, SysctlAttr):
+                attr = SysctlAttr(key, attr)
+            if attr.read_live() is None:
+                # sysctl -p would fail on it at boot
+                print "Note: Kernel has no sysctl %s, skipping it." % key
+                continue
+            self.attrs[key] = attr
+    def diff(self):
+        """Return a list of (key, live value, value to set) for every
+        setting which needs to change on the running system."""
+        changes = []
+        for key, attr in sorted(self.attrs.items()):
+            live = attr.read_live()
+            if not attr.satisfied_by(live):
+                changes.append((key, live, attr.target(live)))
+        return changes
+    def apply(self):
+        """Set each attribute on the running system through /proc/sys,
+        which is what the sysctl command does too."""
+        for key, live, value in self.diff():
+            try:
+                with open(self.attrs[key].proc_path(), 'w') as proc_file:
+                    proc_file.write(value + '\n')
+            except IOError, e:
+                print "Warning: Unable to set sysctl %s = %s: %s" % (key,
+                        value, e)
+    def verify(self):
+        """Read back the running values, returning a list of strings
+        describing any that did not take."""
+        return ["sysctl %s is %s, expected %s" % (key, live, value)
+                for key, live, value in self.diff()]
     def write(self):
-        """Modifies sysctl.conf as necessary, then runs the sysctl
-        command to explicitly set each attribute on the running system."""
+        """Modifies sysctl.conf as necessary, then sets each attribute on
+        the running system and checks that it took."""
         current_conf = open(self.path).read().split('\n')
         new_conf = []
         remaining_attrs = self.attrs.keys()
+        modified = False
         # Example Lines:
         #   # Useful for debugging multi-threaded applications.
         #   kernel.core_uses_pid = 1
@@ -1662,53 +3865,134 @@ class SysctlConfig(object):
                 # We don't care about this attribute
                 new_conf.append(line)
                 continue
-            if self.attrs[key] == value:
-                # This line already set correctly
-                remaining_attrs.remove(key)
+            if self.attrs[key].satisfied_by(value):
+                # This line already set correctly, or better than ours
+                if key in remaining_attrs:
+                    remaining_attrs.remove(key)
                 new_conf.append(line)
                 continue
-            if self.attrs[key] == '0':
-                # 0 is the only exception to the <= rule below
-                # Comment out whatever non-zero value we have
-                new_conf.append("# Line commented by ClustrixDB Installer "
-                        "at %s:" % isodate())
-                new_conf.append('# %s' % stripped_line)
-                continue
-            try:
-                if int(self.attrs[key]) <= int(value):
-                    # Current value greater than ours, keep it
-                    remaining_attrs.remove(key)
-                    new_conf.append(line)
-                    continue
-            except ValueError:
-                # Something did not cast to an int, to be safe
-                #   we will comment the line
-                new_conf.append("# Line commented by ClustrixDB Installer "
-                        "at %s:" % isodate())
-                new_conf.append('# %s' % stripped_line)
-            # If we've got to this point the line is a mismatch, comment it:
+            # If we've got to this point the line is a mismatch, comment it,
+            #   even after a line which satisfied us, since the last line
+            #   for a key wins at boot:
+            modified = True
             new_conf.append("# Line commented by ClustrixDB Installer "
                     "at %s:" % isodate())
             new_conf.append('# %s' % stripped_line)
         # We've pulled out all conflicting values from the file, now add ours:
-        for key in remaining_attrs:
+        for key in sorted(remaining_attrs):
+            attr = self.attrs[key]
             new_conf.append("# Line added by ClustrixDB Installer "
                     "at %s:" % isodate())
-            new_conf.append("%s = %s" % (key, self.attrs[key]))
-            # sysctl.conf only takes effect on boot, so modify each attr
-            #   manually too:
-            subprocess.call("sysctl %s=%s > /dev/null" % (key,
-                self.attrs[key]), shell=True)
-        # create backup of current file:
-        conf_stat = os.stat(self.path)
-        os.rename(self.path, "%s.bak" % self.path)
-        conf_file = open(self.path, 'w')
-        conf_file.write('\n'.join(new_conf) + '\n')
-        conf_file.close()
-        os.chmod(self.path, conf_stat[0]) # Apply previous mode
-        # Apply previous uid and guid:
-        os.chown(self.path, conf_stat[4], conf_stat[5])
-        return bool(remaining_attrs) # Indicate whether we modified the file
+            new_conf.append("%s = %s" % (key, attr.target(attr.read_live())))
+        # sysctl.conf only takes effect on boot, so set the running values
+        #   too:
+        self.apply()
+        for problem in self.verify():
+            print "Warning: %s." % problem
+        if not remaining_attrs and not modified:
+            return False
+        # Keeps a backup of the current file, True if we modified it:
+        return atomic_write(self.path, '\n'.join(new_conf) + '\n',
+                backup=True)
+
+def read_meminfo(path=PROC_MEMINFO_PATH):
+    """Return /proc/meminfo as a dict of name: int (kB, or a count for
+    the HugePages_* lines)."""
+    meminfo = {}
+    for line in read_sys(path, '').split('\n'):
+        line = line.split()
+        if len(line) >= 2 and line[0].endswith(':'):
+            meminfo[line[0][:-1]] = int(line[1])
+    return meminfo
+
+class HugePagePlan(object):
+    """How many huge pages NODE_MEMORY needs, how many this machine has
+    and how many more it could reserve right now."""
+    def __init__(self, mem_mib, topology=None):
+        self.mem_mib = mem_mib
+        self.topology = topology or HardwareTopology.shared()
+        self.refresh()
+    def refresh(self):
+        meminfo = read_meminfo()
+        self.page_kib = meminfo.get('Hugepagesize', 2048)
+        self.total = meminfo.get('HugePages_Total', 0)
+        self.free = meminfo.get('HugePages_Free', 0)
+        self.mem_free_kib = meminfo.get('MemFree', 0)
+        # Round up, so clxnode never comes up a page short:
+        self.needed = -(-self.mem_mib * 1024 // self.page_kib)
+        self.buddy_pages = self.read_buddyinfo()
+    def read_buddyinfo(self):
+        """Count the huge pages which could be carved out of free memory
+        without compaction, per NUMA node."""
+        # Lines look like:
+        #   Node 0, zone   Normal   3162   1930    504 ...
+        # with a count of free blocks of 2**order base pages per column.
+        base_kib = os.sysconf('SC_PAGE_SIZE') / 1024
+        order = 0
+        while base_kib << order < self.page_kib:
+            order += 1
+        pages = {}
+        for line in read_sys(PROC_BUDDYINFO_PATH, '').split('\n'):
+            fields = line.replace(',', ' ').split()
+            if len(fields) < 5 or fields[0] != 'Node':
+                continue
+            node = int(fields[1])
+            counts = [int(x) for x in fields[4:]]
+            pages[node] = pages.get(node, 0) + sum([count << (x - order)
+                for x, count in enumerate(counts) if x >= order])
+        return pages
+    def node_pages(self):
+        """Return a dict of NUMA node id: huge pages reserved there."""
+        pages = {}
+        for node in self.topology.numa_nodes:
+            count = read_sys(os.path.join(self.topology.node_path,
+                'node%d' % node.node_id, 'hugepages',
+                'hugepages-%dkB' % self.page_kib, 'nr_hugepages'))
+            if count is not None:
+                pages[node.node_id] = int(count)
+        return pages
+    def reservable(self):
+        """Huge pages we could have in total without compacting memory."""
+        return self.total + sum(self.buddy_pages.values())
+    def fragmentation(self):
+        """Percent of free memory in blocks too small for a huge page."""
+        if not self.mem_free_kib:
+            return 0.0
+        usable = sum(self.buddy_pages.values()) * self.page_kib
+        return max(0.0, 100.0 - 100.0 * usable / self.mem_free_kib)
+    def reserve(self):
+        """Ask the kernel for the pages we need, compacting memory once if
+        the first attempt comes up short. Returns pages now reserved."""
+        if self.total >= self.needed:
+            return self.total
+        for attempt in (1, 2):
+            try:
+                with open(NR_HUGEPAGES_PATH, 'w') as nr_hugepages:
+                    nr_hugepages.write('%d\n' % self.needed)
+            except IOError, e:
+                print "Warning: Unable to reserve huge pages: %s" % e
+                break
+            self.refresh()
+            if self.total >= self.needed or attempt == 2:
+                break
+            try:
+                with open(COMPACT_MEMORY_PATH, 'w') as compact:
+                    compact.write('1\n')
+            except IOError:
+                break # No compaction in this kernel, nothing more to try
+        return self.total
+    def summary(self):
+        """Return the plan as lines of text."""
+        lines = ["Huge pages: %d x %d kB needed for %d MiB, %d reserved, "
+                "%d more free without compaction (%.0f%% of free memory "
+                "fragmented)" % (self.needed, self.page_kib, self.mem_mib,
+                    self.total, sum(self.buddy_pages.values()),
+                    self.fragmentation())]
+        node_pages = self.node_pages()
+        if len(node_pages) > 1:
+            lines.append("Huge pages per NUMA node: %s" % ', '.join([
+                "node%d %d" % item for item in sorted(node_pages.items())]))
+        return lines
 
 class ConfigHugeTLBOption(ConfigBoolOption):
     """Configure option for HugeTLB, to be used by hugetlb.init.
@@ -1737,7 +4021,42 @@ class ConfigHugeTLBOption(ConfigBoolOption):
             self.value = bool_prompt("Enabling HugeTLB on this system is not "
                     "recommended, as it may cause instability. Please confirm "
                     "that you want to run an unstable configuration", False)
+        if self.value:
+            plan = self.plan()
+            if plan.reservable() < plan.needed:
+                print ("Warning: Only %d of the %d huge pages needed for "
+                        "ClustrixDB can be reserved now, %.0f%% of free "
+                        "memory is fragmented. ClustrixDB will fall back to "
+                        "regular pages unless more are reserved at boot." %
+                        (plan.reservable(), plan.needed,
+                            plan.fragmentation()))
         return True
+    def dependencies(self):
+        return ['NODE_MEMORY']
+    def plan(self):
+        """Return a HugePagePlan for the configured NODE_MEMORY."""
+        return HugePagePlan(int(self.get_var('NODE_MEMORY').value))
+    def config_comments(self):
+        if not self.value:
+            return []
+        return self.plan().summary()
+    def write(self):
+        """Reserve huge pages for NODE_MEMORY on the running system.
+        Returns sysctl attrs which keep the reservation across reboots."""
+        plan = self.plan()
+        reserved = plan.reserve()
+        if reserved < plan.needed:
+            print ("Warning: Reserved %d of %d huge pages, ClustrixDB will use "
+                    "regular pages for the rest until the next reboot." %
+                    (reserved, plan.needed))
+        node_pages = plan.node_pages()
+        if len(node_pages) > 1:
+            share = plan.needed / len(node_pages)
+            for node, count in sorted(node_pages.items()):
+                if count < share:
+                    print ("Warning: NUMA node %d has %d huge pages, less "
+                            "than its share of %d." % (node, count, share))
+        return {'vm.nr_hugepages': SysctlAttr('vm.nr_hugepages', plan.needed)}
     def is_default(self):
         # Overload this so that ConfigFile.write() uncomments our variable
         #   when self.value is True, ignoring the default value
@@ -1754,7 +4073,7 @@ class ConfigHugeTLBOption(ConfigBoolOption):
         #   then that is treated as True
         self.value = True
         self.is_set = True
-    def mkarg(self, no_defaults=False):
+    def mkarg(self, no_defaults=False, placeholders=True):
         # If HUGETLB is missing from the config, but it defaults to ON,
         #   then we need to add the --toggle-hugetlb flag
         if self.loaded_from_file and not self.is_set and self.default == True:
@@ -1763,6 +4082,121 @@ class ConfigHugeTLBOption(ConfigBoolOption):
             # Option was changed manually
             return "--%s" % self.option_name
 
+class PreflightResult(object):
+    """Outcome of a single option's probe(), for the preflight report."""
+    def __repr__(self):
+        return "<PreflightResult %s: %s>" % (self.option.variable_name,
+                self.status())
+    def __init__(self, option):
+        self.option = option
+        self.findings = {}
+        self.error = None
+        self.seconds = None
+    def status(self):
+        if self.error:
+            return 'error'
+        return 'ok'
+    def details(self):
+        if self.error:
+            return self.error
+        return ', '.join(['%s=%s' % item for item in
+            sorted(self.findings.items())])
+
+class Preflight(object):
+    """Run probe() for many options at once in a pool of threads,
+    starting each option only after the options it depends on.
+
+    Probes only gather facts and warm caches; check() still makes the
+    decisions (and asks the questions) one option at a time afterwards."""
+    def __init__(self, options, workers=PREFLIGHT_WORKERS):
+        self.options = list(options)
+        self.workers = workers
+        self.results = {}
+        for opt in self.options:
+            self.results[opt.variable_name] = PreflightResult(opt)
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.waiting = {} # variable_name: set of unfinished dependencies
+        self.remaining = 0
+        self.seconds = None
+    def plan(self):
+        """Fill self.waiting, dropping dependencies on options we aren't
+        running and breaking any cycles so that everything gets run."""
+        for opt in self.options:
+            self.waiting[opt.variable_name] = set([x for x in
+                opt.dependencies() if x in self.results and
+                x != opt.variable_name])
+        pending = dict([(k, set(v)) for k, v in self.waiting.items()])
+        while pending:
+            ready = [k for k, v in pending.items() if not v]
+            if not ready:
+                # Cycle, run what's left as if it were independent
+                for name in pending:
+                    self.waiting[name] = set()
+                break
+            for name in ready:
+                del pending[name]
+            for deps in pending.values():
+                deps.difference_update(ready)
+    def run_probe(self, name):
+        result = self.results[name]
+        t0 = time.time()
+        try:
+            result.findings = result.option.probe()
+        except Exception, e:
+            # A probe failure isn't fatal, check() will run into it again
+            #   and deal with it interactively
+            result.error = "%s: %s" % (e.__class__.__name__, e)
+        result.seconds = time.time() - t0
+    def worker(self):
+        while True:
+            name = self.queue.get()
+            if name is None:
+                return
+            self.run_probe(name)
+            with self.lock:
+                self.remaining -= 1
+                for other, deps in self.waiting.items():
+                    if name in deps:
+                        deps.discard(name)
+                        if not deps:
+                            self.queue.put(other)
+                if not self.remaining:
+                    for x in range(self.workers):
+                        self.queue.put(None) # Tell workers to exit
+    def run(self):
+        """Probe every option, return the list of PreflightResults in
+        option order."""
+        t0 = time.time()
+        self.plan()
+        self.remaining = len(self.options)
+        if not self.remaining:
+            return []
+        for opt in self.options:
+            if not self.waiting[opt.variable_name]:
+                self.queue.put(opt.variable_name)
+        threads = [threading.Thread(target=self.worker)
+                for x in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(1) # With a timeout, so ^C still works
+        self.seconds = time.time() - t0
+        return self.report()
+    def report(self):
+        return [self.results[opt.variable_name] for opt in self.options]
+    def summary(self):
+        """Return the report as a human-readable table."""
+        lines = ["Preflight checks (%d options in %.2f seconds):" %
+                (len(self.options), self.seconds or 0)]
+        for result in self.report():
+            lines.append("  %-18s %-5s %6.2fs  %s" % (
+                result.option.variable_name, result.status(),
+                result.seconds or 0, result.details()))
+        return '\n'.join(lines)
+
 class ClxnodeVersion(object):
     """Simple class to store and compare versions of clxnode."""
     def __str__(self):
@@ -1806,11 +4240,11 @@ def get_included_clxnode():
         if 'clxnode' in clxnode_glob:
             break
     # glob will now match the clxnode RPM:
-    clxnode_rpm = glob.glob(clxnode_glob)
+    clxnode_rpm = find_rpm(clxnode_glob)
     if not clxnode_rpm:
         # No RPM found
         return None
-    clxnode_rpm = clxnode_rpm[0] # Pick the first RPM we find
+    clxnode_rpm = os.path.basename(clxnode_rpm)
     # File name looks like:
     # clustrix-clxnode-purelicense-mainline1-9868.x86_64.rpm
     # clustrix-clxnode-purelicense-v5.1-9868.x86_64.rpm
@@ -1837,29 +4271,61 @@ RunFlag('skip-rpms', False, "Do not automatically install ClustrixDB "
     "RPMs located in the current directory. Implies --no-autorun.")
 RunFlag('reconfigure', False, "Change configuration options on existing "
         "ClustrixDB Installation. Implies --load-config")
+RunFlag('rolling', False, "Reconfigure without stopping ClustrixDB "
+        "while options are validated; it is only stopped to restart with "
+        "the new config. Ports held by ClustrixDB itself count as free. "
+        "Implies --reconfigure.")
 RunFlag('no-autorun', False, "Do not automatically start ClustrixDB "
         "service after installation.")
+RunFlag('benchmark-storage', False, "Measure sequential write, fsync "
+        "latency and random IO performance of the storage under the data "
+        "and log paths, and warn if it looks too slow for ClustrixDB. "
+        "Results are recorded in %s." % CONFIG_FILE_PATH)
+RunFlag('stage-rpms', False, "Copy the ClustrixDB RPMs into a local yum "
+        "repo in %s and exit, so that a later install does not need to "
+        "build it." % LOCAL_REPO_PATH)
+RunFlag('sysctl-dry-run', False, "Print the sysctl settings which would "
+        "be changed for the given options and exit, without changing "
+        "anything or stopping ClustrixDB.")
+RunValue('max-clock-offset-ms', "Fail, and don't start ClustrixDB, if this "
+        "node's clock is further than this many milliseconds from its time "
+        "source, unless --force is given [Default: %.0f]" %
+        NTP_MAX_OFFSET_MS, metavar='MS')
+RunValue('sysctl-role', "Tune sysctl for this node's role: 'frontend' if "
+        "clients connect to it directly, 'backend' if only other nodes or a "
+        "proxy do [Default: %s]" % DEFAULT_SYSCTL_ROLE, metavar='ROLE')
+RunValue('trace-file', "Write the time spent in each install phase, "
+        "option check and service probe to this file, as a Chrome trace "
+        "(JSON), and print a per-phase summary.", metavar='PATH')
+RunFlag('print-schema', False, "Print the JSON Schema of %s and exit." %
+        CONFIG_JSON_PATH)
 RunFlag('print-config', False, "Print the command required to configure "
         "another node to join this cluster and exit, without modifying the "
         "current running system.")
 
 
 # Config options are global
-ConfigMemOption("NODE_MEMORY", "Memory to use for ClustrixDB, in MiB",
-        1024, option_name="clxnode-mem", extra_help="Use %(variable_name)s "
-        "to specify how much memory (in MiB) to allocate for "
-        "ClustrixDB.")
+# MAX_REDO comes first, NODE_MEMORY's default depends on it
 ConfigOption("MAX_REDO", "Maximum ClustrixDB Redo Space, in MiB", 1024)
+# Sized from this node's RAM, so not copied to other nodes:
+ConfigMemOption("NODE_MEMORY", "Memory to use for ClustrixDB, in MiB",
+        1024, per_node=True, option_name="clxnode-mem",
+        extra_help="Use %(variable_name)s to specify how much memory (in "
+        "MiB) to allocate for ClustrixDB.")
 ConfigCoresOption("CPU_CORES", "CPU cores to use for ClustrixDB",
         'All', option_name="cpu-cores", extra_help="Use %(variable_name)s "
         "to limit the number of CPU cores used by ClustrixDB. Set equal "
-        "to or less than the licensed core count.")
+        "to or less than the licensed core count. 'physical' uses one "
+        "thread per core and 'irq-free' also skips cores handling device "
+        "interrupts.")
 #ConfigOption("CLUSTER_NAME", "Cluster Name", "clx", option_name="cluster-name")
-# Path globals must stay in the correct order, for references to work
+# Paths may reference paths created before them; checks run in dependency
+#   order, see OptionRegistry.topological_order()
 ConfigPathOption("DATA_PATH", "Database Storage", "/data/clustrix",
         option_name="data-path", min_free_space=MIN_FREE_SPACE,
-        valid_fs=VALID_FILESYSTEMS)
-ConfigPathOption("LOG_PATH", "Logs", "$DATA_PATH/log", option_name="log-path")
+        valid_fs=VALID_FILESYSTEMS, benchmark=True)
+ConfigPathOption("LOG_PATH", "Logs", "$DATA_PATH/log", option_name="log-path",
+        benchmark=True)
 ConfigPathOption("UI_LOGDIR", "WebUI Logs", "$LOG_PATH/clustrix_ui",
         option_name="ui-log-path")
 ConfigPathOption("UI_CACHEDIR", "WebUI Cache", "/var/cache/clustrix/django")
@@ -1906,8 +4372,20 @@ ConfigHugeTLBOption("HUGE_TLB_ENABLE", "Enable HugeTLB memory allocation "
         "especially in virtualized environments.")
 
 
+def node_sysctl_attrs():
+    """Return the SysctlAttrs of the profiles for this node's hardware
+    and role."""
+    topology = HardwareTopology.shared()
+    profiles = sysctl_profiles(topology,
+            ConfigOption.get_var('NODE_MEMORY').memtotal, topology.virtual(),
+            ConfigOption.runmode.sysctl_role.mode or DEFAULT_SYSCTL_ROLE)
+    print "Sysctl profiles: %s" % ', '.join(profiles)
+    return sysctl_attrs(profiles)
+
 def main():
     runmode = ConfigOption.runmode
+    timer = PhaseTimer.shared()
+    timer.phase('parse options')
     configfile = ConfigFile()
     if len(sys.argv) > 1 or not sys.stdout.isatty():
         # Wizard mode only implicit with no args:
@@ -1921,23 +4399,68 @@ def main():
         opt.mkoptparse(parser)
 
     (options, args) = parser.parse_args()
+    if runmode.trace_file:
+        # Written on every exit, so failed installs get traced too
+        atexit.register(timer.write_trace, runmode.trace_file.mode)
+    max_offset_ms = NTP_MAX_OFFSET_MS
+    if runmode.max_clock_offset_ms:
+        try:
+            max_offset_ms = float(runmode.max_clock_offset_ms.mode)
+        except ValueError:
+            parser.error("--max-clock-offset-ms must be a number.")
+    if runmode.sysctl_role and runmode.sysctl_role.mode not in SYSCTL_ROLES:
+        parser.error("--sysctl-role must be one of: %s." %
+                ', '.join(SYSCTL_ROLES))
 
-    if runmode.load_config or runmode.print_config:
-        # Read config file and apply any settings we find:
-        # Do this early so that print_config can exit before anything happens
+    if runmode.print_schema:
+        print json.dumps(config_schema(ConfigOption.options), sort_keys=True,
+                indent=1)
+        exit(0)
+
+    def load_config():
+        """Apply settings from the config file to every option which was
+        not given on the command line."""
+        timer.phase('load config')
         for file_opt in configfile.current_config:
             opt = ConfigOption.get_var(file_opt)
             if not opt:
                 # We have a value set in the file which isn't handled
                 #   by this script. Store it for later:
-                configfile.add_extra(opt)
+                configfile.add_extra(file_opt)
                 continue
-            opt.set_value(configfile.current_config[file_opt]) # Store Value
+            if opt.from_command_line:
+                continue # Changing this one is why we were run
+            # Store Value
+            opt.set_value(opt.from_config(configfile.current_config[file_opt]))
         ConfigOption.loaded_from_file = True
+    if runmode.rolling:
+        runmode.reconfigure = True
+    if (runmode.reconfigure or runmode.sysctl_dry_run) and \
+            os.path.exists(CLXNODE_PATH):
+        # Keep this node's settings for anything not on the command line,
+        #   the dry run plans HugeTLB pages from its NODE_MEMORY
+        runmode.load_config = True
+    if runmode.load_config or runmode.print_config:
+        # Read config file and apply any settings we find:
+        # Do this early so that print_config can exit before anything happens
+        load_config()
     if runmode.print_config:
         # Print the arg string required to configure another node and exit
         print ' '.join([x.mkarg(False) for x in ConfigOption.options if x.mkarg(False)])
         exit(0)
+    if runmode.sysctl_dry_run:
+        # Show what sysctl would change, before anything is touched
+        sysctl = SysctlConfig(SYSCTL_CONFIG_PATH, node_sysctl_attrs())
+        hugetlb_option = ConfigOption.get_var("HUGE_TLB_ENABLE")
+        if hugetlb_option.value:
+            sysctl.attrs['vm.nr_hugepages'] = SysctlAttr('vm.nr_hugepages',
+                    hugetlb_option.plan().needed)
+        changes = sysctl.diff()
+        for key, live, value in changes:
+            print "sysctl %s: %s -> %s" % (key, live, value)
+        if not changes:
+            print "All sysctl settings are already tuned."
+        exit(0)
 
     # Ensure we're running as root:
     # Don't run this earlier, otherwise we can't print --help as non-root
@@ -1945,7 +4468,18 @@ def main():
         print "Error: root privileges required to run."
         print "Please execute %s as root." % sys.argv[0]
         exit(1)
+    if runmode.stage_rpms:
+        # Only prepare the local repo, so a later install is quick
+        if not find_rpms():
+            print "Error: ClustrixDB RPMs not found."
+            exit(1)
+        if not LocalRepo().build():
+            print "Error: Unable to build local repo in %s." % LOCAL_REPO_PATH
+            exit(1)
+        print "ClustrixDB RPMs staged in %s." % LOCAL_REPO_PATH
+        exit(0)
 
+    timer.phase('version check')
     current_clxnode = get_current_clxnode()
     included_clxnode = get_included_clxnode()
     if current_clxnode and included_clxnode:
@@ -1960,6 +4494,31 @@ def main():
         else:
             # Same version, subsequent run
             print "Clustrix version %s already installed." % current_clxnode
+    # If the last complete run was asked for exactly this, and nothing it
+    #   wrote has been touched since, there is nothing to do:
+    manifest = StateManifest()
+    def run_inputs(current):
+        """What a run is asked to do. The options are recorded as they end
+        up after configuration, and compared as they are before it, so a
+        rerun only skips if it would configure the same values."""
+        return {'argv': sys.argv[1:], 'options': [(x.variable_name,
+            str(x.config_string())) for x in ConfigOption.options],
+            'included': str(included_clxnode), 'current': str(current)}
+    run_outputs = [CONFIG_FILE_PATH, CONFIG_JSON_PATH, SYSCTL_CONFIG_PATH,
+            SSHD_CONFIG_PATH, SSH_CLIENT_CONFIG_PATH, ROOT_SHOSTS_PATH]
+    # Reconfiguring with a single option, like --reconfigure on its own,
+    #   turns on the wizard below:
+    wizard_next = current_clxnode and len(sys.argv) == 2
+    fast_path = not (runmode.wizard or wizard_next or runmode.force or
+            runmode.benchmark_storage)
+    if fast_path and manifest.is_current('run', run_inputs(current_clxnode),
+            run_outputs):
+        # A crashed or stopped node still needs the restart below
+        if runmode.no_autorun or clustrix_running():
+            print "Nothing has changed since the last run, nothing to do."
+            exit(0)
+        print "Nothing has changed since the last run, but ClustrixDB is " \
+                "not running."
     if current_clxnode and not runmode.reconfigure:
         # Prompt to reconfigure or quit now:
         reconfig = bool_prompt("\nReconfigure ClustrixDB? Enter Y to "
@@ -1978,16 +4537,21 @@ def main():
             # This implies --load-config and --skip-rpms
             runmode.load_config = True
             runmode.skip_rpms = True
+            if not ConfigOption.loaded_from_file:
+                # Only decided at the prompt above
+                load_config()
             if not runmode.wizard and len(sys.argv) == 2:
                 # --reconfigure was the only option, enable wizard mode
                 runmode.wizard = True
 
 
-    if runmode.reconfigure:
+    if runmode.reconfigure and not runmode.rolling:
         # We don't want clxnode tieing up the various ports when we check them
         #   to make sure they're available.
+        timer.phase('service stop')
         initctl_clustrix('stop')
     # Iterate through options to get user input and validate:
+    timer.phase('configure')
     if runmode.wizard:
         while not ConfigOption.configured:
             print "Starting ClustrixDB Install Wizard...\n"
@@ -2016,7 +4580,7 @@ def main():
                         elif user_input.lower() in ('q', 'quit'):
                             # Exit now
                             print "Quitting ClustrixDB Installer..."
-                            if runmode.reconfigure:
+                            if runmode.reconfigure and not runmode.rolling:
                                 socket_path = ConfigOption.get_var('UNIX_SOCKET_PATH').value
                                 http_port = ConfigOption.get_var('HTTP_PORT').value
                                 private_ip = ConfigOption.get_var('BACKEND_ADDR').value
@@ -2048,11 +4612,24 @@ def main():
                         display_license()
                         break # Re-print config list and original prompt
                     # Now we have an actual config option selected, go for a prompt:
-                    user_options[selection].prompt() # Use return value?
+                    ConfigOption.configured = True # Until check() declines it
+                    if user_options[selection].prompt() and \
+                            ConfigOption.configured:
+                        # prompt() ran check() on the new value, and the
+                        #   user accepted it
+                        ConfigOption.options.mark_checked(
+                                user_options[selection])
                     break # Re-print the config list and original prompt
             ConfigOption.configured = True # Until a later .check() sets it to false
-            for opt in ConfigOption.options:
-                if not opt.check():
+            # Only check options which changed, or depend on ones which did,
+            #   since they last passed check():
+            stale = ConfigOption.options.stale()
+            with timer.span('preflight', 'check'):
+                Preflight(stale).run()
+            for opt in stale:
+                with timer.span('check %s' % opt.variable_name, 'check'):
+                    ok = opt.check()
+                if not ok:
                     # The check() method returns False if it is unable to make a
                     #   minimally-functional configuration choice.
                     # This will almost never happen - either the user will
@@ -2064,39 +4641,87 @@ def main():
                 if not ConfigOption.configured:
                     # Some .check() wants us to go back to the main menu
                     break
+                ConfigOption.options.mark_checked(opt)
     else: # not runmode.wizard
+        # Probe every option at once first, so that the slow filesystem
+        #   and network probes overlap and check() mostly hits the cache:
+        with timer.span('preflight', 'check'):
+            preflight = Preflight(ConfigOption.options)
+            preflight.run()
+        print preflight.summary()
         # We still need to run the check() loop here
-        for opt in ConfigOption.options:
-            if not opt.check():
+        for opt in ConfigOption.options.topological_order():
+            with timer.span('check %s' % opt.variable_name, 'check'):
+                ok = opt.check()
+            if not ok:
                 print ("Unable to achieve a minimum valid config. Contact "
                         "Clustrix Support for assistance.")
                 exit(1)
     print "\nClustrixDB successfully configured!"
+    hugetlb_option = ConfigOption.get_var("HUGE_TLB_ENABLE")
     # Write config file:
-    configfile.write(ConfigOption.options, runmode)
+    timer.phase('write config')
+    changed = [] # Stages which changed files ClustrixDB reads
+    completed = True # Whether to record this run in the manifest
+    if configfile.write(ConfigOption.options, runmode):
+        changed.append('config')
     # Possibly configure ssh:
+    timer.phase('ssh config')
     sshd_option = ConfigOption.get_var("WRITE_HOSTS")
-    if sshd_option.value:
+    ssh_inputs = [sorted(SSHD_CONFIG_ATTRS.items()),
+            sorted(SSH_CLIENT_CONFIG_ATTRS.items())]
+    # .shosts is repaired to be a link to hosts.equiv:
+    ssh_outputs = [SSHD_CONFIG_PATH, SSH_CLIENT_CONFIG_PATH, ROOT_SHOSTS_PATH]
+    if sshd_option.value and not manifest.is_current('ssh', ssh_inputs,
+            ssh_outputs):
         sshd_option.write()
-    # Set up sysctl:
-    sysctl = SysctlConfig(SYSCTL_CONFIG_PATH, SYSCTL_CONFIG_ATTRS)
-    sysctl.write()
+        manifest.record('ssh', ssh_inputs, ssh_outputs)
+    # Set up sysctl, including the huge page reservation:
+    timer.phase('sysctl')
+    sysctl = SysctlConfig(SYSCTL_CONFIG_PATH, node_sysctl_attrs())
+    if hugetlb_option.value:
+        with timer.span('reserve huge pages', 'sysctl'):
+            sysctl.attrs.update(hugetlb_option.write())
+    sysctl_inputs = sorted((key, attr.value, attr.rule)
+            for key, attr in sysctl.attrs.items())
+    # The running values are cheap to read, and are lost on reboot:
+    if sysctl.diff() or not manifest.is_current('sysctl', sysctl_inputs,
+            [SYSCTL_CONFIG_PATH]):
+        if sysctl.write():
+            changed.append('sysctl')
+        manifest.record('sysctl', sysctl_inputs, [SYSCTL_CONFIG_PATH])
+    # Check time sync while the RPMs install:
+    timesync = TimeSyncCheck(max_offset_ms)
+    timesync.start()
+    def clock_ok(running=False):
+        """Finish the time sync check; False if the clock is outside the
+        limits and --force was not given, so ClustrixDB must not start.
+        With running, it is left running as it is instead."""
+        with timer.span('time sync wait', 'ntp'):
+            ok = timesync.finish()
+        if ok or runmode.force:
+            return True
+        if running:
+            outcome = "ClustrixDB was left running with its old configuration"
+        else:
+            outcome = "ClustrixDB service has not been started"
+        print ("Error: This node's clock is outside the time sync limits "
+                "above. %s. Fix time sync or rerun with --force to go ahead "
+                "anyway." % outcome)
+        return False
     # Attempt to install RPMs
     if not runmode.skip_rpms:
         # Install RPMs
-        rpm_list = []
-        for rpmglob in RPM_GLOBS:
-            rpm_list.append(glob.glob(rpmglob))
-        if len([x for x in rpm_list if x]) == len(RPM_GLOBS):
-            # We found every RPM we were looking for, keep trying to install
-            for rpms in rpm_list:
-                # rpms is a list from glob, with ideally just one element
-                rc = yum_install(rpms[0])
-                if rc:
-                    print "Error installing %s" % rpms[0]
-                    if not runmode.no_autorun:
-                        print "ClustrixDB service has not been started."
-                    break
+        timer.phase('rpm install')
+        rpms = find_rpms()
+        if rpms:
+            # We found every RPM we were looking for, install them together
+            rc = install_rpms(rpms)
+            if rc:
+                completed = False
+                print "Error installing %s" % ', '.join(rpms)
+                if not runmode.no_autorun:
+                    print "ClustrixDB service has not been started."
             if not rc:
                 # We didn't fail!
                 print "\nClustrixDB RPMs installed successfully"
@@ -2105,10 +4730,14 @@ def main():
                     http_port = ConfigOption.get_var('HTTP_PORT').value
                     private_ip = ConfigOption.get_var('BACKEND_ADDR').value.addr
                     if http_port != '80':
-                        url = "http://%s:%s/" % (private_ip, http_port)
+                        url = "http://%s:%s/" % (private_ip.url_host(),
+                                http_port)
                     else:
-                        url = "http://%s/" % private_ip
-                    if initctl_clustrix('start', socket_path, http_port):
+                        url = "http://%s/" % private_ip.url_host()
+                    timer.phase('service start')
+                    if not clock_ok():
+                        completed = False
+                    elif initctl_clustrix('start', socket_path, http_port):
                         print "\nClustrixDB is now ready for use."
                         print ("\nOpen %s in a web browser if this "
                         "is the first or only host in your cluster.\nAdd %s "
@@ -2116,6 +4745,7 @@ def main():
                         "dialog if you are adding this node to a cluster." %
                         (url, private_ip))
                     else:
+                        completed = False
                         print "Error: Could not start ClustrixDB Service"
                         print "\tContact Clustrix Support for assistance."
                 else:
@@ -2123,20 +4753,37 @@ def main():
                     print "Start Clustrix with 'initctl start clustrix' as root"
         elif not runmode.skip_rpms:
             # RPM install requested but no RPMs found
+            completed = False
             print "\nNo ClustrixDB RPMs found - install them manually and run:"
             print "\tinitctl start clustrix"
             print "to start the ClustrixDB Service.\n"
+    elif runmode.reconfigure and runmode.rolling and not changed and \
+            clustrix_running():
+        # Nothing clxnode reads has changed, so don't bounce it
+        print ("ClustrixDB configuration is unchanged, the service was left "
+                "running.")
+    elif runmode.reconfigure and runmode.rolling and clustrix_running() and \
+            not clock_ok(running=True):
+        # Don't take a node out of the cluster which we can't bring back
+        completed = False
     elif runmode.reconfigure:
         # Upon reconfiguration, restart initctl clustrix job:
+        if runmode.rolling:
+            # It kept running while we validated, stop it only now
+            timer.phase('service stop')
+            initctl_clustrix('stop')
         socket_path = ConfigOption.get_var('UNIX_SOCKET_PATH').value
         http_port = ConfigOption.get_var('HTTP_PORT').value
         private_ip = ConfigOption.get_var('BACKEND_ADDR').value.addr
         if http_port not in ('80', 80): # Match either type
-            url = "http://%s:%s/" % (private_ip, http_port)
+            url = "http://%s:%s/" % (private_ip.url_host(), http_port)
         else:
             # Don't add the port when its default
-            url = "http://%s/" % private_ip
-        if initctl_clustrix('start', socket_path, http_port):
+            url = "http://%s/" % private_ip.url_host()
+        timer.phase('service start')
+        if not clock_ok():
+            completed = False
+        elif initctl_clustrix('start', socket_path, http_port):
             # Restarted or Started OK
             print ("ClustrixDB Service restarted sucessfully. If your cluster "
                     "has previously been configured, you may continue to use "
@@ -2145,64 +4792,24 @@ def main():
                     "cluster. If you are adding this node to an existing "
                     "cluster, enter '%s' to the list of IP addresses in the "
                     "'Nodes to Add' dialog." % (url, private_ip))
+        else:
+            completed = False
 
     # Now that the RPMs are installed, ntp should be available and running
     # Do some sanity checks and warn on ungood conditions:
-    if not have_command('ntpq'):
-        # This comes in the ntp package, which should have just been installed
-        ntp_warn("ntp not found.")
-    else:
-        # Note: this command may take ~20 seconds to complete:
-        ntp_peers = get_output('ntpq -p').strip()
-        if 'Connection refused' in ntp_peers:
-            # Could not connect to ntpd, attempt to start service
-            print 'NOTE: ntpd is not running - attempting to start service.'
-            p = subprocess.Popen('service ntpd start'.split())
-            p.wait()
-            time.sleep(5) # Give it some time to initialize
-            ntp_peers = get_output('ntpq -p').strip()
-        if 'Connection refused' in ntp_peers:
-            # Could not connect to ntpd again
-            ntp_warn('ntpd is not running.')
-        else:
-            # Got some peers info back from ntpd
-            # Ex:
-            #       remote           refid      st t when poll reach   delay   offset  jitter
-            #   ==============================================================================
-            #    LOCAL(0)        .LOCL.          10 l   6h   64    0    0.000    0.000   0.000
-            #   *midget.colo.spr 38.229.71.1      3 u  834 1024  377    2.048   -0.121  11.800
-            # Example with no servers configured:
-            #   No association ID's returned
-            # Column info: http://www.eecis.udel.edu/~mills/ntp/html/ntpq.html - peers section
-            try:
-                ntp_peers = ntp_peers.split('\n')[2:] # Ignore first two lines
-                for peer in ntp_peers:
-                    if peer.split()[3] == 'l':
-                        # This is the local clock - does not provide sync
-                        continue
-                    if peer[0].lower() in ('x', '.', '-'):
-                        # The leading character indicates peer status, as per
-                        #   the 'T' column of the 'Select Field' table here:
-                        # http://www.eecis.udel.edu/~mills/ntp/html/decode.html#peer
-                        # A leading space is a bad status, but that's what
-                        # all servers start with before ntpd has had time to
-                        # get sync'd up, so we'll allow it.
-                        continue
-                    # If we get this far, we probably have a legit time source
-                    print "Note: ntpd is running with acceptable configuration."
-                    break
-                else:
-                    # We got through the whole peers output with finding a
-                    #   proper time server
-                    ntp_warn("No valid NTP time source found.")
-            except:
-                ntp_warn('NTP Peers parse failure.')
+    timer.phase('ntp check')
+    clock_in_limits = timesync.finish() or runmode.force
+    if not clock_in_limits:
+        completed = False # So the next run checks again
 
+    timer.end_phase()
     if not ConfigOption.runmode.reconfigure:
         # Print config command for other nodes for new installs:
         print '' # newline
         print "= "*39 # Wide dotted bar
-        arg_string = ' '.join([x.mkarg() for x in ConfigOption.options if x.mkarg()])
+        # Per-node options are left out, each node picks its own
+        args = [x.mkarg(placeholders=False) for x in ConfigOption.options]
+        arg_string = ' '.join([x for x in args if x])
         if 'CLXSRC' in os.environ:
             # We got this from the web, print an automatic download / install command:
             version = os.environ['VERSION']
@@ -2224,6 +4831,19 @@ def main():
         print "= " * 39
     print ("\n*** This Node's IP (Needed later during cluster configuration): %s" %
             ConfigOption.get_var('BACKEND_ADDR').value.addr)
+    if completed:
+        # The version now installed is what a rerun will see:
+        manifest.record('run', run_inputs(get_current_clxnode()),
+                run_outputs)
+    try:
+        manifest.save()
+    except (IOError, OSError), e:
+        print "Warning: Unable to save install state to %s: %s" % (
+                manifest.path, e)
+    if not clock_in_limits:
+        print ("Error: Clock is outside the time sync limits, rerun with "
+                "--force to ignore them.")
+        exit(1)
 
 
 
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+
+#
+#   ClustrixDB back-end network probe.
+#
+#   Run with --listen on every node before ClustrixDB is started, then run
+#   with a list of peer back-end IPs on any node to measure round trip
+#   time, UDP loss and TCP throughput to each of them over the back-end
+#   network, and compare them against the cluster interconnect budget.
+#   With --skew, measure how far each peer's clock is from ours instead.
+
+import socket
+import struct
+import select
+import optparse
+import threading
+import time
+
+DEFAULT_PORT = 24378 # BACKEND_PORT, free until clxnode is started
+SKEW_PORT = 24379 # For clock skew checks once clxnode holds DEFAULT_PORT
+UDP_PROBES = 200 # Probes sent to each peer for RTT and loss
+UDP_INTERVAL = 0.005 # Seconds between UDP probes
+UDP_PROBE_SIZE = 256 # Bytes per UDP probe, with padding
+UDP_TIMEOUT = 1.0 # Seconds to wait for stragglers after the last probe
+TCP_TEST_SIZE = 64 # MiB streamed to each peer for throughput
+TCP_CHUNK = 1024 * 1024
+CONNECT_TIMEOUT = 5.0
+SKEW_PROBES = 32 # Probes sent to each peer for its clock offset
+SKEW_INTERVAL = 0.01 # Seconds between clock offset probes
+# The cluster interconnect budget, links which miss it get a warning:
+BUDGET_RTT_P99_MS = 1.0
+BUDGET_UDP_LOSS_PCT = 0.1
+BUDGET_TCP_MIBPS = 100.0
+BUDGET_SKEW_MS = 10.0 # Largest clock difference between any two nodes
+
+# UDP probe:       type, sequence number, client send time (t0)
+# UDP probe reply: type, sequence number, t0, server receive time (t1),
+#                  server send time (t2)
+UDP_PROBE = struct.Struct('!cId')
+UDP_REPLY = struct.Struct('!cIddd')
+# TCP throughput test: the client sends a header with the byte count,
+#   then the bytes, and the server answers with what it received and
+#   how long that took on its side.
+TCP_HEADER = struct.Struct('!cQ')
+TCP_REPLY = struct.Struct('!Qd')
+
+def percentile(values, pct):
+    """Return the pct'th percentile (nearest rank) of a list of numbers."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def address_family(addr):
+    """Return the socket family of a numeric IPv4 or IPv6 address, raising
+    socket.gaierror for anything else."""
+    return socket.getaddrinfo(addr, None, socket.AF_UNSPEC, 0, 0,
+            socket.AI_NUMERICHOST)[0][0]
+
+def valid_ip(ip):
+    """Check that ip is a numeric IPv4 or IPv6 address."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, ip)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+def listen_addr():
+    """Address to listen on when none is given: every IPv6 and IPv4
+    address if this host has IPv6, otherwise every IPv4 address."""
+    if socket.has_ipv6:
+        try:
+            socket.socket(socket.AF_INET6, socket.SOCK_DGRAM).close()
+            return '::'
+        except socket.error:
+            pass
+    return '0.0.0.0'
+
+def recv_exactly(sock, size):
+    """Read exactly size bytes from a TCP socket, or raise socket.error."""
+    data = []
+    while size:
+        chunk = sock.recv(min(size, TCP_CHUNK))
+        if not chunk:
+            raise socket.error("Connection closed by peer")
+        data.append(chunk)
+        size -= len(chunk)
+    return ''.join(data)
+
+class ProbeListener(object):
+    """Answers UDP probes and TCP throughput tests from peers."""
+    def __init__(self, addr='0.0.0.0', port=DEFAULT_PORT):
+        # On Linux, '::' takes IPv4 peers too, as IPv4-mapped addresses
+        family = address_family(addr)
+        self.udp = socket.socket(family, socket.SOCK_DGRAM)
+        self.udp.bind((addr, port))
+        self.tcp = socket.socket(family, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((addr, port))
+        self.tcp.listen(16)
+    def serve_udp(self):
+        while True:
+            data, peer = self.udp.recvfrom(65536)
+            t1 = time.time()
+            try:
+                kind, seq, t0 = UDP_PROBE.unpack_from(data)
+            except struct.error:
+                continue # Not one of ours
+            self.udp.sendto(UDP_REPLY.pack(kind, seq, t0, t1, time.time()),
+                    peer)
+    def serve_tcp_client(self, conn):
+        try:
+            kind, size = TCP_HEADER.unpack(recv_exactly(conn,
+                TCP_HEADER.size))
+            t0 = time.time()
+            received = 0
+            while received < size:
+                chunk = conn.recv(min(size - received, TCP_CHUNK))
+                if not chunk:
+                    break
+                received += len(chunk)
+            conn.sendall(TCP_REPLY.pack(received, time.time() - t0))
+        except (socket.error, struct.error):
+            pass # The client will report the failure
+        finally:
+            conn.close()
+    def serve_tcp(self):
+        while True:
+            conn, peer = self.tcp.accept()
+            t = threading.Thread(target=self.serve_tcp_client, args=(conn,))
+            t.daemon = True
+            t.start()
+    def serve(self, duration=None):
+        """Serve until duration seconds pass (or forever)."""
+        for target in (self.serve_udp, self.serve_tcp):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        deadline = duration and time.time() + duration
+        while not deadline or time.time() < deadline:
+            time.sleep(1) # Sleep in the main thread so ^C works
+
+class UDPSample(object):
+    """One answered UDP probe, with NTP-style timestamps:
+    t0 client send, t1 server receive, t2 server send, t3 client receive."""
+    def __init__(self, t0, t1, t2, t3):
+        self.t0, self.t1, self.t2, self.t3 = t0, t1, t2, t3
+    def rtt(self):
+        """Round trip time, less the time the server held the probe."""
+        return (self.t3 - self.t0) - (self.t2 - self.t1)
+    def offset(self):
+        """How far the server's clock is ahead of ours."""
+        return ((self.t1 - self.t0) + (self.t2 - self.t3)) / 2
+
+class PeerProbe(object):
+    """Measures the link to one peer running a ProbeListener."""
+    def __repr__(self):
+        return "<PeerProbe %s:%d>" % (self.peer, self.port)
+    def __init__(self, peer, port=DEFAULT_PORT, source=None):
+        self.peer = peer
+        self.port = port
+        self.source = source # Local back-end IP to send from
+        self.samples = []
+        self.sent = 0
+        self.tcp_mibps = None
+        self.error = None
+    def udp_probe(self, count=UDP_PROBES, interval=UDP_INTERVAL,
+            kind='P'):
+        """Send count probes, collect replies into self.samples."""
+        sock = socket.socket(address_family(self.peer), socket.SOCK_DGRAM)
+        if self.source:
+            sock.bind((self.source, 0))
+        sock.connect((self.peer, self.port))
+        pad = '\0' * max(0, UDP_PROBE_SIZE - UDP_PROBE.size)
+        replies = {}
+        def receive(deadline, stop_when_answered):
+            """Collect replies until the deadline, or until every probe sent
+            so far has been answered if stop_when_answered is set.
+            Replies are timestamped as soon as they arrive."""
+            while not (stop_when_answered and len(replies) == self.sent):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                if not select.select([sock], [], [], remaining)[0]:
+                    return
+                try:
+                    data = sock.recv(65536)
+                except socket.error:
+                    # ICMP port unreachable shows up here, nobody listening
+                    continue
+                t3 = time.time()
+                try:
+                    k, seq, t0, t1, t2 = UDP_REPLY.unpack_from(data)
+                except struct.error:
+                    continue # Not one of ours
+                replies[seq] = UDPSample(t0, t1, t2, t3)
+        try:
+            next_send = time.time()
+            for seq in range(count):
+                sock.send(UDP_PROBE.pack(kind, seq, time.time()) + pad)
+                self.sent += 1
+                # Pace the probes, listening for replies in between:
+                next_send += interval
+                receive(next_send, False)
+            receive(time.time() + UDP_TIMEOUT, True)
+        finally:
+            sock.close()
+        self.samples.extend([replies[x] for x in sorted(replies)])
+        return self.samples
+    def tcp_throughput(self, size_mib=TCP_TEST_SIZE):
+        """Stream size_mib MiB to the peer, return MiB/s."""
+        size = size_mib * 1024 * 1024
+        sock = socket.socket(address_family(self.peer), socket.SOCK_STREAM)
+        if self.source:
+            sock.bind((self.source, 0))
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect((self.peer, self.port))
+            sock.settimeout(None)
+            chunk = '\xa5' * TCP_CHUNK
+            t0 = time.time()
+            sock.sendall(TCP_HEADER.pack('S', size))
+            sent = 0
+            while sent < size:
+                sock.sendall(chunk[:size - sent])
+                sent += min(TCP_CHUNK, size - sent)
+            received, server_seconds = TCP_REPLY.unpack(recv_exactly(sock,
+                TCP_REPLY.size))
+            elapsed = time.time() - t0
+        finally:
+            sock.close()
+        self.tcp_mibps = received / 1048576.0 / elapsed
+        return self.tcp_mibps
+    def run(self, tcp_size=TCP_TEST_SIZE):
+        """Run the UDP and TCP tests, recording any error."""
+        try:
+            self.udp_probe()
+            if not self.samples:
+                self.error = "No UDP replies, is the listener running?"
+                return
+            if tcp_size:
+                self.tcp_throughput(tcp_size)
+        except socket.error, e:
+            self.error = str(e)
+    def loss_pct(self):
+        if not self.sent:
+            return None
+        return 100.0 * (self.sent - len(self.samples)) / self.sent
+    def rtt_ms(self, pct):
+        return percentile([x.rtt() * 1000 for x in self.samples], pct)
+    def over_budget(self, max_rtt=BUDGET_RTT_P99_MS,
+            max_loss=BUDGET_UDP_LOSS_PCT, min_mibps=BUDGET_TCP_MIBPS):
+        """Return a list of strings describing how this link misses the
+        interconnect budget."""
+        if self.error:
+            return [self.error]
+        problems = []
+        if self.rtt_ms(99) > max_rtt:
+            problems.append("RTT p99 %.3f ms exceeds %.3f ms" %
+                    (self.rtt_ms(99), max_rtt))
+        if self.loss_pct() > max_loss:
+            problems.append("UDP loss %.2f%% exceeds %.2f%%" %
+                    (self.loss_pct(), max_loss))
+        if self.tcp_mibps is not None and self.tcp_mibps < min_mibps:
+            problems.append("TCP throughput %.0f MiB/s is below %.0f MiB/s" %
+                    (self.tcp_mibps, min_mibps))
+        return problems
+    def summary(self):
+        if self.error:
+            return "%-16s error: %s" % (self.peer, self.error)
+        tcp = 'n/a'
+        if self.tcp_mibps is not None:
+            tcp = '%.0f MiB/s' % self.tcp_mibps
+        return ("%-16s rtt p50 %.3f ms p99 %.3f ms max %.3f ms, "
+                "udp loss %.2f%%, tcp %s" % (self.peer, self.rtt_ms(50),
+                    self.rtt_ms(99), self.rtt_ms(100), self.loss_pct(), tcp))
+
+class SkewSurvey(object):
+    """Measures every peer's clock offset from ours at once, and from those
+    the skew between every pair of nodes, this one included."""
+    def __init__(self, peers, port=SKEW_PORT, source=None, count=SKEW_PROBES):
+        self.local = source or 'local'
+        self.probes = [PeerProbe(peer, port, source) for peer in peers]
+        self.count = count
+    def probe(self, probe):
+        try:
+            probe.udp_probe(self.count, SKEW_INTERVAL, kind='T')
+        except socket.error, e:
+            probe.error = str(e)
+    def run(self):
+        threads = [threading.Thread(target=self.probe, args=(probe,))
+                for probe in self.probes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    def offsets(self):
+        """Return a dict of peer: (offset ms, error bound ms) for every peer
+        which answered. Like NTP, trust the sample with the lowest RTT,
+        whose offset can be off by at most half that RTT."""
+        offsets = {}
+        for probe in self.probes:
+            if probe.samples:
+                best = min(probe.samples, key=lambda x: x.rtt())
+                offsets[probe.peer] = (best.offset() * 1000,
+                        best.rtt() * 1000 / 2)
+        return offsets
+    def unmeasured(self):
+        return [probe.peer for probe in self.probes if not probe.samples]
+    def pairwise(self):
+        """Return (node, node, skew ms) for every pair of measured nodes,
+        largest skew first."""
+        offsets = [(self.local, 0.0)] + [(peer, offset) for peer, (offset,
+            error) in sorted(self.offsets().items())]
+        pairs = []
+        for x, (a, a_offset) in enumerate(offsets):
+            for b, b_offset in offsets[x + 1:]:
+                pairs.append((a, b, abs(a_offset - b_offset)))
+        pairs.sort(key=lambda pair: -pair[2])
+        return pairs
+    def outliers(self, budget=BUDGET_SKEW_MS):
+        """Return the peers to blame when the skew is over budget: those
+        further than half the budget from the median clock. Any two nodes
+        left are then within the budget of each other."""
+        offsets = self.offsets()
+        clocks = sorted([0.0] + [offset for offset, error in offsets.values()])
+        median = clocks[len(clocks) / 2]
+        return sorted([peer for peer, (offset, error) in offsets.items()
+            if abs(offset - median) > budget / 2])
+    def summary(self):
+        lines = []
+        for peer, (offset, error) in sorted(self.offsets().items()):
+            lines.append("%-16s clock offset %+.3f ms (+/- %.3f ms)" %
+                    (peer, offset, error))
+        for peer in self.unmeasured():
+            lines.append("%-16s no reply, is the listener running?" % peer)
+        pairs = self.pairwise()
+        if len(pairs):
+            lines.append("Largest skew %.3f ms, between %s and %s" %
+                    (pairs[0][2], pairs[0][0], pairs[0][1]))
+        return lines
+
+def main():
+    parser = optparse.OptionParser(usage="%prog --listen [options]\n"
+            "       %prog [options] PEER_IP ...")
+    parser.add_option('--listen', action='store_true', default=False,
+            help="Answer probes from other nodes.")
+    parser.add_option('--addr', help="With --listen, the address to listen "
+            "on [Default: :: if this host has IPv6, otherwise 0.0.0.0]")
+    parser.add_option('--duration', type='int', help="With --listen, exit "
+            "after this many seconds.")
+    parser.add_option('--port', type='int', default=DEFAULT_PORT,
+            help="TCP and UDP port to use [Default: %default]")
+    parser.add_option('--source', help="Local back-end IP to send probes "
+            "from.")
+    parser.add_option('--skew', action='store_true', default=False,
+            help="Only measure the clock skew between this node and the "
+            "peers, and between the peers.")
+    parser.add_option('--skew-port', type='int', default=SKEW_PORT,
+            help="With --skew, port the peers' listeners use, the same one "
+            "cluster_join.py uses [Default: %default]")
+    parser.add_option('--max-skew-ms', type='float', default=BUDGET_SKEW_MS,
+            help="With --skew, budget for clock skew between any two nodes "
+            "[Default: %default]")
+    parser.add_option('--tcp-size', type='int', default=TCP_TEST_SIZE,
+            help="MiB to send for the TCP throughput test, 0 to skip it "
+            "[Default: %default]")
+    parser.add_option('--max-rtt-ms', type='float', default=BUDGET_RTT_P99_MS,
+            help="Budget for p99 round trip time [Default: %default]")
+    parser.add_option('--max-loss-pct', type='float',
+            default=BUDGET_UDP_LOSS_PCT, help="Budget for UDP loss "
+            "[Default: %default]")
+    parser.add_option('--min-tcp-mibps', type='float',
+            default=BUDGET_TCP_MIBPS, help="Budget for TCP throughput "
+            "[Default: %default]")
+    (options, args) = parser.parse_args()
+
+    if options.listen:
+        options.addr = options.addr or listen_addr()
+        try:
+            listener = ProbeListener(options.addr, options.port)
+        except socket.error, e:
+            print "Error: Unable to listen on port %d: %s" % (options.port, e)
+            exit(1)
+        print "Listening for probes on %s port %d" % (options.addr,
+                options.port)
+        try:
+            listener.serve(options.duration)
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+    if not args:
+        parser.error("No peer IPs given.")
+    for peer in args:
+        if not valid_ip(peer):
+            parser.error("`%s` is not a valid IP address." % peer)
+    if options.skew:
+        survey = SkewSurvey(args, options.skew_port, options.source)
+        survey.run()
+        print '\n'.join(survey.summary())
+        outliers = survey.outliers(options.max_skew_ms)
+        for peer in outliers:
+            print "Warning: Clock on %s is outside the %.1f ms skew budget." % \
+                    (peer, options.max_skew_ms)
+        exit(bool(outliers or survey.unmeasured()))
+    ok = True
+    # One peer at a time, so throughput tests don't compete for the link
+    for peer in args:
+        probe = PeerProbe(peer, options.port, options.source)
+        probe.run(options.tcp_size)
+        print probe.summary()
+        for problem in probe.over_budget(options.max_rtt_ms,
+                options.max_loss_pct, options.min_tcp_mibps):
+            print "Warning: Link to %s is outside the interconnect budget: "\
+                    "%s." % (peer, problem)
+            ok = False
+    exit(not ok)
+
+
+if __name__ == "__main__":
+    main()